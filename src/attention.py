@@ -10,7 +10,7 @@ class AttLayer(Layer):
         self.init = initializers.get('normal')
         self.supports_masking = True
         self.attention_dim = attention_dim
-        super(AttLayer, self).__init__()
+        super(AttLayer, self).__init__(**kwargs)
 
     def build(self, input_shape):
         assert len(input_shape) == 3
@@ -46,6 +46,11 @@ class AttLayer(Layer):
     def compute_output_shape(self, input_shape):
         return (input_shape[0], input_shape[-1])
 
+    def get_config(self):
+        config = {'attention_dim': self.attention_dim}
+        base_config = super(AttLayer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
 class AttentionWeightedAverage(Layer):
     """
     Attention implementation from: https://github.com/tsterbak/keras_attention/blob/master/models.py
@@ -0,0 +1,142 @@
+import math
+import multiprocessing
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _ngram_rows(sequences:list, n:int):
+    """ Every n-gram of every sequence as a row (sequence index, w_1, ..., w_n), built over
+    one flat token array instead of a Python loop per position
+    """
+    lengths = np.asarray([len(s) for s in sequences], dtype=np.int64)
+    if lengths.sum() == 0:
+        return np.zeros((0, n + 1), dtype=np.int64)
+    tokens = np.concatenate([np.asarray(s, dtype=np.int64) for s in sequences if len(s) > 0])
+    seq_ids = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths)
+
+    starts = np.arange(len(tokens) - n + 1)
+    # An n-gram may not cross into the next sequence
+    starts = starts[seq_ids[starts] == seq_ids[starts + n - 1]]
+    return np.stack([seq_ids[starts]] + [tokens[starts + k] for k in range(n)], axis=1)
+
+def clipped_matches(references:list, candidates:list, n:int):
+    """ Candidate n-grams matched in their reference, each clipped to its reference count,
+    summed over the corpus; and the total number of candidate n-grams
+    """
+    cand_rows, ref_rows = _ngram_rows(candidates, n), _ngram_rows(references, n)
+    if len(cand_rows) == 0 or len(ref_rows) == 0:
+        return 0, len(cand_rows)
+
+    cand_unique, cand_counts = np.unique(cand_rows, axis=0, return_counts=True)
+    ref_unique, ref_counts = np.unique(ref_rows, axis=0, return_counts=True)
+    # Shared ID's for (sequence, n-gram) rows of both sides
+    _, row_ids = np.unique(np.concatenate([cand_unique, ref_unique]), axis=0, return_inverse=True)
+    row_ids = row_ids.ravel()
+    ref_count_by_id = np.zeros(row_ids.max() + 1, dtype=np.int64)
+    ref_count_by_id[row_ids[len(cand_unique):]] = ref_counts
+    matches = np.minimum(cand_counts, ref_count_by_id[row_ids[:len(cand_unique)]]).sum()
+    return int(matches), len(cand_rows)
+
+def corpus_bleu(references:list, candidates:list, max_n:int=4):
+    """ Corpus BLEU with one reference per candidate, no smoothing (as
+    `nltk.translate.bleu_score.corpus_bleu` with single references)
+
+    Arguments:
+        references {list} -- Reference token ID sequences
+        candidates {list} -- Candidate token ID sequences, aligned with `references`
+
+    Returns:
+        dict -- `bleu`, n-gram `precisions`, `brevity_penalty`, candidate/reference lengths
+    """
+    assert len(references) == len(candidates), 'Need one reference per candidate!'
+    precisions = []
+    for n in range(1, max_n + 1):
+        matches, total = clipped_matches(references, candidates, n)
+        precisions.append(float(matches) / total if total > 0 else 0.)
+
+    cand_len, ref_len = sum(len(c) for c in candidates), sum(len(r) for r in references)
+    if cand_len == 0:
+        brevity_penalty = 0.
+    else:
+        brevity_penalty = 1. if cand_len > ref_len else math.exp(1. - float(ref_len) / cand_len)
+    bleu = brevity_penalty * math.exp(sum(math.log(p) for p in precisions) / max_n) if min(precisions) > 0 else 0.
+    return {'bleu': bleu, 'precisions': precisions, 'brevity_penalty': brevity_penalty,
+            'candidate_length': cand_len, 'reference_length': ref_len}
+
+def greedy_decode_batch(predict_fn, encoder_inputs:list, bos:int, eos:int, len_limit:int=100):
+    """ Greedy decoding of a whole batch for a model that maps (*encoder_inputs, decoder
+    input) to logits over every decoder position. Finished rows are dropped from later
+    steps and decoding stops once every row produced `eos`.
+
+    Arguments:
+        predict_fn {callable} -- List of input arrays -> logits (batch, time, vocab)
+        encoder_inputs {list} -- Encoder input arrays, (batch, time) each
+
+    Returns:
+        list -- Decoded token ID's per row, without `bos`/`eos`
+    """
+    batch_size = encoder_inputs[0].shape[0]
+    target_seq = np.zeros((batch_size, len_limit), dtype='int32')
+    target_seq[:, 0] = bos
+    lengths = np.full(batch_size, len_limit - 1)
+    active = np.arange(batch_size)
+
+    for i in range(len_limit - 1):
+        logits = predict_fn([x[active] for x in encoder_inputs] + [target_seq[active, :i + 1]])
+        next_tokens = logits[:, i, :].argmax(axis=-1)
+        target_seq[active, i + 1] = next_tokens
+        finished = next_tokens == eos
+        lengths[active[finished]] = i
+        active = active[~finished]
+        if len(active) == 0:
+            break
+
+    return [target_seq[b, 1: lengths[b] + 1].tolist() for b in range(batch_size)]
+
+_replica = {}
+
+def _init_replica(model_path:str, custom_objects:dict):
+    import os
+    # Replicas run on CPU so they can share the machine with a GPU trainer
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    from keras.models import load_model
+
+    _replica['model'] = load_model(model_path, custom_objects=custom_objects, compile=False)
+
+def _decode_on_replica(task):
+    encoder_inputs, bos, eos, len_limit = task
+    return greedy_decode_batch(_replica['model'].predict_on_batch, encoder_inputs, bos, eos, len_limit=len_limit)
+
+def parallel_decode(model_path:str, batches:list, bos:int, eos:int, len_limit:int=100, n_processes:int=2,
+                    custom_objects:dict=None):
+    """ `greedy_decode_batch` over `batches` (lists of encoder input arrays) on a pool of
+    `n_processes` model replicas loaded from `model_path`
+
+    Returns:
+        list -- Decoded token ID's per row, batches concatenated in order
+    """
+    # Fresh interpreters, a forked TF session is not safe to use
+    pool = multiprocessing.get_context('spawn').Pool(n_processes, initializer=_init_replica,
+                                                     initargs=(model_path, custom_objects or {}))
+    try:
+        decoded = pool.map(_decode_on_replica, [(b, bos, eos, len_limit) for b in batches], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [seq for batch in decoded for seq in batch]
+
+def bleu_report(references:list, candidates:list, decode_sec:float, max_n:int=4):
+    """ Corpus BLEU plus decoding throughput, printed and returned """
+    report = corpus_bleu(references, candidates, max_n=max_n)
+    report = OrderedDict([('sentences', len(candidates)), ('decode_sec', decode_sec),
+                          ('sentences_per_sec', len(candidates) / max(decode_sec, 1e-9))] + list(report.items()))
+    print('\nBLEU EVALUATION REPORT')
+    print('=' * 50)
+    for k, v in report.items():
+        if isinstance(v, list):
+            v = ' / '.join('{:.4f}'.format(p) for p in v)
+        print('{}: {}'.format(k, round(v, 4) if isinstance(v, float) else v))
+    return report
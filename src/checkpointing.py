@@ -0,0 +1,357 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from keras.callbacks import Callback
+
+
+def rng_state():
+    """ NumPy global RNG state as JSON-serializable values """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+def skip_batches(generator, n_batches:int):
+    """ Fast-forward a batch generator past the `n_batches` already trained on """
+    for _ in range(n_batches):
+        next(generator)
+    return generator
+
+def _atomic_write(path:str, write_fn):
+    """ Write through a temporary file and rename it into place, so readers never see a partial file """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='wb') as outfile:
+        write_fn(outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointManager(object):
+    def __init__(self, directory:str, prefix:str='ckpt', keep_last:int=3, keep_best:int=1, mode:str='min'):
+        """ Snapshot weights in memory and write them to disk on a background thread
+
+        Training only pays for copying the weights to host memory; the write happens while the
+        next batches run. Files are written under a temporary name and renamed into place, and
+        `<prefix>.json` in `directory` indexes them together with the training state needed to
+        resume (epoch, batches done, RNG state...). The `keep_last` most recent checkpoints and the
+        `keep_best` best by metric are kept, the rest deleted.
+
+        Arguments:
+            directory {str} -- Checkpoint directory, created if missing
+
+        Keyword Arguments:
+            prefix {str} -- Checkpoint file name prefix (default: {'ckpt'})
+            keep_last {int} -- Number of most recent checkpoints to keep (default: {3})
+            keep_best {int} -- Number of best-metric checkpoints to keep (default: {1})
+            mode {str} -- `min` or `max`, whether a lower or higher metric is better (default: {'min'})
+        """
+        assert mode in {'min', 'max'}, 'Mode must be `min` or `max`!'
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.index_path = os.path.join(directory, prefix + '.json')
+        os.makedirs(directory, exist_ok=True)
+
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, mode='r') as infile:
+                self.entries = json.load(infile)
+        self.n_saved = max([e['id'] for e in self.entries], default=-1) + 1
+
+        # One snapshot can wait while another is written, a third save blocks - bounds host memory
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def save(self, weights:list, state:dict=None, metric:float=None, export:tuple=None):
+        """ Queue a snapshot for writing and return immediately
+
+        Arguments:
+            weights {list} -- NumPy arrays, already copied out of the model (see `keras_snapshot`)
+
+        Keyword Arguments:
+            state {dict} -- JSON-serializable training state stored with the weights (default: {None})
+            metric {float} -- Validation metric used for best-K retention (default: {None})
+            export {tuple} -- `(path, write_fn)`, a loadable model file also written from `weights` on the
+            background thread, e.g. `KerasModelExport`. Exports are not pruned (default: {None})
+        """
+        self._raise_writer_error()
+        entry = {'id': self.n_saved, 'path': '{}-{:06d}.npz'.format(self.prefix, self.n_saved), 'time': time.time(),
+                 'metric': None if metric is None else float(metric), 'state': state or {}}
+        self.n_saved += 1
+        self._queue.put((entry, weights, export))
+
+    def export(self, weights:list, path:str, write_fn):
+        """ Queue only a loadable model file written from `weights`, no resume snapshot (see `save`) """
+        self._raise_writer_error()
+        self._queue.put((None, weights, (path, write_fn)))
+
+    def _write_loop(self):
+        while True:
+            entry, weights, export = self._queue.get()
+            try:
+                if entry is not None:
+                    start = time.time()
+                    _atomic_write(os.path.join(self.directory, entry['path']), lambda f: np.savez(f, *weights))
+                    entry['write_sec'] = time.time() - start
+                if export is not None:
+                    path, write_fn = export
+                    write_fn(path, weights)
+                if entry is not None:
+                    if export is not None:
+                        entry['export'] = path
+                    self.entries.append(entry)
+                    self._prune()
+                    _atomic_write(self.index_path, lambda f: f.write(json.dumps(self.entries, indent=1).encode('utf-8')))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        keep = {e['id'] for e in self.entries[-self.keep_last:]} if self.keep_last > 0 else set()
+        scored = [e for e in self.entries if e['metric'] is not None]
+        scored.sort(key=lambda e: e['metric'], reverse=(self.mode == 'max'))
+        keep.update(e['id'] for e in scored[:self.keep_best])
+
+        for e in self.entries:
+            if e['id'] not in keep:
+                path = os.path.join(self.directory, e['path'])
+                if os.path.exists(path):
+                    os.remove(path)
+        self.entries = [e for e in self.entries if e['id'] in keep]
+
+    def _raise_writer_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Checkpoint write failed: {}'.format(error))
+
+    def wait(self):
+        """ Block until every queued checkpoint is on disk """
+        self._queue.join()
+        self._raise_writer_error()
+
+    def _load(self, entry):
+        with np.load(os.path.join(self.directory, entry['path'])) as data:
+            weights = [data['arr_{}'.format(i)] for i in range(len(data.files))]
+        return weights, entry['state']
+
+    def latest(self):
+        """ (weights, state) of the most recent checkpoint, (None, None) if there is none """
+        self.wait()
+        return self._load(self.entries[-1]) if self.entries else (None, None)
+
+    def best(self):
+        """ (weights, state) of the best-metric checkpoint, (None, None) if none has a metric """
+        self.wait()
+        scored = [e for e in self.entries if e['metric'] is not None]
+        if not scored:
+            return None, None
+        pick = min if self.mode == 'min' else max
+        return self._load(pick(scored, key=lambda e: e['metric']))
+
+class PeriodicCheckpoint(Callback):
+    def __init__(self, manager:CheckpointManager, snapshot_fn, every_n_batches:int, state:dict, start_batch:int=0,
+                 data_state_fn=None):
+        """ Keras callback queueing a snapshot every `every_n_batches` batches of an epoch, with
+        `state` plus the number of batches done this epoch (`batch`) for mid-epoch resume
+
+        Arguments:
+            snapshot_fn {callable} -- Returns the weights to save, e.g. `lambda: keras_snapshot(model)`
+            state {dict} -- Training state saved alongside, e.g. epoch and epoch-start RNG state
+
+        Keyword Arguments:
+            start_batch {int} -- Batches of this epoch done before a resume (default: {0})
+            data_state_fn {callable} -- Batches done -> data iterator state, saved as `data` (default: {None})
+        """
+        super(PeriodicCheckpoint, self).__init__()
+        self.manager = manager
+        self.snapshot_fn = snapshot_fn
+        self.every_n_batches = every_n_batches
+        self.state = state
+        self.start_batch = start_batch
+        self.data_state_fn = data_state_fn
+
+    def on_batch_end(self, batch, logs=None):
+        n_done = self.start_batch + batch + 1
+        if self.every_n_batches > 0 and n_done % self.every_n_batches == 0:
+            state = dict(self.state, batch=n_done)
+            # Keras prefetches batches, so the position comes from batches trained, not the live generator
+            if self.data_state_fn is not None:
+                state['data'] = self.data_state_fn(n_done)
+            self.manager.save(self.snapshot_fn(), state=state)
+
+def keras_snapshot(model, optimizer=None):
+    """ In-memory copy of a Keras model's weights followed by its optimizer's (slots, iterations),
+    restored by `restore_keras`
+    """
+    optimizer = model.optimizer if optimizer is None else optimizer
+    model_weights = model.get_weights()
+    optimizer_weights = optimizer.get_weights() if optimizer is not None else []
+    return model_weights + optimizer_weights
+
+def restore_keras(model, weights:list, optimizer=None, train_model=None):
+    """ Load a `keras_snapshot` back. Optimizer weights only exist once the training function is
+    built, so it is built first on `train_model` (the model that gets fit, default `model`).
+    """
+    train_model = model if train_model is None else train_model
+    optimizer = train_model.optimizer if optimizer is None else optimizer
+    n_model_weights = len(model.weights)
+    model.set_weights(weights[:n_model_weights])
+    if len(weights) > n_model_weights:
+        train_model._make_train_function()
+        optimizer.set_weights(weights[n_model_weights:])
+
+def _json_default(obj):
+    """ JSON fallback for Keras configs, the same conversions Keras' `save_model` applies """
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__, 'config': obj.get_config()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if callable(obj) or isinstance(obj, type):
+        return obj.__name__
+    raise TypeError('Not JSON Serializable: {}'.format(obj))
+
+def _keras_layout(model, snapshot_model):
+    """ Per layer of `model`: its name, weight names and the positions of its weights in a
+    `keras_snapshot` of `snapshot_model`, plus the number of model weights in that snapshot
+    """
+    snapshot_weights = [w for layer in snapshot_model.layers for w in layer.weights]
+    positions = {id(w): i for i, w in enumerate(snapshot_weights)}
+    layout = []
+    for layer in model.layers:
+        missing = [w.name for w in layer.weights if id(w) not in positions]
+        if missing:
+            raise ValueError('Weights {} of layer {} are not in the snapshot'.format(missing, layer.name))
+        names = [str(w.name) if getattr(w, 'name', None) else 'param_{}'.format(i) for i, w in enumerate(layer.weights)]
+        layout.append((layer.name, names, [positions[id(w)] for w in layer.weights]))
+    return layout, len(snapshot_weights)
+
+def _write_datasets(group, names, values):
+    for name, value in zip(names, values):
+        value = np.asarray(value)
+        dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+        if not value.shape:
+            dataset[()] = value
+        else:
+            dataset[:] = value
+
+class KerasWeightsExport(object):
+    def __init__(self, model, snapshot_model=None):
+        """ `export` writer for `CheckpointManager.save`: the file `model.save_weights` would write, for
+        `model.load_weights`, from a `keras_snapshot` of `snapshot_model` (default `model`), which has to
+        hold every weight of `model`. Everything read from the models is read here, on the training
+        thread, so the file can be written off it.
+        """
+        import keras
+        import keras.backend as K
+
+        self.layout, self.n_model_weights = _keras_layout(model, model if snapshot_model is None else snapshot_model)
+        self.meta = {'backend': K.backend().encode('utf8'), 'keras_version': str(keras.__version__).encode('utf8')}
+
+    def write_weights(self, group, weights):
+        """ Same layout as Keras' `save_weights_to_hdf5_group` """
+        from keras.engine.saving import save_attributes_to_hdf5_group
+
+        save_attributes_to_hdf5_group(group, 'layer_names', [name.encode('utf8') for name, _, _ in self.layout])
+        group.attrs.update(self.meta)
+        for layer_name, names, positions in self.layout:
+            layer_group = group.create_group(layer_name)
+            save_attributes_to_hdf5_group(layer_group, 'weight_names', [n.encode('utf8') for n in names])
+            _write_datasets(layer_group, names, [weights[p] for p in positions])
+
+    def __call__(self, path:str, weights:list):
+        import h5py
+
+        tmp_path = path + '.tmp'
+        with h5py.File(tmp_path, mode='w') as f:
+            self.write(f, weights)
+            f.flush()
+        os.replace(tmp_path, path)
+
+    def write(self, f, weights):
+        self.write_weights(f, weights)
+
+class KerasModelExport(KerasWeightsExport):
+    def __init__(self, model, snapshot_model=None, optimizer=None):
+        """ `export` writer for `CheckpointManager.save`: the file `model.save` would write, for
+        `load_model`, from a `keras_snapshot` of `snapshot_model` (default `model`). Optimizer weights
+        are included when `optimizer` (the one the snapshot holds) is `model`'s own. The training
+        config, learning rate included, is read now - build one per save.
+        """
+        super(KerasModelExport, self).__init__(model, snapshot_model=snapshot_model)
+        self.model_config = json.dumps({'class_name': model.__class__.__name__, 'config': model.get_config()},
+                                       default=_json_default).encode('utf8')
+        self.training_config, self.optimizer_names = None, []
+        model_optimizer = getattr(model, 'optimizer', None)
+        if model_optimizer is not None:
+            self.training_config = json.dumps({
+                'optimizer_config': {'class_name': model_optimizer.__class__.__name__, 'config': model_optimizer.get_config()},
+                'loss': model.loss, 'metrics': model.metrics, 'sample_weight_mode': model.sample_weight_mode,
+                'loss_weights': model.loss_weights}, default=_json_default).encode('utf8')
+            if model_optimizer is optimizer:
+                self.optimizer_names = [str(w.name) if getattr(w, 'name', None) else 'param_{}'.format(i)
+                                        for i, w in enumerate(optimizer.weights)]
+
+    def write(self, f, weights):
+        """ Same layout as Keras' `save_model` """
+        from keras.engine.saving import save_attributes_to_hdf5_group
+
+        f.attrs.update(self.meta)
+        f.attrs['model_config'] = self.model_config
+        self.write_weights(f.create_group('model_weights'), weights)
+        if self.training_config is not None:
+            f.attrs['training_config'] = self.training_config
+        optimizer_weights = weights[self.n_model_weights:]
+        if self.optimizer_names and len(optimizer_weights) == len(self.optimizer_names):
+            group = f.create_group('optimizer_weights')
+            save_attributes_to_hdf5_group(group, 'weight_names', [n.encode('utf8') for n in self.optimizer_names])
+            _write_datasets(group, self.optimizer_names, optimizer_weights)
+
+class TFCheckpointExport(object):
+    def __init__(self, variables:list):
+        """ `export` writer for `CheckpointManager.save`: a `tf.train.Saver` checkpoint of `variables`
+        (readable by a default `Saver` over them) from a `session_snapshot` of them. Written from a
+        private graph and session, so the training session is never touched off its thread.
+        """
+        self.specs = [(v.op.name, v.dtype.base_dtype, v.get_shape()) for v in variables]
+        self.session = None
+
+    def _build(self):
+        import tensorflow as tf
+
+        graph = tf.Graph()
+        with graph.as_default():
+            self.variables = [tf.Variable(tf.zeros(shape, dtype=dtype), name=name.replace('/', '_'))
+                              for name, dtype, shape in self.specs]
+            self.saver = tf.train.Saver({name: v for (name, _, _), v in zip(self.specs, self.variables)})
+            self.session = tf.Session(graph=graph)
+
+    def __call__(self, path:str, values:list):
+        if self.session is None:
+            self._build()
+        for variable, value in zip(self.variables, values):
+            variable.load(value, self.session)
+        self.saver.save(self.session, path, write_meta_graph=False)
+
+def session_snapshot(sess, variables:list):
+    """ In-memory copy of TF variables (e.g. `tf.global_variables()`, optimizer slots included) """
+    return sess.run(variables)
+
+def restore_session(sess, variables:list, values:list):
+    import tensorflow as tf
+
+    placeholders = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape()) for v in variables]
+    sess.run([tf.assign(v, p) for v, p in zip(variables, placeholders)], feed_dict=dict(zip(placeholders, values)))
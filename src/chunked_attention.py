@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+
+def _dropout(probs, rate):
+    return probs if not rate else tf.nn.dropout(probs, rate=rate)
+
+def _attend(q, k, v, bias, scale, key_chunk_size=None, dropout=0.):
+    """ Attention for one chunk of queries against all keys
+
+    With `key_chunk_size` the keys are visited in chunks and the softmax is accumulated
+    with a running max and normalizer, so only (query chunk, key chunk) scores exist at once.
+    Dropout scales single probabilities, so it commutes with the final normalization and
+    each key chunk's unnormalized probabilities can be dropped as they are used.
+    """
+    if key_chunk_size is None:
+        logits = tf.matmul(q, k, transpose_b=True) * scale
+        if bias is not None:
+            logits += bias
+        return tf.matmul(_dropout(tf.nn.softmax(logits, axis=-1), dropout), v)
+
+    n_keys = tf.shape(k)[-2]
+    stats_shape = tf.concat([tf.shape(q)[:-1], [1]], axis=0)
+    running_max = tf.fill(stats_shape, tf.constant(-np.inf, dtype=q.dtype))
+    normalizer = tf.zeros(stats_shape, dtype=q.dtype)
+    acc = tf.zeros(tf.concat([tf.shape(q)[:-1], tf.shape(v)[-1:]], axis=0), dtype=q.dtype)
+
+    def body(start, running_max, normalizer, acc):
+        end = start + key_chunk_size
+        logits = tf.matmul(q, k[..., start:end, :], transpose_b=True) * scale
+        if bias is not None:
+            logits += bias[..., start:end]
+        new_max = tf.maximum(running_max, tf.reduce_max(logits, axis=-1, keepdims=True))
+        probs = tf.exp(logits - new_max)
+        correction = tf.exp(running_max - new_max)
+        normalizer = normalizer * correction + tf.reduce_sum(probs, axis=-1, keepdims=True)
+        acc = acc * correction + tf.matmul(_dropout(probs, dropout), v[..., start:end, :])
+        return end, new_max, normalizer, acc
+
+    _, _, normalizer, acc = tf.while_loop(lambda start, *_: start < n_keys, body,
+                                          [tf.constant(0), running_max, normalizer, acc])
+    return acc / normalizer
+
+def chunked_attention(q, k, v, bias=None, chunk_size=64, key_chunk_size=None, scale=None, dropout=0.):
+    """ Scaled dot-product attention computed one chunk of queries at a time
+
+    Chunks run sequentially, so the largest score tensor held at once is
+    (..., chunk_size, Lk) instead of (..., Lq, Lk) - or (..., chunk_size, key_chunk_size)
+    with a running softmax over key chunks. Outputs equal the unchunked computation up to
+    float rounding (and exactly for `key_chunk_size=None`, where every row still gets one
+    plain softmax). Backprop through the loop keeps each chunk's intermediates, so the
+    peak-memory saving applies to inference and evaluation.
+
+    Arguments:
+        q {tf.Tensor} -- Queries, (..., Lq, d)
+        k {tf.Tensor} -- Keys, (..., Lk, d)
+        v {tf.Tensor} -- Values, (..., Lk, dv)
+
+    Keyword Arguments:
+        bias {tf.Tensor} -- Additive logits bias (e.g. -1e9 at masked positions), broadcastable
+        to (..., Lq, Lk) with a full key axis and a query axis of Lq or 1 (default: {None})
+        chunk_size {int} -- Queries per chunk (default: {64})
+        key_chunk_size {int} -- Keys per running-softmax step, None for one step (default: {None})
+        scale {float} -- Logits scale, 1 / sqrt(d) if None (default: {None})
+        dropout {float} -- Dropout rate on the attention probabilities, applied chunk by chunk;
+        pass 0 outside training (default: {0.})
+
+    Returns:
+        tf.Tensor -- Attention output, (..., Lq, dv)
+    """
+    if scale is None:
+        scale = 1. / tf.sqrt(tf.cast(tf.shape(k)[-1], q.dtype))
+
+    rank = len(q.shape)
+    n_queries = tf.shape(q)[-2]
+    n_chunks = (n_queries + chunk_size - 1) // chunk_size
+    pad = n_chunks * chunk_size - n_queries
+
+    def to_chunks(x):
+        # (..., n_chunks * chunk_size, d) -> (n_chunks, ..., chunk_size, d)
+        x = tf.pad(x, [[0, 0]] * (rank - 2) + [[0, pad], [0, 0]])
+        s = tf.shape(x)
+        x = tf.reshape(x, tf.concat([s[:-2], [n_chunks, chunk_size], s[-1:]], axis=0))
+        return tf.transpose(x, [rank - 2] + list(range(rank - 2)) + [rank - 1, rank])
+
+    # A bias with a size-1 query axis (padding masks) broadcasts over every chunk as-is
+    chunk_bias = bias is not None and tf.compat.dimension_value(bias.shape[-2]) != 1
+    elems = (to_chunks(q), to_chunks(bias)) if chunk_bias else (to_chunks(q),)
+
+    def attend_chunk(x):
+        return _attend(x[0], k, v, x[1] if chunk_bias else bias, scale, key_chunk_size=key_chunk_size, dropout=dropout)
+
+    # parallel_iterations=1 keeps one chunk's scores alive at a time
+    outputs = tf.map_fn(attend_chunk, elems, dtype=q.dtype, parallel_iterations=1)
+
+    # (n_chunks, ..., chunk_size, dv) -> (..., Lq, dv)
+    outputs = tf.transpose(outputs, list(range(1, rank - 1)) + [0, rank - 1, rank])
+    s = tf.shape(outputs)
+    outputs = tf.reshape(outputs, tf.concat([s[:-3], [n_chunks * chunk_size], s[-1:]], axis=0))
+    return outputs[..., :n_queries, :]
+
+def local_attention(q, k, v, key_bias=None, window=64, n_global=1, scale=None, causal=False, dropout=0.):
+    """ Sliding-window self-attention: position i attends to positions (i - window, i + window)
+    plus the first `n_global` positions (e.g. `<s>` or summary tokens). With `causal` the
+    window is (i - window, i] and global positions after i are hidden too.
+
+    Queries are split into blocks of `window`, and each block only scores its own and the
+    neighbouring key blocks (the previous one, and the next one unless causal, masked down to
+    the window) plus the global keys, so cost grows as O(L * (3 * window + n_global)) instead
+    of O(L^2).
+
+    Arguments:
+        q {tf.Tensor} -- Queries, (..., L, d)
+        k {tf.Tensor} -- Keys, (..., L, d)
+        v {tf.Tensor} -- Values, (..., L, dv)
+
+    Keyword Arguments:
+        key_bias {tf.Tensor} -- Additive per-key bias (e.g. -1e9 at padding), broadcastable
+        to (..., L) (default: {None})
+        window {int} -- Number of positions on each side each query attends to (default: {64})
+        n_global {int} -- Number of leading positions every query attends to, at most the sequence
+        length (default: {1})
+        scale {float} -- Logits scale, 1 / sqrt(d) if None (default: {None})
+        causal {bool} -- Hide every later position, for decoder self-attention (default: {False})
+        dropout {float} -- Dropout rate on the attention probabilities, pass 0 outside training (default: {0.})
+
+    Returns:
+        tf.Tensor -- Attention output, (..., L, dv)
+    """
+    if scale is None:
+        scale = 1. / tf.sqrt(tf.cast(tf.shape(k)[-1], q.dtype))
+
+    rank = len(q.shape)
+    length = tf.shape(q)[-2]
+    # Sequences shorter than n_global would otherwise get fewer global keys than the split below assumes
+    n_global = tf.minimum(n_global, length)
+    n_blocks = (length + window - 1) // window
+    pad = n_blocks * window - length
+
+    def to_blocks(x, has_depth=True):
+        # (..., L[, d]) -> (..., n_blocks, window[, d])
+        tail = 1 if has_depth else 0
+        x = tf.pad(x, [[0, 0]] * (len(x.shape) - 1 - tail) + [[0, pad]] + [[0, 0]] * tail)
+        s = tf.shape(x)
+        split = tf.shape(s)[0] - 1 - tail
+        return tf.reshape(x, tf.concat([s[:split], [n_blocks, window], s[split + 1:]], axis=0))
+
+    def with_neighbours(x, axis):
+        # Keys of block b are blocks b - 1, b (and b + 1 unless causal); out-of-range blocks are zeros
+        zeros = tf.zeros_like(tf.gather(x, [0], axis=axis))
+        blocks = [tf.concat([zeros, tf.gather(x, tf.range(n_blocks - 1), axis=axis)], axis=axis), x]
+        if not causal:
+            blocks.append(tf.concat([tf.gather(x, tf.range(1, n_blocks), axis=axis), zeros], axis=axis))
+        return tf.concat(blocks, axis=axis + 1)
+
+    n_context = 2 if causal else 3
+    q_blocks = to_blocks(q)
+    k_local, v_local = with_neighbours(to_blocks(k), rank - 2), with_neighbours(to_blocks(v), rank - 2)
+
+    # Query i = b * window + r, local key j = (b - 1) * window + c, i - j = r + window - c
+    r = tf.range(window)[:, None]
+    c = tf.range(n_context * window)[None, :]
+    offset = r + window - c
+    j = (tf.range(n_blocks)[:, None, None] - 1) * window + c[None]
+    in_window = tf.logical_and(offset >= 0, offset < window) if causal else tf.abs(offset) < window
+    # Global keys come in separately, drop them here so they aren't counted twice
+    allowed = tf.logical_and(tf.logical_and(in_window[None], j >= n_global), j < length)
+    local_bias = (1. - tf.cast(allowed, q.dtype)) * -1e9
+    if key_bias is not None:
+        key_bias = tf.broadcast_to(key_bias, tf.shape(q)[:-1])
+        local_bias += with_neighbours(to_blocks(key_bias, has_depth=False), rank - 2)[..., None, :]
+
+    local_logits = tf.matmul(q_blocks, k_local, transpose_b=True) * scale + local_bias
+
+    # Every block scores the same global keys
+    k_global, v_global = k[..., None, :n_global, :], v[..., None, :n_global, :]
+    global_logits = tf.matmul(q_blocks, k_global, transpose_b=True) * scale
+    if key_bias is not None:
+        global_logits += key_bias[..., None, None, :n_global]
+    if causal:
+        # Global key g is only visible from query g onwards
+        i = tf.range(n_blocks)[:, None, None] * window + r[None]
+        global_logits += (1. - tf.cast(tf.range(n_global)[None, None, :] <= i, q.dtype)) * -1e9
+
+    probs = _dropout(tf.nn.softmax(tf.concat([global_logits, local_logits], axis=-1), axis=-1), dropout)
+    outputs = tf.matmul(probs[..., :n_global], v_global) + tf.matmul(probs[..., n_global:], v_local)
+
+    s = tf.shape(outputs)
+    outputs = tf.reshape(outputs, tf.concat([s[:-3], [n_blocks * window], s[-1:]], axis=0))
+    return outputs[..., :length, :]
+
+def _peak_bytes(sess):
+    if tf.test.is_gpu_available():
+        return int(sess.run(tf.contrib.memory_stats.MaxBytesInUse()))
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _measure(batch_size, n_head, seq_len, depth, chunk_size, key_chunk_size):
+    """ Peak memory of one attention call, run in a fresh process by `profile_memory` """
+    q_np = np.random.normal(size=(batch_size, n_head, seq_len, depth)).astype('float32')
+    lengths = np.random.randint(1, seq_len + 1, size=batch_size)
+    mask_np = (np.arange(seq_len)[None, :] >= lengths[:, None]).astype('float32')[:, None, None, :]
+
+    q = tf.constant(q_np)
+    bias = tf.constant(mask_np) * -1e9
+    if chunk_size is None:
+        logits = tf.matmul(q, q, transpose_b=True) / np.sqrt(depth) + bias
+        output = tf.matmul(tf.nn.softmax(logits, axis=-1), q)
+    else:
+        output = chunked_attention(q, q, q, bias=bias, chunk_size=chunk_size, key_chunk_size=key_chunk_size)
+
+    with tf.Session() as sess:
+        result = sess.run(tf.reduce_sum(output))
+        peak = _peak_bytes(sess)
+    return {'chunk_size': chunk_size, 'key_chunk_size': key_chunk_size, 'peak_mb': peak / 1e6, 'checksum': float(result)}
+
+def profile_memory(batch_size=512, n_head=4, seq_len=300, depth=64, configs=((None, None), (64, None), (32, None), (64, 64))):
+    """ Peak memory of full against chunked attention at encoder length `seq_len`
+
+    Every configuration runs in its own interpreter so peaks don't carry over.
+    Also prints the size of the largest score tensor each configuration materializes.
+    """
+    results = []
+    for chunk_size, key_chunk_size in configs:
+        cmd = [sys.executable, os.path.abspath(__file__), '--measure', json.dumps([chunk_size, key_chunk_size]),
+               '--batch_size', str(batch_size), '--n_head', str(n_head), '--seq_len', str(seq_len), '--depth', str(depth)]
+        output = subprocess.check_output(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+
+    print('\nATTENTION MEMORY PROFILE (batch {}, {} heads, length {})'.format(batch_size, n_head, seq_len))
+    print('=' * 50)
+    for r in results:
+        rows = seq_len if r['chunk_size'] is None else r['chunk_size']
+        cols = seq_len if r['key_chunk_size'] is None else r['key_chunk_size']
+        print('chunk {:>5} x {:>5} | scores: {:8.1f} MB | peak: {:8.1f} MB | checksum: {:.4f}'.format(
+            str(r['chunk_size']), str(r['key_chunk_size']), batch_size * n_head * rows * cols * 4 / 1e6,
+            r['peak_mb'], r['checksum']))
+    return results
+
+def benchmark_window(history_lens=(128, 256, 512, 1024, 2048), window=64, n_global=1, batch_size=32, n_head=4,
+                     depth=64, n_runs=10):
+    """ Latency of full against sliding-window self-attention as the dialog history grows """
+    import time
+
+    q = tf.placeholder(tf.float32, shape=[None, n_head, None, depth])
+    key_pad = tf.placeholder(tf.float32, shape=[None, 1, None])
+    full_logits = tf.matmul(q, q, transpose_b=True) / np.sqrt(depth) + key_pad[:, :, None, :] * -1e9
+    outputs = {'full': tf.matmul(tf.nn.softmax(full_logits, axis=-1), q),
+               'window': local_attention(q, q, q, key_bias=key_pad * -1e9, window=window, n_global=n_global)}
+
+    report = []
+    with tf.Session() as sess:
+        for length in history_lens:
+            feed = {q: np.random.normal(size=(batch_size, n_head, length, depth)).astype('float32'),
+                    key_pad: np.zeros((batch_size, 1, length), dtype='float32')}
+            result = {'history_len': length}
+            for name, output in outputs.items():
+                sess.run(output, feed_dict=feed)
+                start = time.time()
+                for _ in range(n_runs):
+                    sess.run(output, feed_dict=feed)
+                result['{}_ms'.format(name)] = 1000 * (time.time() - start) / n_runs
+            report.append(result)
+
+    print('\nWINDOWED ATTENTION LATENCY (window {}, {} global, batch {}, {} heads)'.format(window, n_global, batch_size, n_head))
+    print('=' * 50)
+    for r in report:
+        print('history {:5d} | full: {:8.2f} ms | window: {:8.2f} ms | speed-up: {:5.2f}x'.format(
+            r['history_len'], r['full_ms'], r['window_ms'], r['full_ms'] / r['window_ms']))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', type=str, required=False, default='0')
+    parser.add_argument('--batch_size', type=int, required=False, default=512)
+    parser.add_argument('--n_head', type=int, required=False, default=4)
+    parser.add_argument('--seq_len', type=int, required=False, default=300)
+    parser.add_argument('--depth', type=int, required=False, default=64)
+    parser.add_argument('--window', type=int, required=False, default=None, help='Benchmark sliding-window attention latency instead')
+    parser.add_argument('--n_global', type=int, required=False, default=1)
+    parser.add_argument('--measure', type=str, required=False, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+    if args.measure is not None:
+        np.random.seed(7)
+        chunk_size, key_chunk_size = json.loads(args.measure)
+        print(json.dumps(_measure(args.batch_size, args.n_head, args.seq_len, args.depth, chunk_size, key_chunk_size)))
+    elif args.window is not None:
+        benchmark_window(window=args.window, n_global=args.n_global, n_head=args.n_head, depth=args.depth)
+    else:
+        profile_memory(batch_size=args.batch_size, n_head=args.n_head, seq_len=args.seq_len, depth=args.depth)
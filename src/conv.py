@@ -12,6 +12,9 @@ from keras.preprocessing.text import Tokenizer
 from keras.preprocessing.sequence import pad_sequences
 from keras.optimizers import Adagrad, Adam, RMSprop, SGD
 
+from layer_utils import build_accumulation_model, targets_as_inputs
+from dataset_manifest import example_count
+
 
 class ConvSeq2Seq(RNNSeq2Seq):
     def __init__(self, args, vocab):
@@ -25,8 +28,8 @@ class ConvSeq2Seq(RNNSeq2Seq):
         self.num_decoder_layers = 10
         self.kernel_width = 5
         self.model_name = args.model_name
-        self.n_train_examples = args.n_train_examples
-        self.n_valid_examples = args.n_valid_examples
+        self.n_train_examples = example_count(args.train_file, args.n_train_examples)
+        self.n_valid_examples = example_count(args.valid_file, args.n_valid_examples)
         self.train_file = args.train_file
         self.valid_file = args.valid_file
         self.n_epochs = args.n_epochs
@@ -35,6 +38,7 @@ class ConvSeq2Seq(RNNSeq2Seq):
         self.inverse_vocab = {v: k for k, v in self.vocab.items()}
         self.vocab_size = len(self.vocab)
         self.num_sampled = 20000
+        self.grad_accum_steps = getattr(args, 'grad_accum_steps', 1)
         self.eval_thresh = 50000
 
         self._choose_optimizer()
@@ -120,6 +124,11 @@ class ConvSeq2Seq(RNNSeq2Seq):
         opt = Adagrad()
         self.model.compile(loss=self.sparse_loss, optimizer=opt, target_tensors=[self.decoder_target])
         self.model.summary()
+        if self.grad_accum_steps > 1:
+            self.train_model = build_accumulation_model(self.model, optimizer=opt, accum_steps=self.grad_accum_steps)
+            print('Accumulating gradients over {} batches of {}...'.format(self.grad_accum_steps, self.batch_size))
+        else:
+            self.train_model = self.model
 
         return
 
@@ -157,8 +166,13 @@ class ConvSeq2Seq(RNNSeq2Seq):
         for e in range(self.n_epochs):
             train_datagen = s2s_processor.generate_s2s_batches(mode='train')
             valid_datagen = s2s_processor.generate_s2s_batches(mode='valid')
-            hist = self.model.fit_generator(generator=train_datagen, steps_per_epoch=n_train_iters, validation_data=valid_datagen,
-                                validation_steps=n_valid_iters, epochs=1, shuffle=False, callbacks=[tboard])
+            if self.train_model is self.model:
+                hist = self.model.fit_generator(generator=train_datagen, steps_per_epoch=n_train_iters, validation_data=valid_datagen,
+                                    validation_steps=n_valid_iters, epochs=1, shuffle=False, callbacks=[tboard])
+            else:
+                self.train_model.fit_generator(generator=targets_as_inputs(train_datagen), steps_per_epoch=n_train_iters,
+                                               epochs=1, shuffle=False, callbacks=[tboard])
+                print('val_loss: {:.4f}'.format(self.model.evaluate_generator(valid_datagen, steps=n_valid_iters)))
 
             # Look at qualitative output
             print('Testing input sentences...')
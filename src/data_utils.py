@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 
+from line_index import LineIndex, iterate_lines
+
 
 def get_vocab(vocab_file, min_freq:int=3):
     special_toks = ['<UNK>', '<PAD>', '<s>', '</s>']
@@ -34,7 +36,8 @@ class BPEArgs:
 
 class S2SProcessing(object):
     def __init__(self, train_file, valid_file, vocab, encoder_max_len=300, decoder_max_len=100,
-                 batch_size=256, shuffle_batch=False, model_type='transformer'):
+                 batch_size=256, shuffle_batch=False, model_type='transformer', seed=None, shuffle_buffer=None,
+                 shuffle_block=256):
         self.train_file = train_file
         self.valid_file = valid_file
         self.vocab = vocab
@@ -44,6 +47,12 @@ class S2SProcessing(object):
         self.batch_size = batch_size
         self.shuffle_batch = shuffle_batch
         self.model_type = model_type
+        # Shuffle seed, saved with the iterator state so a resumed epoch shuffles the same way
+        self.seed = seed
+        # Training lines are shuffled `shuffle_buffer` at a time, read in blocks of `shuffle_block` lines
+        self.shuffle_buffer = (65536 if shuffle_batch else 0) if shuffle_buffer is None else shuffle_buffer
+        self.shuffle_block = shuffle_block
+        self.line_indexes = {}
 
     def get_tokid(self, word):
         if word in self.vocab.keys():
@@ -56,11 +65,28 @@ class S2SProcessing(object):
         orig_word = self.inv_vocab[int(tokid)]
         return orig_word
 
-    def get_line(self, data_file):
+    def line_index(self, mode='train'):
+        data_file = self.train_file if mode == 'train' else self.valid_file
+        if data_file not in self.line_indexes:
+            self.line_indexes[data_file] = LineIndex(data_file)
+        return self.line_indexes[data_file]
+
+    def iterator_state(self, mode='train', n_batches=0, epoch=0):
+        """ State of `generate_s2s_batches(mode, epoch=epoch)` after `n_batches` batches - save
+        it with a checkpoint and pass it back as `state` to seek straight to the next batch
+        """
+        return self.line_index(mode).batch_state(n_batches, self.batch_size, seed=self.seed, epoch=epoch)
+
+    def get_line(self, data_file, state=None, epoch=0):
         bos = '<s>'
         eos = '</s>'
-        with tf.gfile.GFile(data_file, 'r') as infile:
-            for line_ix, line in enumerate(infile):
+        # Only training data is shuffled, with a fresh permutation per epoch
+        shuffle = self.shuffle_buffer > 0 and data_file == self.train_file
+        with tf.gfile.GFile(data_file, 'rb') as infile:
+            lines = iterate_lines(infile, state=state, epoch=epoch, index=self.line_index('train') if shuffle else None,
+                                  shuffle_buffer=self.shuffle_buffer if shuffle else 0, shuffle_block=self.shuffle_block,
+                                  seed=self.seed)
+            for line_ix, line in lines:
                 line_split = line.strip().split('\t')
                 # if len(line_split) != 2:
                 #     print(line_ix)
@@ -118,14 +144,18 @@ class S2SProcessing(object):
 
         return encoder_batch, decoder_in_batch, decoder_out_batch
 
-    def generate_s2s_batches(self, mode='train'):
+    def generate_s2s_batches(self, mode='train', state=None, epoch=0):
+        """ Endless batches over the `mode` file, starting from an `iterator_state` when given.
+        Each pass over the file counts as an epoch for shuffling, starting at `epoch`.
+        """
         assert mode in {'train', 'valid'}, 'Supply a mode that is either `train` or `valid`!'
         data_file = self.train_file if mode == 'train' else self.valid_file
+        n_pass = epoch if state is None else state.get('pass', epoch)
 
         while True:
             encoder_batch, decoder_in_batch, decoder_out_batch  = [], [], []
             encoder_batch_lengths, decoder_batch_lengths = [], []
-            for encoder_toks, decoder_in_toks, decoder_out_toks in self.get_line(data_file=data_file):
+            for encoder_toks, decoder_in_toks, decoder_out_toks in self.get_line(data_file=data_file, state=state, epoch=n_pass):
                 # Build up batches
                 encoder_batch.append(encoder_toks)
                 decoder_in_batch.append(decoder_in_toks)
@@ -153,6 +183,9 @@ class S2SProcessing(object):
                     # Reset batch containers
                     encoder_batch, decoder_in_batch, decoder_out_batch  = [], [], []
                     encoder_batch_lengths, decoder_batch_lengths = [], []
+            # Later passes start from the top of the file
+            state = None
+            n_pass += 1
 
             if len(encoder_batch) > 0:
                 encoder_batch, decoder_in_batch, decoder_out_batch = self.s2s_padding(encoder_batch,
@@ -175,7 +208,8 @@ class S2SProcessing(object):
 
 class HanS2SProcessing(object):
     def __init__(self, train_file, valid_file, vocab, encoder_max_len=300, decoder_max_len=100,
-                 batch_size=256, shuffle_batch=False, model_type='transformer'):
+                 batch_size=256, shuffle_batch=False, model_type='transformer', seed=None, shuffle_buffer=None,
+                 shuffle_block=256):
         self.train_file = train_file
         self.valid_file = valid_file
         self.vocab = vocab
@@ -185,6 +219,12 @@ class HanS2SProcessing(object):
         self.batch_size = batch_size
         self.shuffle_batch = shuffle_batch
         self.model_type = model_type
+        # Shuffle seed, saved with the iterator state so a resumed epoch shuffles the same way
+        self.seed = seed
+        # Training lines are shuffled `shuffle_buffer` at a time, read in blocks of `shuffle_block` lines
+        self.shuffle_buffer = (65536 if shuffle_batch else 0) if shuffle_buffer is None else shuffle_buffer
+        self.shuffle_block = shuffle_block
+        self.line_indexes = {}
 
     def get_tokid(self, word):
         if word in self.vocab.keys():
@@ -197,11 +237,28 @@ class HanS2SProcessing(object):
         orig_word = self.inv_vocab[int(tokid)]
         return orig_word
 
-    def get_line(self, data_file):
+    def line_index(self, mode='train'):
+        data_file = self.train_file if mode == 'train' else self.valid_file
+        if data_file not in self.line_indexes:
+            self.line_indexes[data_file] = LineIndex(data_file)
+        return self.line_indexes[data_file]
+
+    def iterator_state(self, mode='train', n_batches=0, epoch=0):
+        """ State of `generate_s2s_batches(mode, epoch=epoch)` after `n_batches` batches - save
+        it with a checkpoint and pass it back as `state` to seek straight to the next batch
+        """
+        return self.line_index(mode).batch_state(n_batches, self.batch_size, seed=self.seed, epoch=epoch)
+
+    def get_line(self, data_file, state=None, epoch=0):
         bos = '<s>'
         eos = '</s>'
-        with tf.gfile.GFile(data_file, 'r') as infile:
-            for line_ix, line in enumerate(infile):
+        # Only training data is shuffled, with a fresh permutation per epoch
+        shuffle = self.shuffle_buffer > 0 and data_file == self.train_file
+        with tf.gfile.GFile(data_file, 'rb') as infile:
+            lines = iterate_lines(infile, state=state, epoch=epoch, index=self.line_index('train') if shuffle else None,
+                                  shuffle_buffer=self.shuffle_buffer if shuffle else 0, shuffle_block=self.shuffle_block,
+                                  seed=self.seed)
+            for line_ix, line in lines:
                 context_words, current_words, decoder_words = line.strip().split('\t')
                 # Train without special dialog-marking tags
                 context_words = context_words.replace('<SOD>', '')
@@ -243,8 +300,12 @@ class HanS2SProcessing(object):
                 # assert len(decoder_in_toks) == len(decoder_out_toks), "Mismatch in decoder tokens!"
                 yield context_toks, current_toks, decoder_in_toks, decoder_out_toks
 
+    def _batch_rng(self, n_batches):
+        # Seeded per batch, so shuffling a resumed epoch does not depend on the batches skipped
+        return None if self.seed is None else np.random.RandomState([self.seed, n_batches])
+
     def s2s_padding(self, context_batch, current_batch, decoder_in_batch, decoder_out_batch,
-                    context_batch_lengths, current_batch_lengths, decoder_batch_lengths):
+                    context_batch_lengths, current_batch_lengths, decoder_batch_lengths, rng=None):
         pad = self.vocab['<PAD>']
         max_context_length = max(context_batch_lengths)
         max_current_length = max(current_batch_lengths)
@@ -279,20 +340,26 @@ class HanS2SProcessing(object):
                                            np.asarray(context_batch), np.asarray(current_batch), np.asarray(decoder_in_batch), np.asarray(decoder_out_batch)
         
         if self.shuffle_batch:
-            shuffle_ix = np.random.choice(list(range(current_batch_pad.shape[0])), size=current_batch_pad.shape[0], replace=False)
+            rng = np.random if rng is None else rng
+            shuffle_ix = rng.choice(list(range(current_batch_pad.shape[0])), size=current_batch_pad.shape[0], replace=False)
             context_batch_pad, current_batch_pad, decoder_in_batch_pad, decoder_out_batch_pad = context_batch_pad[shuffle_ix], current_batch_pad[shuffle_ix], \
                                                                                                 decoder_in_batch_pad[shuffle_ix], decoder_out_batch_pad[shuffle_ix]
         
         return context_batch_pad, current_batch_pad, decoder_in_batch_pad, decoder_out_batch_pad
 
-    def generate_s2s_batches(self, mode='train'):
+    def generate_s2s_batches(self, mode='train', state=None, epoch=0):
+        """ Endless batches over the `mode` file, starting from an `iterator_state` when given.
+        Each pass over the file counts as an epoch for shuffling, starting at `epoch`.
+        """
         assert mode in {'train', 'valid'}, 'Supply a mode that is either `train` or `valid`!'
         data_file = self.train_file if mode == 'train' else self.valid_file
+        n_pass = epoch if state is None else state.get('pass', epoch)
 
+        n_batches = 0 if state is None else state['batch']
         while True:
             context_batch, current_batch, decoder_in_batch, decoder_out_batch  = [], [], [], []
             context_batch_lengths, current_batch_lengths, decoder_batch_lengths = [], [], []
-            for context_toks, current_toks, decoder_in_toks, decoder_out_toks in self.get_line(data_file=data_file):
+            for context_toks, current_toks, decoder_in_toks, decoder_out_toks in self.get_line(data_file=data_file, state=state, epoch=n_pass):
                 # Build up batches
                 context_batch.append(context_toks)
                 current_batch.append(current_toks)
@@ -309,8 +376,10 @@ class HanS2SProcessing(object):
                                                                                     decoder_out_batch,
                                                                                     context_batch_lengths=context_batch_lengths,
                                                                                     current_batch_lengths=current_batch_lengths,
-                                                                                    decoder_batch_lengths=decoder_batch_lengths)
-                    
+                                                                                    decoder_batch_lengths=decoder_batch_lengths,
+                                                                                    rng=self._batch_rng(n_batches))
+                    n_batches += 1
+
                     if self.model_type == 'hatt':
                         if context_batch_pad.shape[1] > current_batch_pad.shape[1]:
                             diff = context_batch_pad.shape[1] - current_batch_pad.shape[1]
@@ -328,6 +397,9 @@ class HanS2SProcessing(object):
                     # Reset batch containers
                     context_batch, current_batch, decoder_in_batch, decoder_out_batch  = [], [], [], []
                     context_batch_lengths, current_batch_lengths, decoder_batch_lengths = [], [], []
+            # Later passes start from the top of the file
+            state = None
+            n_pass += 1
 
             if len(current_batch_pad) > 0:
                 context_batch_pad, current_batch_pad, decoder_in_batch_pad, decoder_out_batch_pad = self.s2s_padding(context_batch,
@@ -336,8 +408,10 @@ class HanS2SProcessing(object):
                                                                                     decoder_out_batch,
                                                                                     context_batch_lengths=context_batch_lengths,
                                                                                     current_batch_lengths=current_batch_lengths,
-                                                                                    decoder_batch_lengths=decoder_batch_lengths)
-                
+                                                                                    decoder_batch_lengths=decoder_batch_lengths,
+                                                                                    rng=self._batch_rng(n_batches))
+                n_batches += 1
+
                 # print(np.asarray(encoder_batch).shape, np.asarray(decoder_in_batch).shape)
                 if self.model_type == 'hatt':
                     if context_batch_pad.shape[1] > current_batch_pad.shape[1]:
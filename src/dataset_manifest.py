@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+MAX_TRACKED_LENGTH = 1024
+
+def chunk_boundaries(data_file:str, chunk_size:int=1 << 26):
+    """ (start, end) byte ranges of roughly `chunk_size` bytes that each end on a line break """
+    file_size = os.path.getsize(data_file)
+    boundaries = [0]
+    with open(data_file, mode='rb') as infile:
+        while boundaries[-1] < file_size:
+            position = boundaries[-1] + chunk_size
+            if position >= file_size:
+                boundaries.append(file_size)
+                break
+            infile.seek(position)
+            infile.readline()
+            boundaries.append(min(infile.tell(), file_size))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def _scan_chunk(task):
+    """ Line count, per-field token-length counts and SHA-1 of one byte range """
+    data_file, start, end, histograms = task
+    with open(data_file, mode='rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+
+    n_lines = data.count(b'\n') + int(len(data) > 0 and not data.endswith(b'\n'))
+    field_lengths = []
+    if histograms:
+        for line in data.split(b'\n')[:n_lines]:
+            for i, field in enumerate(line.split(b'\t')):
+                if i == len(field_lengths):
+                    field_lengths.append(np.zeros(MAX_TRACKED_LENGTH + 1, dtype=np.int64))
+                # Anything longer lands in the last bin
+                field_lengths[i][min(len(field.split()), MAX_TRACKED_LENGTH)] += 1
+    return n_lines, field_lengths, hashlib.sha1(data).hexdigest()
+
+class DatasetManifest(object):
+    def __init__(self, data_file:str, n_lines:int, checksum:str, field_lengths:list, file_size:int, mtime:float,
+                 chunk_size:int):
+        """ Example count, token-length histograms and checksum of one line-per-example corpus,
+        stored next to it as `<data_file>.manifest.json` (see `build` and `load_or_build`)
+
+        Arguments:
+            data_file {str} -- Corpus path
+            n_lines {int} -- Number of lines (examples)
+            checksum {str} -- SHA-1 over the SHA-1's of the `chunk_size` chunks
+            field_lengths {list} -- Per tab-separated field, counts of lines by whitespace-token length
+        """
+        self.data_file = data_file
+        self.n_lines = n_lines
+        self.checksum = checksum
+        self.field_lengths = [np.asarray(h, dtype=np.int64) for h in field_lengths]
+        self.file_size = file_size
+        self.mtime = mtime
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def manifest_path(data_file:str):
+        return data_file + '.manifest.json'
+
+    @classmethod
+    def build(cls, data_file:str, n_workers:int=None, chunk_size:int=1 << 26, histograms:bool=True):
+        """ Scan the corpus in `chunk_size` binary chunks on `n_workers` processes (default: all
+        cores) and save the manifest
+
+        Keyword Arguments:
+            n_workers {int} -- Worker processes, 1 scans in this process (default: {None})
+            chunk_size {int} -- Bytes per chunk (default: {64MB})
+            histograms {bool} -- Also count token lengths, the slower part of the scan (default: {True})
+        """
+        start = time.time()
+        stat = os.stat(data_file)
+        tasks = [(data_file, s, e, histograms) for s, e in chunk_boundaries(data_file, chunk_size=chunk_size)]
+        n_workers = min(n_workers or multiprocessing.cpu_count(), max(len(tasks), 1))
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                results = pool.map(_scan_chunk, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_scan_chunk(task) for task in tasks]
+
+        n_lines = sum(r[0] for r in results)
+        field_lengths = []
+        for _, chunk_lengths, _ in results:
+            for i, h in enumerate(chunk_lengths):
+                if i == len(field_lengths):
+                    field_lengths.append(np.zeros_like(h))
+                field_lengths[i] += h
+        checksum = hashlib.sha1(''.join(r[2] for r in results).encode('utf-8')).hexdigest()
+
+        manifest = cls(data_file, n_lines, checksum, field_lengths, stat.st_size, stat.st_mtime, chunk_size)
+        manifest.save()
+        print('Manifest for {} ({} lines) built in {:.1f}s on {} processes'.format(data_file, n_lines, time.time() - start, n_workers))
+        return manifest
+
+    @classmethod
+    def load(cls, data_file:str):
+        with open(cls.manifest_path(data_file), mode='r') as infile:
+            m = json.load(infile)
+        return cls(data_file, m['n_lines'], m['checksum'], m['field_lengths'], m['file_size'], m['mtime'], m['chunk_size'])
+
+    @classmethod
+    def load_or_build(cls, data_file:str, verify:bool=False, **build_kwargs):
+        """ Stored manifest if it matches the corpus, otherwise a freshly built one. A match is
+        the same size and modification time, or with `verify` the same checksum.
+        """
+        if os.path.exists(cls.manifest_path(data_file)):
+            manifest = cls.load(data_file)
+            stat = os.stat(data_file)
+            if manifest.file_size == stat.st_size and (manifest.mtime == stat.st_mtime or verify):
+                if not verify or manifest.verify():
+                    return manifest
+        return cls.build(data_file, **build_kwargs)
+
+    def save(self):
+        manifest = {'data_file': os.path.basename(self.data_file), 'n_lines': self.n_lines, 'checksum': self.checksum,
+                    'file_size': self.file_size, 'mtime': self.mtime, 'chunk_size': self.chunk_size,
+                    'field_lengths': [h.tolist() for h in self.field_lengths]}
+        tmp_path = self.manifest_path(self.data_file) + '.tmp'
+        try:
+            with open(tmp_path, mode='w') as outfile:
+                json.dump(manifest, outfile)
+            os.replace(tmp_path, self.manifest_path(self.data_file))
+        except OSError:
+            # Read-only corpus directory, the manifest is rebuilt next time
+            print('Could not write manifest for {}'.format(self.data_file))
+
+    def verify(self):
+        """ Whether the corpus still has the stored checksum """
+        tasks = [(self.data_file, s, e, False) for s, e in chunk_boundaries(self.data_file, chunk_size=self.chunk_size)]
+        digests = ''.join(_scan_chunk(task)[2] for task in tasks)
+        return hashlib.sha1(digests.encode('utf-8')).hexdigest() == self.checksum
+
+    def steps_per_epoch(self, batch_size:int, num_workers:int=1, drop_remainder:bool=False):
+        """ Batches per epoch (per worker when sharded over `num_workers`) """
+        global_batch = batch_size * num_workers
+        if drop_remainder:
+            return self.n_lines // global_batch
+        return int(math.ceil(self.n_lines / float(global_batch)))
+
+    def length_percentile(self, field:int, q:float):
+        """ Token length of field `field` below which `q` percent of lines fall """
+        cdf = np.cumsum(self.field_lengths[field])
+        return int(np.searchsorted(cdf, cdf[-1] * q / 100.))
+
+    def report(self):
+        print('\nDATASET MANIFEST: {}'.format(self.data_file))
+        print('=' * 50)
+        print('lines: {} | bytes: {} | checksum: {}'.format(self.n_lines, self.file_size, self.checksum))
+        for i, h in enumerate(self.field_lengths):
+            n = max(h.sum(), 1)
+            mean = float(np.dot(np.arange(len(h)), h)) / n
+            print('field {} tokens | mean: {:6.1f} | p50: {:4d} | p95: {:4d} | p99: {:4d} | max: {:4d}'.format(
+                i, mean, self.length_percentile(i, 50), self.length_percentile(i, 95), self.length_percentile(i, 99),
+                int(np.flatnonzero(h).max()) if h.any() else 0))
+
+def example_count(data_file:str, n_examples:int=None):
+    """ `n_examples` when given, otherwise the line count from the corpus manifest """
+    if n_examples is not None:
+        return n_examples
+    return DatasetManifest.load_or_build(data_file).n_lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_files', type=str, nargs='+')
+    parser.add_argument('--n_workers', type=int, required=False, default=None)
+    parser.add_argument('--chunk_size', type=int, required=False, default=1 << 26)
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild even if a matching manifest exists')
+    parser.add_argument('--verify', action='store_true', help='Check stored manifests against the corpus checksum')
+    args = parser.parse_args()
+
+    for data_file in args.data_files:
+        if args.rebuild:
+            manifest = DatasetManifest.build(data_file, n_workers=args.n_workers, chunk_size=args.chunk_size)
+        else:
+            manifest = DatasetManifest.load_or_build(data_file, verify=args.verify, n_workers=args.n_workers,
+                                                     chunk_size=args.chunk_size)
+        manifest.report()
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from fast_startup import import_keras_deps, tokenizer_from_bytes, tokenizer_to_bytes
+from inference_models import DialogModel, load_gpt_tokenizer, sparse_loss, perplexity
+
+# data_utils.py is imported from the training code one directory up, only when a vocab is bundled
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+BUNDLE_FORMAT_VERSION = 1
+
+
+def _to_bytes_array(payload:bytes):
+    return np.frombuffer(payload, dtype=np.uint8)
+
+def _load_vocab(vocab_file:str, min_freq:int):
+    from data_utils import get_vocab
+    return get_vocab(vocab_file, min_freq=min_freq)
+
+def export_bundle(model_path:str, output_path:str, tokenizer, vocab_file:str=None, min_vocab_freq:int=3):
+    """ Write everything needed to serve a model into one file
+
+    The bundle is an `.npz` archive holding:
+        * `graph_def` -- frozen inference graph (variables folded into constants,
+          learning phase fixed to inference), decode-step signature
+          `logits = f(encoder_ids, decoder_ids)`
+        * `tokenizer` -- serialised tokenizer, see `fast_startup.tokenizer_to_bytes`
+        * `vocab_words` / `vocab_ids` -- optional word-level vocab parsed from a TSV
+        * `metadata` -- JSON with the input/output tensor names
+
+    Arguments:
+        model_path {str} -- Path to `.h5` model saved with `sparse_loss`/`perplexity`
+        output_path {str} -- Where to write the bundle
+        tokenizer -- Tokenizer to embed (e.g. from `load_gpt_tokenizer`)
+
+    Keyword Arguments:
+        vocab_file {str} -- Optional vocab TSV, parsed with `data_utils.get_vocab` (default: {None})
+        min_vocab_freq {int} -- Minimum count for vocab entries (default: {3})
+    """
+    deps = import_keras_deps()
+    tf, K = deps['tf'], deps['K']
+
+    # Freeze Dropout etc. in inference mode before the graph is built
+    K.set_learning_phase(0)
+    model = deps['load_model'](model_path, custom_objects={'tf': tf, 'sparse_loss': sparse_loss, 'perplexity': perplexity})
+
+    sess = K.get_session()
+    output_nodes = [t.op.name for t in model.outputs]
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+        sess=sess, input_graph_def=sess.graph.as_graph_def(), output_node_names=output_nodes)
+
+    metadata = {'format_version': BUNDLE_FORMAT_VERSION,
+                'source_model': os.path.basename(model_path),
+                'signature': {'inputs': [t.name for t in model.inputs],
+                              'outputs': [t.name for t in model.outputs]}}
+    arrays = {'graph_def': _to_bytes_array(frozen_graph_def.SerializeToString()),
+              'tokenizer': _to_bytes_array(tokenizer_to_bytes(tokenizer))}
+
+    if vocab_file is not None:
+        vocab = _load_vocab(vocab_file, min_freq=min_vocab_freq)
+        words = sorted(vocab.keys(), key=lambda w: vocab[w])
+        arrays['vocab_words'] = np.asarray(words)
+        arrays['vocab_ids'] = np.asarray([vocab[w] for w in words], dtype=np.int32)
+
+    arrays['metadata'] = _to_bytes_array(json.dumps(metadata).encode('utf-8'))
+    with open(output_path, mode='wb') as outfile:
+        np.savez(outfile, **arrays)
+
+    print('{} ops in frozen graph'.format(len(frozen_graph_def.node)))
+    print('Bundle written to {} ({:.1f} MB)'.format(output_path, os.path.getsize(output_path) / 1e6))
+    return metadata
+
+class FrozenGraphModel(object):
+    def __init__(self, graph_def_bytes:bytes, input_names:list, output_names:list):
+        """ Minimal stand-in for a Keras model backed by a frozen GraphDef - exposes the
+        `predict_on_batch` interface the decoding methods in `DialogModel` rely on
+        """
+        import tensorflow as tf
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(graph_def_bytes)
+            tf.import_graph_def(graph_def, name='')
+        self.inputs = [self.graph.get_tensor_by_name(n) for n in input_names]
+        self.outputs = [self.graph.get_tensor_by_name(n) for n in output_names]
+        self.sess = tf.Session(graph=self.graph)
+
+    def _make_predict_function(self):
+        # Frozen graphs have nothing left to build
+        return
+
+    def predict_on_batch(self, x:list):
+        outputs = self.sess.run(self.outputs, feed_dict=dict(zip(self.inputs, x)))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+class BundledDialogModel(DialogModel):
+    def __init__(self, bundle_path:str, verbose:bool=False):
+        """ `DialogModel` loaded from a single bundle written by `export_bundle` -
+        no `.h5`, custom objects, tokenizer download or vocab TSV needed
+
+        Arguments:
+            bundle_path {str} -- Path to bundle file
+        """
+        with np.load(bundle_path, allow_pickle=False) as bundle:
+            self.metadata = json.loads(bundle['metadata'].tobytes().decode('utf-8'))
+            self._graph_def_bytes = bundle['graph_def'].tobytes()
+            tokenizer = tokenizer_from_bytes(bundle['tokenizer'].tobytes())
+            self.vocab = None
+            if 'vocab_words' in bundle.files:
+                self.vocab = dict(zip(bundle['vocab_words'].tolist(), bundle['vocab_ids'].tolist()))
+
+        super(BundledDialogModel, self).__init__(tokenizer=tokenizer, model_path=bundle_path, verbose=verbose)
+
+    def _load_model(self):
+        signature = self.metadata['signature']
+        model = FrozenGraphModel(self._graph_def_bytes, input_names=signature['inputs'],
+                                 output_names=signature['outputs'])
+        # Parsed graph now owns the weights
+        self._graph_def_bytes = None
+        return model
+
+def load_bundle(bundle_path:str):
+    """ Load a servable model from a bundle in one call """
+    return BundledDialogModel(bundle_path)
+
+def _measure_load(mode:str, model_path:str, bundle_path:str):
+    start = time.time()
+    if mode == 'bundle':
+        model_obj = load_bundle(bundle_path)
+    else:
+        model_obj = DialogModel(tokenizer=load_gpt_tokenizer(), model_path=model_path, verbose=False)
+    model_obj.warm_up()
+    load_secs = time.time() - start
+    # ru_maxrss is reported in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return {'mode': mode, 'load_secs': load_secs, 'peak_rss_mb': peak_rss_mb}
+
+def compare_load_paths(model_path:str, bundle_path:str):
+    """ Measure load time and peak memory of the `.h5` + tokenizer path against the
+    bundle path, each in a fresh interpreter so neither benefits from the other's imports
+    """
+    results = []
+    for mode in ['current', 'bundle']:
+        cmd = [sys.executable, os.path.abspath(__file__), '--measure', mode,
+               '--model_path', model_path, '--bundle_path', bundle_path]
+        output = subprocess.check_output(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+
+    print('\nLOAD COMPARISON')
+    print('=' * 50)
+    for r in results:
+        print('{:<10} load: {:8.3f}s | peak RSS: {:8.1f} MB'.format(r['mode'], r['load_secs'], r['peak_rss_mb']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=False, default='')
+    parser.add_argument('--bundle_path', type=str, required=False, default='dialog_model.bundle.npz')
+    parser.add_argument('--tokenizer_artifact', type=str, required=False, default=None)
+    parser.add_argument('--vocab_file', type=str, required=False, default=None)
+    parser.add_argument('--min_vocab_freq', type=int, required=False, default=3)
+    parser.add_argument('--compare', action='store_true', help='Compare load time/memory against the .h5 path')
+    parser.add_argument('--measure', type=str, required=False, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    if args.measure is not None:
+        print(json.dumps(_measure_load(args.measure, args.model_path, args.bundle_path)))
+    elif args.compare:
+        compare_load_paths(args.model_path, args.bundle_path)
+    else:
+        tok = load_gpt_tokenizer(artifact_path=args.tokenizer_artifact)
+        export_bundle(args.model_path, args.bundle_path, tokenizer=tok,
+                      vocab_file=args.vocab_file, min_vocab_freq=args.min_vocab_freq)
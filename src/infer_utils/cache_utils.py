@@ -0,0 +1,125 @@
+import time
+
+from collections import OrderedDict
+from itertools import chain
+
+import numpy as np
+
+
+class PersonaCache(object):
+    def __init__(self, max_size:int=32):
+        """ LRU cache of encoded personas shared across conversations
+
+        Keyword Arguments:
+            max_size {int} -- Maximum number of distinct personas to keep around (default: {32})
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, personality:list):
+        return tuple(p.strip() for p in personality)
+
+    def get(self, personality:list, tokenizer, bos_id:int):
+        """ Look up (or encode and store) a persona
+
+        Arguments:
+            personality {list} -- List of persona strings
+            tokenizer -- Tokenizer exposing an `encode` method
+            bos_id {int} -- Word ID of the <bos> token that starts every model input
+
+        Returns:
+            dict -- Entry with `persona_ids` (one list of word ID's per persona string)
+            and `prefix_ids` (the <bos> + persona segment fed to the model)
+        """
+        key = self._key(personality)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        persona_ids = [tokenizer.encode(p) for p in personality]
+        entry = {'persona_ids': persona_ids,
+                 'prefix_ids': [bos_id] + list(chain(*persona_ids))}
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SessionStore(object):
+    def __init__(self, max_history:int=2, idle_timeout:float=1800., max_sessions:int=10000):
+        """ Per-conversation dialog history, keyed by session ID
+
+        Each session keeps its utterances as compact int32 arrays and only the last
+        `2 * max_history + 1` of them, so the model input never grows past a fixed
+        window no matter how long the conversation runs.
+
+        Keyword Arguments:
+            max_history {int} -- Number of previous exchanges kept per session (default: {2})
+            idle_timeout {float} -- Seconds of inactivity after which a session is dropped (default: {1800.})
+            max_sessions {int} -- Hard cap on live sessions, least-recently-used are dropped first (default: {10000})
+        """
+        self.max_history = max_history
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        # Ordered by last access so idle sessions are always at the front
+        self.sessions = OrderedDict()
+
+    def _touch(self, session_id, now=None):
+        now = time.time() if now is None else now
+        if session_id not in self.sessions:
+            self.sessions[session_id] = {'history': [], 'last_access': now}
+        session = self.sessions[session_id]
+        session['last_access'] = now
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def append(self, session_id, token_ids:list):
+        """ Add an utterance to a session and trim it to the history window """
+        session = self._touch(session_id)
+        session['history'].append(np.asarray(token_ids, dtype=np.int32))
+        session['history'] = session['history'][-(2 * self.max_history + 1):]
+        self.evict_idle()
+
+    def history(self, session_id):
+        """ Session history as lists of word ID's, ready for `_build_input_from_segments` """
+        session = self._touch(session_id)
+        return [utt.tolist() for utt in session['history']]
+
+    def evict_idle(self, now=None):
+        """ Drop sessions idle past `idle_timeout` and enforce `max_sessions`
+
+        Returns:
+            int -- Number of sessions evicted
+        """
+        now = time.time() if now is None else now
+        n_evicted = 0
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            idle = (now - session['last_access']) > self.idle_timeout
+            if not idle and len(self.sessions) <= self.max_sessions:
+                break
+            self.sessions.popitem(last=False)
+            n_evicted += 1
+
+        return n_evicted
+
+    def end(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,195 @@
+import argparse
+import os
+import pickle
+import sys
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Attributes of OpenAIGPTTokenizer that hold spacy/ftfy handles - these are rebuilt on load
+# rather than pickled, since they're both slow to load and not reliably serialisable
+_TOKENIZER_RUNTIME_ATTRS = ('nlp', 'fix_text')
+_KERAS_DEPS = None
+
+
+def import_keras_deps():
+    """ Import tensorflow, keras and keras_transformer the first time they're needed
+
+    keras_transformer registers its layers (LayerNormalization, MultiHeadAttention, ...)
+    as Keras custom objects on import, so it has to be imported before `load_model`.
+
+    Returns:
+        dict -- Handles to `tf`, `K`, and `load_model`
+    """
+    global _KERAS_DEPS
+    if _KERAS_DEPS is None:
+        import tensorflow as tf
+        import keras.backend as K
+        from keras.models import load_model
+
+        import keras_transformer.transformer
+        import keras_transformer.attention
+        import keras_transformer.extras
+        import keras_transformer.position
+
+        _KERAS_DEPS = {'tf': tf, 'K': K, 'load_model': load_model}
+
+    return _KERAS_DEPS
+
+def pad_batch(sequences:list, value:int=0, dtype='int32'):
+    """ Post-pad a list of word ID sequences into a matrix (numpy-only stand-in for
+    keras' `pad_sequences`, so decoding doesn't need keras imported)
+    """
+    max_len = max(len(s) for s in sequences)
+    padded = np.full((len(sequences), max_len), value, dtype=dtype)
+    for i, s in enumerate(sequences):
+        padded[i, :len(s)] = s
+    return padded
+
+def tokenizer_to_bytes(tokenizer):
+    """ Serialise a tokenizer (vocab, BPE merges, special tokens) to bytes
+
+    Arguments:
+        tokenizer -- Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer
+    """
+    state = {k: v for k, v in tokenizer.__dict__.items() if k not in _TOKENIZER_RUNTIME_ATTRS}
+    # OpenAIGPTTokenizer uses spacy + ftfy when both are installed and BasicTokenizer otherwise,
+    # and the two split words differently - record which one this tokenizer was built with
+    front_end = 'basic' if getattr(tokenizer, 'fix_text', None) is None else 'spacy'
+    artifact = {'class_module': type(tokenizer).__module__, 'class_name': type(tokenizer).__name__, 'state': state,
+                'front_end': front_end}
+    return pickle.dumps(artifact, protocol=pickle.HIGHEST_PROTOCOL)
+
+def tokenizer_from_bytes(payload:bytes):
+    """ Rebuild a tokenizer from `tokenizer_to_bytes` without touching the network
+
+    The word-splitting front-end the tokenizer was saved with is rebuilt: spacy + ftfy, or
+    BERT's BasicTokenizer (what OpenAIGPTTokenizer falls back to without them).
+
+    Raises:
+        ImportError -- The artifact was saved with spacy + ftfy and they aren't installed
+        ValueError -- The artifact predates the front-end being recorded
+
+    Returns:
+        Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer tokenizer
+    """
+    import importlib
+
+    artifact = pickle.loads(payload)
+    if 'front_end' not in artifact:
+        raise ValueError('Tokenizer artifact does not record its word-splitting front-end, rebuild it with --build_artifact')
+    tok_class = getattr(importlib.import_module(artifact['class_module']), artifact['class_name'])
+    tok = tok_class.__new__(tok_class)
+    tok.__dict__.update(artifact['state'])
+
+    if artifact['front_end'] == 'spacy':
+        try:
+            import ftfy
+            from spacy.lang.en import English
+        except ImportError as e:
+            raise ImportError('Tokenizer artifact was saved with the spacy + ftfy front-end, which needs both '
+                              'installed to split words the same way ({})'.format(e))
+        nlp = English()
+        tok.nlp = nlp.Defaults.create_tokenizer(nlp)
+        tok.fix_text = ftfy.fix_text
+    else:
+        from pytorch_pretrained_bert.tokenization import BasicTokenizer
+        tok.nlp = BasicTokenizer(do_lower_case=True, never_split=list(tok.special_tokens.keys()))
+        tok.fix_text = None
+
+    return tok
+
+def save_tokenizer_artifact(tokenizer, artifact_path:str):
+    """ Write a tokenizer to a single local file, see `tokenizer_to_bytes` """
+    with open(artifact_path, mode='wb') as outfile:
+        outfile.write(tokenizer_to_bytes(tokenizer))
+    print('Tokenizer artifact saved to {}'.format(artifact_path))
+
+def load_tokenizer_artifact(artifact_path:str):
+    """ Load a tokenizer written by `save_tokenizer_artifact`, see `tokenizer_from_bytes` """
+    with open(artifact_path, mode='rb') as infile:
+        return tokenizer_from_bytes(infile.read())
+
+class StartupProfiler(object):
+    def __init__(self):
+        """ Wall-clock timer for named startup phases """
+        self.phases = OrderedDict()
+
+    def phase(self, name:str):
+        profiler = self
+
+        class _Phase(object):
+            def __enter__(self):
+                self.start = time.time()
+
+            def __exit__(self, *exc):
+                profiler.phases[name] = profiler.phases.get(name, 0.) + (time.time() - self.start)
+
+        return _Phase()
+
+    def report(self, title:str='STARTUP PROFILE'):
+        total = sum(self.phases.values())
+        print('\n{}'.format(title))
+        print('=' * 50)
+        for name, secs in self.phases.items():
+            print('{:<30} {:8.3f}s  ({:5.1f}%)'.format(name, secs, 100. * secs / max(total, 1e-9)))
+        print('{:<30} {:8.3f}s'.format('total', total))
+        return dict(self.phases, total=total)
+
+def profile_startup(model_path:str, tokenizer_artifact:str=None, model_class:str='DialogModel'):
+    """ Time every phase of bringing up an inference model, from the first import
+    to the first response being ready
+
+    Arguments:
+        model_path {str} -- Path to saved Keras model
+
+    Keyword Arguments:
+        tokenizer_artifact {str} -- Local artifact from `save_tokenizer_artifact`, if None
+        the tokenizer is loaded with `from_pretrained` as before (default: {None})
+        model_class {str} -- `DialogModel` (inference_models.py) or `InferenceModel` (inference_model.py)
+    """
+    profiler = StartupProfiler()
+
+    with profiler.phase('import inference module'):
+        if model_class == 'DialogModel':
+            from inference_models import DialogModel as model_cls, load_gpt_tokenizer
+        else:
+            from inference_model import InferenceModel as model_cls, load_gpt_tokenizer
+
+    with profiler.phase('load tokenizer'):
+        tok = load_gpt_tokenizer(artifact_path=tokenizer_artifact)
+
+    with profiler.phase('import keras/tensorflow'):
+        import_keras_deps()
+
+    with profiler.phase('load model'):
+        model_obj = model_cls(tokenizer=tok, model_path=model_path, verbose=False)
+
+    with profiler.phase('warm up predict function'):
+        model_obj.warm_up()
+
+    with profiler.phase('first request'):
+        model_obj.greedy_decode('hey , how are you doing ?')
+
+    return profiler.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=False, default='')
+    parser.add_argument('--model_class', type=str, required=False, default='DialogModel')
+    parser.add_argument('--tokenizer_artifact', type=str, required=False, default='gpt_tokenizer.pkl')
+    parser.add_argument('--build_artifact', action='store_true', help='Download the GPT tokenizer once and save it locally')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    if args.build_artifact:
+        from inference_models import load_gpt_tokenizer
+        save_tokenizer_artifact(load_gpt_tokenizer(), args.tokenizer_artifact)
+        sys.exit(0)
+
+    artifact = args.tokenizer_artifact if os.path.exists(args.tokenizer_artifact) else None
+    profile_startup(model_path=args.model_path, tokenizer_artifact=artifact, model_class=args.model_class)
@@ -10,9 +10,13 @@ from itertools import chain
 from pytorch_pretrained_bert import cached_path
 from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
 
+from cache_utils import PersonaCache, SessionStore
+
 # GLOBALS
 PERSONACHAT_URL = "https://s3.amazonaws.com/datasets.huggingface.co/personachat/personachat_self_original.json"
 HF_FINETUNED_MODEL = "https://s3.amazonaws.com/models.huggingface.co/transfer-learning-chatbot/finetuned_chatbot_gpt.tar.gz"
+DEFAULT_PERSONALITY = ["i like playing football.", "i am from NYC."]
+DEFAULT_SESSION = 'default'
 
 def download_pretrained_model():
     """ Download and extract finetuned model from S3
@@ -31,13 +35,16 @@ def download_pretrained_model():
     return tempdir
 
 class HuggingFaceModel(object):
-    def __init__(self, decode_method:str):
+    def __init__(self, decode_method:str, persona_cache_size:int=32, session_idle_timeout:float=1800.):
         """ Inference wrapper class for getting predictions from model
         and decoding into text to be presented to end-user
 
         Arguments:
-            tokenizer -- Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer
-            model_path {str} -- Path to trained model
+            decode_method {str} -- Either `greedy` or `sample`
+
+        Keyword Arguments:
+            persona_cache_size {int} -- Number of encoded personas kept in the LRU cache (default: {32})
+            session_idle_timeout {float} -- Seconds before an inactive conversation is evicted (default: {1800.})
         """
         
         self.no_sample = True if decode_method == 'greedy' else False
@@ -45,7 +52,8 @@ class HuggingFaceModel(object):
         self.max_len = 45
         self.device = "cpu"
         self.max_history = 2
-        self.history = []
+        self.sessions = SessionStore(max_history=self.max_history, idle_timeout=session_idle_timeout)
+        self.persona_cache = PersonaCache(max_size=persona_cache_size)
         self._load_model()
 
     def _load_model(self):
@@ -75,7 +83,20 @@ class HuggingFaceModel(object):
         personality_encoded = [self.tokenizer.encode(p) for p in personality_list]
         return personality_encoded
 
-    def _build_input_from_segments(self, persona, history, reply, lm_labels=False, with_eos=True):
+    def _get_persona(self, personality_list:list):
+        """ Cached version of `_encode_personality` - personas are shared across
+        conversations, so each distinct persona is only encoded once.
+
+        Arguments:
+            personality_list {list} -- List of strings encoding personality traits.
+
+        Returns:
+            dict -- Cache entry holding `persona_ids` and the model-ready `prefix_ids`
+        """
+        bos = self.tokenizer.convert_tokens_to_ids(self.SPECIAL_TOKENS[:1])[0]
+        return self.persona_cache.get(personality_list, self.tokenizer, bos_id=bos)
+
+    def _build_input_from_segments(self, persona, history, reply, lm_labels=False, with_eos=True, prefix_ids=None):
         """ Build a sequence of input from 3 segments: persona, history and last reply 
         
         Arguments:
@@ -86,6 +107,7 @@ class HuggingFaceModel(object):
         Keyword Arguments:
             lm_labels {bool} -- Switch indicating whether labels are present (for eval metrics) (default: {False})
             with_eos {bool} -- Switch indicating whether pre-processing should be aware of special <end-of-sentence> token (default: {True})
+            prefix_ids {list or None} -- Pre-built <bos> + persona segment from the persona cache (default: {None})
         
         Returns:
             [type] -- [description]
@@ -93,7 +115,8 @@ class HuggingFaceModel(object):
         bos, eos, speaker1, speaker2 = self.tokenizer.convert_tokens_to_ids(self.SPECIAL_TOKENS[:-1])
 
         instance = {}
-        sequence = [[bos] + list(chain(*persona))] + history + [reply + ([eos] if with_eos else [])]
+        prefix = prefix_ids if prefix_ids is not None else [bos] + list(chain(*persona))
+        sequence = [prefix] + history + [reply + ([eos] if with_eos else [])]
         sequence = [sequence[0]] + [[speaker2 if (len(sequence)-i) % 2 else speaker1] + s for i, s in enumerate(sequence[1:])]
 
         instance["input_ids"] = list(chain(*sequence))
@@ -155,7 +178,7 @@ class HuggingFaceModel(object):
 
         return logits
 
-    def sample_sequence(self, personality:list, history:list, current_output=None):
+    def sample_sequence(self, personality:list, history:list, current_output=None, prefix_ids=None):
         """ Loop through inputs and generated outputs to generate
         the next output token in a response sequence
         
@@ -165,6 +188,7 @@ class HuggingFaceModel(object):
         
         Keyword Arguments:
             current_output {list or None} -- [Potential list of current output to be considered in generating future output] (default: {None})
+            prefix_ids {list or None} -- [Cached <bos> + persona segment, skips re-building the persona prefix every step] (default: {None})
         
         Returns:
             current_output {list} -- [List containing output generated up to current timestep]
@@ -184,7 +208,8 @@ class HuggingFaceModel(object):
             current_output = []
 
         for i in range(max_length):
-            instance, sequence = self._build_input_from_segments(personality, history, current_output, self.tokenizer, with_eos=False)
+            instance, sequence = self._build_input_from_segments(personality, history, current_output, self.tokenizer, with_eos=False,
+                                                                 prefix_ids=prefix_ids)
             # print("instance from sample_sequence function:")
             # print(instance)
 
@@ -210,7 +235,7 @@ class HuggingFaceModel(object):
 
         return current_output
 
-    def get_response(self, input_seq:str, personality:list=[]):
+    def get_response(self, input_seq:str, personality:list=[], session_id=DEFAULT_SESSION):
         """ Wrapper method for taking in dialog input as a string, preprocessing, 
         feeding to model, and generating output from the model.
         
@@ -219,6 +244,7 @@ class HuggingFaceModel(object):
         
         Keyword Arguments:
             personality {list} -- [Personality tokens supplied in list (can be empty list)] (default: {[]})
+            session_id -- [ID of the conversation this input belongs to, each ID keeps its own bounded history] (default: {DEFAULT_SESSION})
         
         Returns:
             decoded_string {str} -- [Decoded string response from model]
@@ -230,19 +256,24 @@ class HuggingFaceModel(object):
         torch.cuda.manual_seed(7)
 
         if len(personality) == 0:
-            personality = ["i like playing football.", "i am from NYC."]
+            personality = DEFAULT_PERSONALITY
 
-        personality_encoded = self._encode_personality(personality)
+        persona = self._get_persona(personality)
 
-        self.history.append(self.tokenizer.encode(input_seq))
+        self.sessions.append(session_id, self.tokenizer.encode(input_seq))
 
         with torch.no_grad():
-            out_ids = self.sample_sequence(personality_encoded, self.history)
-        self.history.append(out_ids)
+            out_ids = self.sample_sequence(persona['persona_ids'], self.sessions.history(session_id),
+                                           prefix_ids=persona['prefix_ids'])
+        self.sessions.append(session_id, out_ids)
         decoded_string = self.tokenizer.decode(out_ids, skip_special_tokens=True)
 
         return decoded_string
 
+    def end_session(self, session_id):
+        """ Drop a finished conversation's history """
+        self.sessions.end(session_id)
+
     def run_interactive(self):
         """ Testing method to run model in "online" way to continually get user input in real-time
         and generate output in interactive session 
@@ -253,20 +284,19 @@ class HuggingFaceModel(object):
         torch.random.manual_seed(7)
         torch.cuda.manual_seed(7)
         
-        personality = ["i like playing football.", "i am from NYC."]
-        personality_encoded = self._encode_personality(personality)
-        
-        # history = []
+        persona = self._get_persona(DEFAULT_PERSONALITY)
+        session_id = 'interactive'
+
         while True:
             raw_text = input(">>> ")
             while not raw_text:
                 print('Prompt should not be empty!')
                 raw_text = input(">>> ")
-            history.append(self.tokenizer.encode(raw_text))
+            self.sessions.append(session_id, self.tokenizer.encode(raw_text))
             with torch.no_grad():
-                out_ids = self.sample_sequence(personality_encoded, self.history)
-            self.history.append(out_ids)
-            self.history = self.history[-(2*self.max_history+1):]
+                out_ids = self.sample_sequence(persona['persona_ids'], self.sessions.history(session_id),
+                                               prefix_ids=persona['prefix_ids'])
+            self.sessions.append(session_id, out_ids)
             out_text = self.tokenizer.decode(out_ids, skip_special_tokens=True)
             print(out_text)
 
@@ -2,19 +2,8 @@ import argparse
 import os
 
 import numpy as np
-import tensorflow as tf
 
-import keras.backend as K
-from keras.models import Model, load_model
-from keras.layers import Add, Lambda
-from keras.preprocessing.sequence import pad_sequences
-
-from keras_transformer.transformer import LayerNormalization
-from keras_transformer.attention import MultiHeadAttention
-from keras_transformer.extras import ReusableEmbedding, TiedOutputEmbedding
-from keras_transformer.position import TransformerCoordinateEmbedding
-
-from pytorch_pretrained_bert import OpenAIGPTTokenizer
+from fast_startup import import_keras_deps, load_tokenizer_artifact, pad_batch
 
 
 def sparse_loss(y_true, y_pred, from_logits=True):
@@ -30,6 +19,7 @@ def sparse_loss(y_true, y_pred, from_logits=True):
     Returns:
         crossentropy loss -- Float corresponding to the loss on either training or test set, lower is better
     """
+    K = import_keras_deps()['K']
     return K.sparse_categorical_crossentropy(y_true, y_pred, from_logits=from_logits)
 
 def perplexity(y_true, y_pred):
@@ -44,15 +34,27 @@ def perplexity(y_true, y_pred):
         be interpreted as answering the question "how many words is the model confused between at any
         given timestpe in a sequence?")
     """
+    K = import_keras_deps()['K']
     cross_entropy = K.sparse_categorical_crossentropy(y_true, y_pred, from_logits=True)
     return K.mean(K.exp(K.mean(cross_entropy, axis=-1)))
 
-def load_gpt_tokenizer():
+def load_gpt_tokenizer(artifact_path:str=None):
     """ Helper function for loading sub-word tokenizer
     
+    Keyword Arguments:
+        artifact_path {str} -- Local artifact written by `fast_startup.save_tokenizer_artifact`,
+        loads without downloading anything (default: {None})
+
     Returns:
          Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer tokenizer
     """
+    if artifact_path is not None:
+        tok = load_tokenizer_artifact(artifact_path)
+        print('GPT tokenizer loaded from {}...'.format(artifact_path))
+        return tok
+
+    from pytorch_pretrained_bert import OpenAIGPTTokenizer
+
     model_name = 'openai-gpt'
     special_tokens = ['_start_', '_end_', '_pad_']
     tok = OpenAIGPTTokenizer.from_pretrained(model_name, special_tokens=special_tokens)
@@ -64,16 +66,20 @@ def load_gpt_tokenizer():
     return tok
 
 class InferenceModel(object):
-    def __init__(self, tokenizer, model_path:str):
+    def __init__(self, tokenizer, model_path:str, verbose:bool=True):
         """ Inference wrapper class for getting predictions from model
         and decoding into text to be preented to end-user
         
         Arguments:
             tokenizer -- Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer
             model_path {str} -- Path to trained model
+
+        Keyword Arguments:
+            verbose {bool} -- Print the model summary after loading (default: {True})
         """
         self.tokenizer = tokenizer
         self.model_path = model_path
+        self.verbose = verbose
         self.model = self._load_model()
         self.start_tok_id = self.tokenizer.special_tokens['_start_']
         self.stop_tok_id = self.tokenizer.special_tokens['_end_']
@@ -87,13 +93,25 @@ class InferenceModel(object):
             keras.models.Model -- Keras model ready for inference
         """
         s2s_only = False
-        model = load_model(self.model_path, custom_objects={'tf': tf,
+        deps = import_keras_deps()
+        model = deps['load_model'](self.model_path, custom_objects={'tf': deps['tf'],
                                                                   'sparse_loss': sparse_loss,
                                                                   'perplexity': perplexity})
-        model.summary()
-        
+        if self.verbose:
+            model.summary()
+
         return model
 
+    def warm_up(self):
+        """ Build the predict function and run one dummy step, so the first real
+        request doesn't pay for graph compilation
+        """
+        self.model._make_predict_function()
+        x_input = np.asarray([[self.start_tok_id, self.stop_tok_id]])
+        target_seq = np.zeros((1, self.max_len), dtype='int32')
+        target_seq[0, 0] = self.start_tok_id
+        self.model.predict_on_batch([x_input, target_seq])
+
     def _encode_from_text(self, input_text:str):
         """ Internal method for prepping input text to be fed to model
         
@@ -149,6 +167,40 @@ class InferenceModel(object):
 
         return decoded_string
 
+    def greedy_decode_batch(self, input_seqs:list):
+        """ Greedy decoding over several inputs at once - one `predict_on_batch` call
+        per decode step for the whole batch instead of one per input
+
+        Arguments:
+            input_seqs {list} -- List of input utterances as strings
+
+        Returns:
+            list -- Decoded response string for every input, in order
+        """
+        x_inputs = [self._encode_from_text(s)[0] for s in input_seqs]
+        # Inputs are padded with `_pad_` (word_id = 0), same as in training
+        x_input = pad_batch(x_inputs, value=0)
+        n_inputs = len(input_seqs)
+
+        decoded_tokens = [[] for _ in range(n_inputs)]
+        finished = np.zeros(n_inputs, dtype=bool)
+        target_seq = np.zeros((n_inputs, self.max_len), dtype='int32')
+        target_seq[:, 0] = self.start_tok_id
+
+        for i in range(self.max_len - 1):
+            sampled = self.model.predict_on_batch([x_input, target_seq])[:, i, :].argmax(axis=-1)
+            for b in np.where(~finished)[0]:
+                sampled_index = int(sampled[b])
+                if sampled_index == self.stop_tok_id:
+                    finished[b] = True
+                    continue
+                decoded_tokens[b].append(sampled_index)
+                target_seq[b, i+1] = sampled_index
+            if finished.all():
+                break
+
+        return [self.tokenizer.decode(toks) for toks in decoded_tokens]
+
     def beam_search_decode(self, input_seq:str):
         # TBD for this method
         raise NotImplementedError()
@@ -1,22 +1,15 @@
 import argparse
 import os
+import sys
 
 import numpy as np
-import tensorflow as tf
 
-import keras.backend as K
-from keras.models import Model, load_model
-from keras.layers import Add, Lambda
-from keras.preprocessing.sequence import pad_sequences
-
-from keras_transformer.transformer import LayerNormalization
-from keras_transformer.attention import MultiHeadAttention
-from keras_transformer.extras import ReusableEmbedding, TiedOutputEmbedding
-from keras_transformer.position import TransformerCoordinateEmbedding
-
-from pytorch_pretrained_bert import OpenAIGPTTokenizer
+from fast_startup import import_keras_deps, load_tokenizer_artifact, pad_batch
 from search_utils import softmax, Beam
 
+# shortlist.py is imported from the training code one directory up, only when shortlisting
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 
 def sparse_loss(y_true, y_pred, from_logits=True):
     """ Custom loss function - needed for loading and compiling model
@@ -31,6 +24,7 @@ def sparse_loss(y_true, y_pred, from_logits=True):
     Returns:
         crossentropy loss -- Float corresponding to the loss on either training or test set, lower is better
     """
+    K = import_keras_deps()['K']
     return K.sparse_categorical_crossentropy(y_true, y_pred, from_logits=from_logits)
 
 def perplexity(y_true, y_pred):
@@ -45,15 +39,27 @@ def perplexity(y_true, y_pred):
         be interpreted as answering the question "how many words is the model confused between at any
         given timestpe in a sequence?")
     """
+    K = import_keras_deps()['K']
     cross_entropy = K.sparse_categorical_crossentropy(y_true, y_pred, from_logits=True)
     return K.mean(K.exp(K.mean(cross_entropy, axis=-1)))
 
-def load_gpt_tokenizer():
+def load_gpt_tokenizer(artifact_path:str=None):
     """ Helper function for loading sub-word tokenizer
 
+    Keyword Arguments:
+        artifact_path {str} -- Local artifact written by `fast_startup.save_tokenizer_artifact`,
+        loads without downloading anything (default: {None})
+
     Returns:
          Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer tokenizer
     """
+    if artifact_path is not None:
+        tok = load_tokenizer_artifact(artifact_path)
+        print('GPT tokenizer loaded from {}...'.format(artifact_path))
+        return tok
+
+    from pytorch_pretrained_bert import OpenAIGPTTokenizer
+
     model_name = 'openai-gpt'
     special_tokens = ['_start_', '_end_', '_pad_']
     tok = OpenAIGPTTokenizer.from_pretrained(model_name, special_tokens=special_tokens)
@@ -65,22 +71,27 @@ def load_gpt_tokenizer():
     return tok
 
 class DialogModel(object):
-    def __init__(self, tokenizer, model_path:str):
+    def __init__(self, tokenizer, model_path:str, verbose:bool=True):
         """ Inference wrapper class for getting predictions from model
         and decoding into text to be preented to end-user
 
         Arguments:
             tokenizer -- Instance of pytorch_pretrained_bert.OpenAIGPTTokenizer
             model_path {str} -- Path to trained model
+
+        Keyword Arguments:
+            verbose {bool} -- Print the model summary after loading (default: {True})
         """
         self.tokenizer = tokenizer
         self.model_path = model_path
+        self.verbose = verbose
         self.model = self._load_model()
         self.start_tok_id = self.tokenizer.special_tokens['_start_']
         self.stop_tok_id = self.tokenizer.special_tokens['_end_']
         self.max_len = 45
         self.min_length = 5
         self.s2s_only = True
+        self.shortlist = None
 
     def _load_model(self):
         """ Wrapper method for loading model
@@ -89,11 +100,58 @@ class DialogModel(object):
             keras.models.Model -- Keras model ready for inference
         """
         s2s_only = False
-        model = load_model(self.model_path, custom_objects={'tf': tf, 'sparse_loss': sparse_loss, 'perplexity': perplexity})
-        model.summary()
+        deps = import_keras_deps()
+        model = deps['load_model'](self.model_path, custom_objects={'tf': deps['tf'], 'sparse_loss': sparse_loss, 'perplexity': perplexity})
+        if self.verbose:
+            model.summary()
 
         return model
 
+    def warm_up(self):
+        """ Build the predict function and run one dummy step, so the first real
+        request doesn't pay for graph compilation
+        """
+        self.model._make_predict_function()
+        x_input = np.asarray([[self.start_tok_id, self.stop_tok_id]])
+        target_seq = np.zeros((1, self.max_len), dtype='int32')
+        target_seq[0, 0] = self.start_tok_id
+        self.model.predict_on_batch([x_input, target_seq])
+
+    def enable_shortlist(self, shortlist):
+        """ Score only a per-input candidate vocabulary at each decode step instead of
+        every word, see `shortlist.Shortlist` (word ID's must be in this tokenizer's vocab)
+
+        Arguments:
+            shortlist {shortlist.Shortlist} -- Candidate lists built from training data
+        """
+        from shortlist import split_output_layer
+
+        self.shortlist = shortlist
+        self.hidden_model, self.shortlist_projection = split_output_layer(self.model, vocab_size=self.model.output_shape[-1])
+        self._restricted = (None, None)
+
+    def disable_shortlist(self):
+        self.shortlist = None
+
+    def _restrict_vocab(self, x_input):
+        if self.shortlist is None:
+            return None
+        # Beam search asks for the same input many times, keep the last kernel slice around
+        key = x_input.tobytes()
+        if self._restricted[0] != key:
+            self._restricted = (key, self.shortlist_projection.restrict(self.shortlist.candidates(x_input)))
+        return self._restricted[1]
+
+    def _step_logits(self, x_input, y_input, restricted=None):
+        """ Logits for every decode position, plus the word ID each column stands for
+        (None when scoring the full vocabulary)
+        """
+        if restricted is None:
+            return self.model.predict_on_batch([x_input, y_input]), None
+        word_ids, W_sub, b_sub = restricted
+        hidden = self.hidden_model.predict_on_batch([x_input, y_input])
+        return np.dot(hidden, W_sub) + b_sub, word_ids
+
     def _encode_from_text(self, input_text:str):
         """ Internal method for prepping input text to be fed to model
 
@@ -125,6 +183,7 @@ class DialogModel(object):
             decoded_string {str} -- String of response utterance generated from model
         """
         x_input = self._encode_from_text(input_seq)
+        restricted = self._restrict_vocab(x_input)
 
         # Set up decoder input data
         decoded_tokens = []
@@ -135,9 +194,10 @@ class DialogModel(object):
         print('Generating output...')
         for i in range(self.max_len - 1):
             print('=', end='', flush=True)
-            output = self.model.predict_on_batch([x_input, target_seq]).argmax(axis=2)
+            logits, word_ids = self._step_logits(x_input, target_seq, restricted)
+            output = logits.argmax(axis=2)
             # sampled_index = np.argmax(output[0, i, :])
-            sampled_index = int(output[:, i])
+            sampled_index = int(output[:, i]) if word_ids is None else int(word_ids[output[0, i]])
             if sampled_index == self.stop_tok_id:
                 break
             decoded_tokens.append(sampled_index)
@@ -149,6 +209,45 @@ class DialogModel(object):
 
         return decoded_string
 
+    def greedy_decode_batch(self, input_seqs:list):
+        """ Greedy decoding over several inputs at once - one `predict_on_batch` call
+        per decode step for the whole batch instead of one per input
+
+        Arguments:
+            input_seqs {list} -- List of input utterances as strings
+
+        Returns:
+            list -- Decoded response string for every input, in order
+        """
+        x_inputs = [self._encode_from_text(s)[0] for s in input_seqs]
+        # Inputs are padded with `_pad_` (word_id = 0), same as in training
+        x_input = pad_batch(x_inputs, value=0)
+        n_inputs = len(input_seqs)
+        # One shortlist for the whole batch - the union of every input's candidates
+        restricted = self._restrict_vocab(x_input)
+
+        decoded_tokens = [[] for _ in range(n_inputs)]
+        finished = np.zeros(n_inputs, dtype=bool)
+        target_seq = np.zeros((n_inputs, self.max_len), dtype='int32')
+        target_seq[:, 0] = self.start_tok_id
+
+        for i in range(self.max_len - 1):
+            logits, word_ids = self._step_logits(x_input, target_seq, restricted)
+            sampled = logits[:, i, :].argmax(axis=-1)
+            if word_ids is not None:
+                sampled = word_ids[sampled]
+            for b in np.where(~finished)[0]:
+                sampled_index = int(sampled[b])
+                if sampled_index == self.stop_tok_id:
+                    finished[b] = True
+                    continue
+                decoded_tokens[b].append(sampled_index)
+                target_seq[b, i+1] = sampled_index
+            if finished.all():
+                break
+
+        return [self.tokenizer.decode(toks) for toks in decoded_tokens]
+
     def _get_next_words(self, x_input, context):
         """ Internal helper method for beam search - takes in input
         and generates actual probabilities from trained model.
@@ -171,20 +270,38 @@ class DialogModel(object):
         y_input = np.expand_dims(y_input, 0)
         # print(y_input.shape)
         # print(y_input)
-        logits = self.model.predict_on_batch([x_input, y_input])
+        logits, word_ids = self._step_logits(x_input, y_input, self._restrict_vocab(x_input))
         
         # Return list of score-word tuples sorted by score
         row = len(context) - 1
         # print('row:', row)
         # print('logits shape:', logits.squeeze().shape)
-        next_word_log_probs = logits.squeeze()[row, :]
+        next_word_log_probs = logits[0, row, :]
         # print(next_word_log_probs.shape)
         next_word_probs = softmax(next_word_log_probs)
         # print(next_word_probs.shape)
-        score_word_result = list(zip(next_word_probs, list(range(len(next_word_probs)))))
+        # With a shortlist only the candidate words are expanded by the beam search
+        word_ids = list(range(len(next_word_probs))) if word_ids is None else word_ids.tolist()
+        score_word_result = list(zip(next_word_probs, word_ids))
         
         return score_word_result
 
+    def shortlist_report(self, input_seqs:list, shortlist):
+        """ Speed-up and agreement of shortlist greedy decoding against the full softmax """
+        from shortlist import compare_decoding
+
+        self.enable_shortlist(shortlist)
+
+        def decode(use_shortlist):
+            def fn(input_seq):
+                self.shortlist = shortlist if use_shortlist else None
+                return self.greedy_decode(input_seq)
+            return fn
+
+        report = compare_decoding(decode(False), decode(True), input_seqs)
+        self.shortlist = shortlist
+        return report
+
     def beam_search_decode(self, input_seq:str, beam_width:int=10, return_beams:bool=False):
         """ Beam search decoding method - optionally returns beams and scores 
         for each beam when traversing the logits matrix
@@ -231,6 +348,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_path', type=str, required=False, default='')
     parser.add_argument('--beam_width', type=int, required=False, default=1)
+    parser.add_argument('--shortlist_path', type=str, required=False, default=None)
+    parser.add_argument('--build_shortlist_from', type=str, required=False, default=None,
+                        help='Tab-separated context/response file used to build --shortlist_path')
+    parser.add_argument('--compare_shortlist', type=str, required=False, default=None,
+                        help='File of input utterances (one per line) to compare shortlist and full decoding on')
     parser.add_argument('--gpu', type=int, required=False, default=-1)
     args = parser.parse_args()
 
@@ -241,6 +363,22 @@ if __name__ == '__main__':
 
     inference_model = DialogModel(tokenizer=bpe_tokenizer, model_path=args.model_path)
 
+    if args.shortlist_path is not None:
+        from shortlist import Shortlist
+
+        if args.build_shortlist_from is not None:
+            with open(args.build_shortlist_from, mode='r') as infile:
+                pairs = [tuple(bpe_tokenizer.encode(field) for field in line.strip().split('\t')[:2]) for line in infile]
+            Shortlist.build(pairs, always_include=[inference_model.stop_tok_id]).save(args.shortlist_path)
+        shortlist = Shortlist.load(args.shortlist_path)
+
+        if args.compare_shortlist is not None:
+            with open(args.compare_shortlist, mode='r') as infile:
+                inputs = [line.strip() for line in infile if line.strip()]
+            inference_model.shortlist_report(inputs, shortlist)
+        else:
+            inference_model.enable_shortlist(shortlist)
+
     example_sent = "your account may be compromised." # "Hey, how are you doing?"
     # response = inference_model.greedy_decode(input_seq=example_sent)
     # print("got response: {}".format(response))
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Methods the server knows how to dispatch, and the request fields each one takes
+SUPPORTED_METHODS = {'greedy_decode': ['input_seq'],
+                     'beam_search_decode': ['input_seq', 'beam_width'],
+                     'get_response': ['input_seq', 'personality', 'session_id']}
+# Accepted types of those fields, `input_seq` is required
+FIELD_TYPES = {'input_seq': str, 'beam_width': int, 'personality': list, 'session_id': str}
+
+
+def percentile(values:list, q:float):
+    """ Nearest-rank percentile, avoids pulling numpy into the serving front-end """
+    if len(values) == 0:
+        return float('nan')
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(math.ceil(q / 100. * len(ordered))) - 1))
+    return ordered[rank]
+
+def validate_request(request:dict):
+    """ Error message for a request the model can't be called with, None if it can """
+    method = request.get('method')
+    if method not in SUPPORTED_METHODS:
+        return 'unknown method: {}'.format(method)
+    if 'input_seq' not in request:
+        return 'missing field: input_seq'
+    for field in SUPPORTED_METHODS[method]:
+        value = request.get(field)
+        # bool is an int subclass, but never a valid count
+        if field in request and (not isinstance(value, FIELD_TYPES[field]) or isinstance(value, bool)):
+            return 'invalid {}: expected {}'.format(field, FIELD_TYPES[field].__name__)
+    if request.get('beam_width', 1) < 1:
+        return 'invalid beam_width: must be positive'
+    return None
+
+class DialogServer(object):
+    def __init__(self, model_factory, max_queue_size:int=256, max_batch_size:int=32,
+                 batch_wait:float=0.005, request_timeout:float=10.):
+        """ Asyncio front-end for the dialog inference wrappers
+
+        All model calls happen on a single "model-owner" thread: `model_factory` is run
+        on that thread, so TF1/Keras graphs and sessions are created and used from the
+        same place. Requests are queued, grouped into batches by method and dispatched
+        to `<method>_batch` when the model provides it (e.g. `greedy_decode_batch`),
+        otherwise one at a time. `<method>_batch` only takes the inputs, so requests that
+        set any other field of their method are always decoded one at a time, with it.
+
+        Arguments:
+            model_factory {callable} -- Zero-argument callable returning a `DialogModel`,
+            `InferenceModel` or `HuggingFaceModel` (or anything with the same methods)
+
+        Keyword Arguments:
+            max_queue_size {int} -- Requests waiting beyond this are rejected straight away (default: {256})
+            max_batch_size {int} -- Maximum requests handed to the model in one go (default: {32})
+            batch_wait {float} -- Seconds to wait for more requests before dispatching a batch (default: {0.005})
+            request_timeout {float} -- Per-request deadline in seconds (default: {10.})
+        """
+        self.model_factory = model_factory
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.model = None
+        self.queue = None
+        self.worker = None
+        self.stats = {'completed': 0, 'rejected': 0, 'timed_out': 0, 'failed': 0, 'batches': 0}
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.model = await loop.run_in_executor(self.executor, self.model_factory)
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.worker = asyncio.ensure_future(self._worker_loop())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, request:dict, timeout:float=None):
+        """ Queue one request and wait for its result
+
+        Arguments:
+            request {dict} -- Must hold `method` and `input_seq`, optionally `beam_width`,
+            `personality` and `session_id`
+
+        Returns:
+            dict -- `{'ok': True, 'result': ...}` or `{'ok': False, 'error': ...}`
+        """
+        # Rejected before queueing, so a bad request can't fail the batch it would land in
+        error = validate_request(request)
+        if error is not None:
+            return {'ok': False, 'error': error}
+        method = request['method']
+
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((method, request, future))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return {'ok': False, 'error': 'overloaded'}
+
+        timeout = self.request_timeout if timeout is None else timeout
+        try:
+            result = await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            # `wait_for` cancels the future, so the worker skips it if it's still queued
+            self.stats['timed_out'] += 1
+            return {'ok': False, 'error': 'timeout'}
+        except Exception as e:
+            self.stats['failed'] += 1
+            return {'ok': False, 'error': repr(e)}
+
+        self.stats['completed'] += 1
+        return {'ok': True, 'result': result}
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            if self.queue.empty():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+                if self.queue.empty():
+                    break
+            batch.append(self.queue.get_nowait())
+        # Requests whose callers already timed out don't need to be decoded
+        return [item for item in batch if not item[-1].done()]
+
+    async def _worker_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            by_method = {}
+            for method, request, future in batch:
+                by_method.setdefault(method, []).append((request, future))
+
+            for method, items in by_method.items():
+                self.stats['batches'] += 1
+                requests = [r for r, _ in items]
+                try:
+                    outcomes = await loop.run_in_executor(self.executor, self._run_batch, method, requests)
+                except Exception as e:
+                    outcomes = [(False, e)] * len(items)
+                # Each request gets its own result or error
+                for (_, future), (ok, value) in zip(items, outcomes):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+
+    def _run_one(self, method:str, request:dict):
+        kwargs = {k: request[k] for k in SUPPORTED_METHODS[method] if k in request}
+        output = getattr(self.model, method)(**kwargs)
+        if method == 'beam_search_decode':
+            # Only the best beam is serialisable/useful to a client
+            output = {'token_ids': [int(t) for t in output[0]], 'score': float(output[1])}
+        return output
+
+    def _run_batch(self, method:str, requests:list):
+        """ Runs on the model-owner thread, returns an (ok, result or exception) pair per request """
+        outcomes = [None] * len(requests)
+        batch_fn = getattr(self.model, method + '_batch', None)
+        # The batched call would drop per-request settings, only requests with defaults go through it
+        plain = [i for i, r in enumerate(requests) if all(k == 'input_seq' or k not in r for k in SUPPORTED_METHODS[method])]
+        if batch_fn is not None and len(plain) > 1:
+            try:
+                for i, output in zip(plain, batch_fn([requests[i]['input_seq'] for i in plain])):
+                    outcomes[i] = (True, output)
+            except Exception:
+                # Retried one at a time below, so only the request that caused it fails
+                outcomes = [None] * len(requests)
+
+        for i, r in enumerate(requests):
+            if outcomes[i] is not None:
+                continue
+            try:
+                outcomes[i] = (True, self._run_one(method, r))
+            except Exception as e:
+                outcomes[i] = (False, e)
+        return outcomes
+
+    async def _handle_client(self, reader, writer):
+        # One JSON request per line, one JSON response per line
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                # Valid JSON that isn't an object (a list, string, number...) is as unusable as malformed JSON
+                response = {'ok': False, 'error': 'invalid json'}
+            else:
+                response = await self.submit(request, timeout=request.get('timeout'))
+                response['id'] = request.get('id')
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, host:str='127.0.0.1', port:int=8765, unix_socket:str=None):
+        await self.start()
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self._handle_client, path=unix_socket)
+            print('Serving on unix socket {}'.format(unix_socket))
+        else:
+            server = await asyncio.start_server(self._handle_client, host=host, port=port)
+            print('Serving on {}:{}'.format(host, port))
+        return server
+
+class MockDialogModel(object):
+    def __init__(self, step_latency:float=0.002, max_len:int=20):
+        """ Stand-in model with a fixed per-step cost, so the serving layer can be
+        exercised and benchmarked without TF/torch or downloaded weights
+        """
+        self.step_latency = step_latency
+        self.max_len = max_len
+
+    def _decode_steps(self, input_seq:str):
+        return min(self.max_len, len(input_seq.split()) + 3)
+
+    def greedy_decode(self, input_seq:str):
+        time.sleep(self.step_latency * self._decode_steps(input_seq))
+        return input_seq[::-1]
+
+    def greedy_decode_batch(self, input_seqs:list):
+        # A batched decode step costs about the same as a single one
+        time.sleep(self.step_latency * max(self._decode_steps(s) for s in input_seqs))
+        return [s[::-1] for s in input_seqs]
+
+    def beam_search_decode(self, input_seq:str, beam_width:int=10):
+        time.sleep(self.step_latency * self._decode_steps(input_seq) * beam_width)
+        return (list(range(len(input_seq.split()))), 1.0, None)
+
+    def get_response(self, input_seq:str, personality:list=[], session_id='default'):
+        time.sleep(self.step_latency * self._decode_steps(input_seq))
+        return input_seq.upper()
+
+async def _mock_client(host, port, unix_socket, n_requests, method, latencies, errors):
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    for i in range(n_requests):
+        request = {'id': i, 'method': method, 'input_seq': 'hey , how is it going ?',
+                   'session_id': 'client-{}'.format(id(writer))}
+        start = time.time()
+        writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        await writer.drain()
+        response = json.loads((await reader.readline()).decode('utf-8'))
+        latencies.append(time.time() - start)
+        if not response['ok']:
+            errors.append(response['error'])
+    writer.close()
+
+async def run_benchmark(server:DialogServer, n_clients:int=32, n_requests:int=50, method:str='greedy_decode',
+                        host:str='127.0.0.1', port:int=8765, unix_socket:str=None):
+    """ Hammer a running server with concurrent mock clients and report
+    throughput and latency percentiles
+    """
+    listener = await server.serve(host=host, port=port, unix_socket=unix_socket)
+    latencies, errors = [], []
+    start = time.time()
+    await asyncio.gather(*[_mock_client(host, port, unix_socket, n_requests, method, latencies, errors)
+                           for _ in range(n_clients)])
+    elapsed = time.time() - start
+    listener.close()
+    await listener.wait_closed()
+    await server.stop()
+
+    report = {'requests': len(latencies), 'errors': len(errors), 'elapsed_sec': elapsed,
+              'requests_per_sec': len(latencies) / elapsed,
+              'p50_ms': 1000 * percentile(latencies, 50),
+              'p95_ms': 1000 * percentile(latencies, 95),
+              'p99_ms': 1000 * percentile(latencies, 99),
+              'batches': server.stats['batches']}
+    print('\nBENCHMARK ({} clients x {} requests, method={})'.format(n_clients, n_requests, method))
+    print('=' * 50)
+    for k, v in report.items():
+        print('{}: {}'.format(k, round(v, 3) if isinstance(v, float) else v))
+    return report
+
+def _model_factory(args):
+    if args.model_type == 'mock':
+        return lambda: MockDialogModel()
+    elif args.model_type == 'huggingface':
+        def factory():
+            from hugging_face_model import HuggingFaceModel
+            return HuggingFaceModel(decode_method=args.decode_method)
+        return factory
+    else:
+        def factory():
+            from inference_models import DialogModel, load_gpt_tokenizer
+            model = DialogModel(tokenizer=load_gpt_tokenizer(artifact_path=args.tokenizer_artifact),
+                                model_path=args.model_path, verbose=False)
+            model.warm_up()
+            return model
+        return factory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, required=False, default='mock', help='One of: mock, keras, huggingface')
+    parser.add_argument('--model_path', type=str, required=False, default='')
+    parser.add_argument('--tokenizer_artifact', type=str, required=False, default=None)
+    parser.add_argument('--decode_method', type=str, required=False, default='sample')
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=False, default=8765)
+    parser.add_argument('--unix_socket', type=str, required=False, default=None)
+    parser.add_argument('--max_batch_size', type=int, required=False, default=32)
+    parser.add_argument('--max_queue_size', type=int, required=False, default=256)
+    parser.add_argument('--request_timeout', type=float, required=False, default=10.)
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--n_clients', type=int, required=False, default=32)
+    parser.add_argument('--n_requests', type=int, required=False, default=50)
+    parser.add_argument('--gpu', type=int, required=False, default=-1)
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+
+    dialog_server = DialogServer(model_factory=_model_factory(args), max_queue_size=args.max_queue_size,
+                                 max_batch_size=args.max_batch_size, request_timeout=args.request_timeout)
+    loop = asyncio.get_event_loop()
+    if args.benchmark:
+        loop.run_until_complete(run_benchmark(dialog_server, n_clients=args.n_clients, n_requests=args.n_requests,
+                                              host=args.host, port=args.port, unix_socket=args.unix_socket))
+    else:
+        loop.run_until_complete(dialog_server.serve(host=args.host, port=args.port, unix_socket=args.unix_socket))
+        loop.run_forever()
@@ -1,8 +1,18 @@
-import argparse, os
+import argparse, os, time
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.tools import optimize_for_inference_lib
+from tensorflow.tools.graph_transforms import TransformGraph
 
-def freeze_graph(model_path, output_node_names, output_path):
+# Graph-transform passes applied by `strip_and_fold`, in order
+OPTIMIZE_TRANSFORMS = ['strip_unused_nodes',
+                       'remove_nodes(op=Identity, op=CheckNumerics)',
+                       'fold_constants(ignore_errors=true)',
+                       'fold_batch_norms',
+                       'fold_old_batch_norms',
+                       'sort_by_execution_order']
+
+def freeze_graph(model_path, output_node_names, output_path, verbose=False):
     model_base_path = os.path.split(model_path)[0]
     if not os.path.exists(model_base_path):
         raise AssertionError("directory doesn't exist")
@@ -18,10 +28,10 @@ def freeze_graph(model_path, output_node_names, output_path):
         saver.restore(sess, model_path)
 
         # Looking at TF operation
-        for n in tf.get_default_graph().as_graph_def().node:
-            # if ('logits' in n.name) or (n.name == 'x_input'):
-            if ('gradients' not in n.name):
-                print(n.name)
+        if verbose:
+            for n in tf.get_default_graph().as_graph_def().node:
+                if ('gradients' not in n.name):
+                    print(n.name)
 
         output_graph_def = tf.graph_util.convert_variables_to_constants(
             sess=sess, input_graph_def=tf.get_default_graph().as_graph_def(), output_node_names=output_node_names)
@@ -38,11 +48,149 @@ def load_graph(graph_path, name):
         graph_def.ParseFromString(infile.read())
     return graph_def
 
+def write_graph(graph_def, output_path):
+    with tf.gfile.GFile(output_path, 'wb') as outgraph:
+        outgraph.write(graph_def.SerializeToString())
+
 def create_inference_graph(input_graph_def, input_nodes, output_nodes, output_graph_name):
     output_graph_def = optimize_for_inference_lib.optimize_for_inference(input_graph_def, input_nodes,
                                                 output_nodes, tf.float32.as_datatype_enum)
-    with tf.gfile.FastGFile(output_graph_name, 'w') as outgraph:
-        outgraph.write(output_graph_def.SerializeToString())
+    write_graph(output_graph_def, output_graph_name)
+    return output_graph_def
+
+def strip_and_fold(input_graph_def, input_nodes, output_nodes):
+    """ Drop training-only ops, fold constants and batch norms into the surrounding weights """
+    # Training nodes (gradients, optimizer slots, assert/identity chains) first
+    graph_def = tf.graph_util.remove_training_nodes(input_graph_def, protected_nodes=input_nodes + output_nodes)
+    return TransformGraph(graph_def, input_nodes, output_nodes, OPTIMIZE_TRANSFORMS)
+
+def _find_weight_const(graph_def, matmul_node_name):
+    """ Follow the weight input of a MatMul back through Identity ops to its Const """
+    nodes = {n.name: n for n in graph_def.node}
+    if matmul_node_name not in nodes:
+        raise ValueError('No node named {} in graph'.format(matmul_node_name))
+    node = nodes[nodes[matmul_node_name].input[1].split(':')[0].lstrip('^')]
+    while node.op == 'Identity':
+        node = nodes[node.input[0].split(':')[0].lstrip('^')]
+    if node.op != 'Const':
+        raise ValueError('Weights of {} are not constant - freeze the graph first'.format(matmul_node_name))
+    return node
+
+def quantize_matmul_weights(input_graph_def, matmul_node_name='logits/MatMul'):
+    """ Post-training int8 weight quantization for a single MatMul
+
+    The float32 weight constant (hidden, vocab) is replaced by an int8 constant plus a
+    float32 scale per output column, and de-quantized in-graph (Cast + Mul) under the
+    original node name - so every consumer keeps working unchanged and the weights
+    take a quarter of the space on disk.
+
+    Arguments:
+        input_graph_def {tf.GraphDef} -- Frozen graph
+        matmul_node_name {str} -- Name of the MatMul whose weights get quantized
+
+    Returns:
+        tf.GraphDef -- Graph with quantized weights
+    """
+    graph_def = tf.GraphDef()
+    graph_def.CopyFrom(input_graph_def)
+    weight_node = _find_weight_const(graph_def, matmul_node_name)
+    weights = tf.make_ndarray(weight_node.attr['value'].tensor).astype(np.float32)
+
+    scales = np.maximum(np.abs(weights).max(axis=0), 1e-8) / 127.
+    q_weights = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+
+    name = weight_node.name
+    q_node = graph_def.node.add()
+    q_node.name, q_node.op = name + '_quantized', 'Const'
+    q_node.attr['dtype'].type = tf.int8.as_datatype_enum
+    q_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(q_weights, dtype=tf.int8))
+
+    s_node = graph_def.node.add()
+    s_node.name, s_node.op = name + '_scales', 'Const'
+    s_node.attr['dtype'].type = tf.float32.as_datatype_enum
+    s_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(scales.astype(np.float32), dtype=tf.float32))
+
+    cast_node = graph_def.node.add()
+    cast_node.name, cast_node.op = name + '_dequantize', 'Cast'
+    cast_node.input.append(q_node.name)
+    cast_node.attr['SrcT'].type = tf.int8.as_datatype_enum
+    cast_node.attr['DstT'].type = tf.float32.as_datatype_enum
+    cast_node.attr['Truncate'].b = False
+
+    # The original Const becomes the rescaling Mul, so downstream inputs are untouched
+    weight_node.op = 'Mul'
+    weight_node.ClearField('attr')
+    weight_node.attr['T'].type = tf.float32.as_datatype_enum
+    weight_node.input.extend([cast_node.name, s_node.name])
+
+    return graph_def
+
+def graph_size_mb(graph_def):
+    return len(graph_def.SerializeToString()) / 1e6
+
+def benchmark_graph(graph_def, input_nodes, output_nodes, n_runs=50, batch_size=1, seq_len=20):
+    """ Mean CPU latency (ms) of running `output_nodes` on random word ID's """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    config = tf.ConfigProto(device_count={'GPU': 0})
+
+    feed = {}
+    for name in input_nodes:
+        tensor = graph.get_tensor_by_name(name + ':0')
+        # Small word ID's are valid for every vocab in this repo
+        feed[tensor] = np.random.randint(1, 10, size=(batch_size, seq_len)).astype(tensor.dtype.as_numpy_dtype)
+    fetches = [graph.get_tensor_by_name(name + ':0') for name in output_nodes]
+
+    with tf.Session(graph=graph, config=config) as sess:
+        sess.run(fetches, feed_dict=feed)
+        start = time.time()
+        for _ in range(n_runs):
+            outputs = sess.run(fetches, feed_dict=feed)
+        latency_ms = 1000 * (time.time() - start) / n_runs
+    return latency_ms, outputs
+
+def optimize_graph(input_graph_def, input_nodes, output_nodes, quantize_logits=False,
+                   logits_node='logits/MatMul', output_path=None):
+    """ Full offline pipeline: strip/fold, optionally int8-quantize the logits weights,
+    then report size and CPU latency against the original graph
+
+    Arguments:
+        input_graph_def {tf.GraphDef} -- Frozen graph (see `freeze_graph`)
+        input_nodes {list} -- Names of input placeholders
+        output_nodes {list} -- Names of nodes to keep as outputs
+
+    Keyword Arguments:
+        quantize_logits {bool} -- Apply int8 weight quantization to `logits_node` (default: {False})
+        logits_node {str} -- Output-projection MatMul to quantize (default: {'logits/MatMul'})
+        output_path {str} -- Optional path to write the optimized graph (default: {None})
+
+    Returns:
+        tuple -- (optimized tf.GraphDef, dict report)
+    """
+    optimized_graph_def = strip_and_fold(input_graph_def, input_nodes, output_nodes)
+    if quantize_logits:
+        optimized_graph_def = quantize_matmul_weights(optimized_graph_def, matmul_node_name=logits_node)
+
+    orig_latency, orig_outputs = benchmark_graph(input_graph_def, input_nodes, output_nodes)
+    opt_latency, opt_outputs = benchmark_graph(optimized_graph_def, input_nodes, output_nodes)
+    max_abs_diff = max(float(np.max(np.abs(a - b))) for a, b in zip(orig_outputs, opt_outputs))
+
+    report = {'original_ops': len(input_graph_def.node), 'optimized_ops': len(optimized_graph_def.node),
+              'original_mb': graph_size_mb(input_graph_def), 'optimized_mb': graph_size_mb(optimized_graph_def),
+              'original_latency_ms': orig_latency, 'optimized_latency_ms': opt_latency,
+              'max_abs_output_diff': max_abs_diff}
+
+    print('\nGRAPH OPTIMIZATION REPORT')
+    print('=' * 50)
+    for k, v in report.items():
+        print('{}: {}'.format(k, round(v, 4) if isinstance(v, float) else v))
+
+    if output_path is not None:
+        write_graph(optimized_graph_def, output_path)
+        print('optimized graph written to {}'.format(output_path))
+
+    return optimized_graph_def, report
 
 # run it
 if __name__ == '__main__':
@@ -52,19 +200,23 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_path', type=str, default=os.path.join(root_path, 'lstm_chatbot_epoch36.ckpt'))
-    parser.add_argument('--output_node_names', type=str, default='x, log_softmax')
+    parser.add_argument('--input_node_names', type=str, default='x_input, decoder_input')
+    parser.add_argument('--output_node_names', type=str, default='logits/MatMul')
     parser.add_argument('--output_path', type=str, default=os.path.join(root_path, 'lstm_chatbot_epoch36.pb'))
+    parser.add_argument('--optimized_output_path', type=str, default=os.path.join(root_path, 'lstm_chatbot_epoch36_opt.pb'))
+    parser.add_argument('--quantize_logits', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
 
     args = parser.parse_args()
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-    # output_node_names = [n.strip() for n in args.output_node_names.split(',')]
-    output_node_names = ['x_input',  'decoder_input', 'logits/MatMul']
-    freeze_graph(model_path=args.model_path, output_node_names=output_node_names,
-                output_path=args.output_path)
+    input_node_names = [n.strip() for n in args.input_node_names.split(',')]
+    output_node_names = [n.strip() for n in args.output_node_names.split(',')]
+    freeze_graph(model_path=args.model_path, output_node_names=input_node_names + output_node_names,
+                output_path=args.output_path, verbose=args.verbose)
     print('frozen graph created...')
     input_graph_def = load_graph(graph_path=args.output_path, name='lstm_chatbot')
     print('frozen graph read in...')
-    # create_inference_graph(input_graph_def=input_graph_def, input_nodes=[output_node_names[0]],
-    #                        output_nodes=[output_node_names[-1]], output_graph_name='models/bidi_lm_opt.pb')
-    # print('optimized graph created.')
\ No newline at end of file
+    optimize_graph(input_graph_def, input_nodes=input_node_names, output_nodes=output_node_names,
+                   quantize_logits=args.quantize_logits, logits_node=output_node_names[-1],
+                   output_path=args.optimized_output_path)
+    print('optimized graph created.')
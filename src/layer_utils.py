@@ -1,12 +1,19 @@
+import time
+
 import keras.backend as K
 import numpy as np
 import tensorflow as tf
 
+from keras import optimizers
 from keras.models import Model
+from keras.optimizers import Optimizer
 from keras.layers import Wrapper
 from keras.layers import *
 from keras.initializers import *
 
+from chunked_attention import chunked_attention, local_attention
+from quantization import quantize_matrix
+
 
 class LayerNormalization(Layer):
     def __init__(self, eps=1e-6, **kwargs):
@@ -30,9 +37,14 @@ class LayerNormalization(Layer):
     def compute_output_shape(self, input_shape):
         return input_shape
 
+    def get_config(self):
+        config = {'eps': self.eps}
+        base_config = super(LayerNormalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
 
 class ScaledDotProductAttention(object):
-    def __init__(self, d_model, attn_dropout=0.1):
+    def __init__(self, d_model, attn_dropout=0.1, chunk_size=None, window=None, n_global=1, causal=False,
+                 legacy_mask=True):
         ''' Constructor
         
         Parameters
@@ -42,11 +54,46 @@ class ScaledDotProductAttention(object):
 
         attn_dropout : float, optional
             Dropout rate applied to attention states (the default is 0.1)
+
+        chunk_size : int, optional
+            Process queries in chunks of this size so only (chunk_size, len_k) scores
+            exist at once (see `chunked_attention`). Attention dropout is applied chunk by
+            chunk in the training phase; attention states are never materialized in full,
+            so None is returned in place of them. Needs `legacy_mask=False` (the default
+            is None, unchunked)
+
+        window : int, optional
+            Sliding-window self-attention: each position attends to the `window`
+            positions on either side plus the first `n_global` ones (see `local_attention`).
+            Dropout, attention states and masking as with `chunk_size` (the default is None,
+            full attention)
+
+        n_global : int, optional
+            Number of leading global positions used with `window` (the default is 1)
+
+        causal : bool, optional
+            With `window`, attend to earlier positions only (decoder self-attention). The
+            mask can't carry this, it is reduced to per-key padding (the default is False)
+
+        legacy_mask : bool, optional
+            Add +1e10 instead of -1e10 at masked positions. This is a bug: softmax then puts
+            almost all the weight on the masked (padding) positions. It is kept only so models
+            trained with it give the same outputs; pass False for correct masking. The
+            chunked and windowed paths only mask correctly, so they refuse it (the default
+            is True)
         
         '''
 
         self.temper = np.sqrt(d_model)
         self.dropout = Dropout(attn_dropout)
+        self.chunk_size = chunk_size
+        self.window = window
+        self.n_global = n_global
+        self.causal = causal
+        self.legacy_mask = legacy_mask
+        self.efficient = chunk_size is not None or window is not None
+        if self.efficient and legacy_mask:
+            raise ValueError('`chunk_size` and `window` need `legacy_mask=False`, they would mask differently')
 
     def __call__(self, q, k, v, mask):
         ''' Define forward-pass of dot-product attention
@@ -76,11 +123,16 @@ class ScaledDotProductAttention(object):
 
         '''
 
+        if self.efficient:
+            return self._efficient_call(q, k, v, mask), None
+
         # Compute attention score of how much each non-focus word impacts the encoding
         # of a given focus word
         attn = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[2, 2]) / self.temper)([q, k])
         if mask is not None:
-            mmask = Lambda(lambda x:(1e+10) * (1-x))(mask)
+            # Inverted sign with `legacy_mask`, see the constructor
+            mask_value = 1e+10 if self.legacy_mask else -1e+10
+            mmask = Lambda(lambda x: mask_value * (1-x))(mask)
             attn = Add()([attn, mmask])
         # Normalize attention scores
         attn = Activation('softmax')(attn)
@@ -89,16 +141,90 @@ class ScaledDotProductAttention(object):
         output = Lambda(lambda x: K.batch_dot(x[0], x[1]))([attn, v])
         return output, attn
 
+    def attend(self, q, k, v, mask=None):
+        ''' Chunked or sliding-window attention on raw tensors of shape (..., len, d),
+        with `mask` (1 = visible) broadcastable to (..., len_q, len_k). Attention dropout
+        is applied in the training phase only
+        '''
+        def run(dropout):
+            if self.window is not None:
+                key_bias = None if mask is None else (-1e+10) * (1 - tf.reduce_max(mask, axis=-2))
+                return local_attention(q, k, v, key_bias=key_bias, window=self.window, n_global=self.n_global,
+                                       scale=1. / self.temper, causal=self.causal, dropout=dropout)
+
+            bias = None if mask is None else (-1e+10) * (1 - mask)
+            return chunked_attention(q, k, v, bias=bias, chunk_size=self.chunk_size, scale=1. / self.temper,
+                                     dropout=dropout)
+
+        if not self.dropout.rate:
+            return run(0.)
+        return K.in_train_phase(lambda: run(self.dropout.rate), lambda: run(0.))
+
+    def _efficient_call(self, q, k, v, mask):
+        def attend(x):
+            qs, ks, vs = x[:3]
+            mask = x[3] if len(x) > 3 else None
+            if mask is not None:
+                # Heads folded into the batch axis (head-major) share one per-example mask -
+                # broadcast it instead of materializing a copy per head
+                n_rep = tf.shape(qs)[0] // tf.shape(mask)[0]
+                qs, ks, vs = [tf.reshape(t, tf.concat([[n_rep, -1], tf.shape(t)[1:]], axis=0)) for t in (qs, ks, vs)]
+                mask = mask[None]
+            output = self.attend(qs, ks, vs, mask)
+            return tf.reshape(output, tf.concat([[-1], tf.shape(output)[-2:]], axis=0))
+
+        return Lambda(attend)([q, k, v] if mask is None else [q, k, v, mask])
+
 
 class MultiHeadAttention(object):
-    def __init__(self, n_head, d_model, d_k, d_v, dropout, mode=0, use_norm=True):
+    def __init__(self, n_head, d_model, d_k, d_v, dropout, mode=0, use_norm=True, chunk_size=None,
+                 window=None, n_global=1, causal=False, legacy_mask=True):
+        ''' Constructor
+
+        Parameters
+        ----------
+        mode : int, optional
+            0 -- separate Q/K/V projections, heads folded into the batch axis
+            1 -- separate projection layers per head
+            2 -- fused: one QKV projection for self-attention (one Q and one KV
+                 projection otherwise) and batched 4-D matmuls over the head axis.
+                 Same projections as mode 0, with kernels concatenated as [W_q | W_k | W_v].
+                 Always masks correctly, so it matches mode 0 only with `legacy_mask=False`
+            (the default is 0)
+
+        chunk_size : int, optional
+            Query chunk size for memory-efficient attention in any mode, see
+            `ScaledDotProductAttention` (the default is None, unchunked)
+
+        window : int, optional
+            Sliding-window size for self-attention (q, k and v the same tensor) in any
+            mode; attention over other keys stays full. See `ScaledDotProductAttention`
+            (the default is None, full attention)
+
+        n_global : int, optional
+            Number of leading global positions every query attends to with `window`
+            (the default is 1)
+
+        causal : bool, optional
+            Backward-only window for decoder self-attention (the default is False)
+
+        legacy_mask : bool, optional
+            Modes 0 and 1 only. By default they add +1e10 at masked positions, which is a bug
+            (padding gets almost all the attention) kept so existing checkpoints give the same
+            outputs. False masks correctly, as mode 2 always does, and is needed for `chunk_size`
+            and `window`. See `ScaledDotProductAttention` (the default is True)
+
+        '''
         self.mode = mode
         self.n_head = n_head
         self.d_k = d_k
         self.d_v = d_v
         self.dropout = dropout
 
-        if mode == 0:
+        if mode == 2:
+            # Built on first call, once it is known whether q, k and v are the same tensor
+            self.qkv_layer, self.q_layer, self.kv_layer = None, None, None
+        elif mode == 0:
             self.qs_layer = Dense(units=n_head * d_k, use_bias=False)
             self.ks_layer = Dense(units=n_head * d_k, use_bias=False)
             self.vs_layer = Dense(units=n_head * d_v, use_bias=False)
@@ -109,7 +235,13 @@ class MultiHeadAttention(object):
                 self.ks_layers.append(TimeDistributed(Dense(units=d_k, use_bias=False)))
                 self.vs_layers.append(TimeDistributed(Dense(units=d_k, use_bias=False)))
         
-        self.attention = ScaledDotProductAttention(d_model)
+        self.chunk_size = chunk_size
+        # Mode 2 does its own (correct) masking, the flag only matters for modes 0 and 1
+        legacy_mask = legacy_mask and mode != 2
+        self.attention = ScaledDotProductAttention(d_model, chunk_size=chunk_size, legacy_mask=legacy_mask)
+        self.self_attention = self.attention if window is None else \
+            ScaledDotProductAttention(d_model, chunk_size=chunk_size, window=window, n_global=n_global, causal=causal,
+                                      legacy_mask=legacy_mask)
         self.layer_norm = LayerNormalization() if use_norm else None
         self.w_o = TimeDistributed(Dense(d_model))
 
@@ -142,6 +274,7 @@ class MultiHeadAttention(object):
 
         d_k, d_v = self.d_k, self.d_v
         n_head = self.n_head
+        attention = self.self_attention if (q is k and k is v) else self.attention
 
         if self.mode == 0:
             qs = self.qs_layer(q)
@@ -159,9 +292,9 @@ class MultiHeadAttention(object):
             ks = Lambda(reshape1)(ks)
             vs = Lambda(reshape1)(vs)
 
-            if mask is not None:
+            if mask is not None and not attention.efficient:
                 mask = Lambda(lambda x: K.repeat_elements(x, n_head, 0))(mask)
-            head, attn = self.attention(qs, ks, vs, mask=mask)
+            head, attn = attention(qs, ks, vs, mask=mask)
 
             def reshape2(x):
                 s = tf.shape(x)
@@ -178,12 +311,15 @@ class MultiHeadAttention(object):
                 qs = self.qs_layers[i](q)
                 ks = self.ks_layers[i](k)
                 vs = self.vs_layers[i](v)
-                head, attn = self.attention(qs, ks, vs, mask)
+                head, attn = attention(qs, ks, vs, mask)
                 heads.append(head)
                 attns.append(attn)
             
             head = Concatenate()(heads) if n_head > 1 else heads[0]
-            attn = Concatenate()(attns) if n_head > 1 else attns[0]
+            attn = None if attention.efficient else (Concatenate()(attns) if n_head > 1 else attns[0])
+
+        elif self.mode == 2:
+            head, attn = self._fused_attention(q, k, v, mask, attention)
 
         outputs = self.w_o(head)
         outputs = Dropout(self.dropout)(outputs)
@@ -193,6 +329,150 @@ class MultiHeadAttention(object):
         outputs = Add()([outputs, q])
         return self.layer_norm(outputs), attn
 
+    def _fused_attention(self, q, k, v, mask=None, attention=None):
+        ''' Fused forward-pass used by mode 2
+
+        Returns
+        -------
+        head : tf.tensor
+            Concatenated heads, (batch, len_q, n_head * d_v)
+
+        attn : tf.tensor
+            Attention states, (batch, n_head, len_q, len_k)
+
+        '''
+
+        d_k, d_v = self.d_k, self.d_v
+        n_head = self.n_head
+        attention = attention or self.attention
+        temper = attention.temper
+
+        if q is k and k is v:
+            if self.qkv_layer is None:
+                self.qkv_layer = Dense(units=n_head * (2 * d_k + d_v), use_bias=False)
+            qkv = self.qkv_layer(q)
+            qs = Lambda(lambda x: x[:, :, :n_head * d_k])(qkv)
+            ks = Lambda(lambda x: x[:, :, n_head * d_k:2 * n_head * d_k])(qkv)
+            vs = Lambda(lambda x: x[:, :, 2 * n_head * d_k:])(qkv)
+        else:
+            if self.q_layer is None:
+                self.q_layer = Dense(units=n_head * d_k, use_bias=False)
+                self.kv_layer = Dense(units=n_head * (d_k + d_v), use_bias=False)
+            qs = self.q_layer(q)
+            kv = self.kv_layer(k)
+            ks = Lambda(lambda x: x[:, :, :n_head * d_k])(kv)
+            vs = Lambda(lambda x: x[:, :, n_head * d_k:])(kv)
+
+        def split_heads(x, d):
+            s = tf.shape(x)
+            return tf.reshape(x, [s[0], s[1], n_head, d])
+
+        if attention.efficient:
+            def efficient(x):
+                # (batch, len, head, d) -> (batch, head, len, d) for the chunked/windowed matmuls
+                qs, ks, vs = [tf.transpose(split_heads(t, d), [0, 2, 1, 3]) for t, d in zip(x[:3], (d_k, d_k, d_v))]
+                head = attention.attend(qs, ks, vs, x[3][:, None] if len(x) > 3 else None)
+                s = tf.shape(head)
+                return tf.reshape(tf.transpose(head, [0, 2, 1, 3]), [s[0], s[2], n_head * d_v])
+
+            return Lambda(efficient)([qs, ks, vs] if mask is None else [qs, ks, vs, mask]), None
+
+        def scores(x):
+            attn = tf.einsum('bqhd,bkhd->bhqk', split_heads(x[0], d_k), split_heads(x[1], d_k)) / temper
+            if len(x) > 2:
+                attn += (-1e+10) * (1 - x[2][:, None])
+            return attn
+
+        attn = Lambda(scores)([qs, ks] if mask is None else [qs, ks, mask])
+        attn = Activation('softmax')(attn)
+        attn = attention.dropout(attn)
+
+        def combine(x):
+            head = tf.einsum('bhqk,bkhd->bqhd', x[0], split_heads(x[1], d_v))
+            s = tf.shape(head)
+            return tf.reshape(head, [s[0], s[1], n_head * d_v])
+
+        head = Lambda(combine)([attn, vs])
+        return head, attn
+
+def fused_attention_weights(mha):
+    ''' Kernels of a mode 0 `MultiHeadAttention` laid out for a mode 2 one
+
+    Returns
+    -------
+    weights : dict
+        `qkv`, `q` and `kv` kernels, each a single-element list for `set_weights`
+
+    '''
+
+    W_q, W_k, W_v = [l.get_weights()[0] for l in (mha.qs_layer, mha.ks_layer, mha.vs_layer)]
+    return {'qkv': [np.concatenate([W_q, W_k, W_v], axis=1)], 'q': [W_q],
+            'kv': [np.concatenate([W_k, W_v], axis=1)]}
+
+def benchmark_attention(seq_lens=(32, 64, 128, 200, 300), batch_size=64, n_head=4, d_model=256, d_k=64,
+                        n_runs=20, chunk_size=16):
+    ''' Micro-benchmark self-attention in mode 0 against the fused mode 2, with mode 2
+    and a chunked mode 0 loaded from mode 0's weights so outputs can be compared directly.
+    Mode 0 masks correctly (`legacy_mask=False`); outputs are compared on padded batches
+    and without padding
+
+    Returns
+    -------
+    report : list
+        One dict per sequence length with the latency (ms) of each mode and the
+        maximum absolute output difference against mode 0, without padding (fused)
+        and with it (fused and chunked)
+
+    '''
+
+    K.set_learning_phase(0)
+    x_in = Input(shape=(None, d_model))
+    mask_in = Input(shape=(None, None))
+    models = {}
+    for name, mode, chunks in ((0, 0, None), (2, 2, None), ('chunked', 0, chunk_size)):
+        mha = MultiHeadAttention(n_head, d_model, d_k, d_k, dropout=0.1, mode=mode, chunk_size=chunks, legacy_mask=False)
+        output, _ = mha(x_in, x_in, x_in, mask=mask_in)
+        models[name] = (mha, Model([x_in, mask_in], output))
+
+    mha_0, mha_2, mha_c = [models[name][0] for name in (0, 2, 'chunked')]
+    mha_2.qkv_layer.set_weights(fused_attention_weights(mha_0)['qkv'])
+    for layer in ('qs_layer', 'ks_layer', 'vs_layer'):
+        getattr(mha_c, layer).set_weights(getattr(mha_0, layer).get_weights())
+    for mha in (mha_2, mha_c):
+        mha.w_o.set_weights(mha_0.w_o.get_weights())
+        mha.layer_norm.set_weights(mha_0.layer_norm.get_weights())
+
+    report = []
+    for seq_len in seq_lens:
+        x = np.random.normal(size=(batch_size, seq_len, d_model)).astype('float32')
+        # Random padding so masking is exercised
+        lengths = np.random.randint(1, seq_len + 1, size=batch_size)
+        valid = (np.arange(seq_len)[None, :] < lengths[:, None]).astype('float32')
+        mask = valid[:, :, None] * valid[:, None, :]
+
+        result = {'seq_len': seq_len}
+        outputs, padded = {}, {}
+        for name, (_, model) in models.items():
+            padded[name] = model.predict_on_batch([x, mask])
+            start = time.time()
+            for _ in range(n_runs):
+                model.predict_on_batch([x, mask])
+            result['mode{}_ms'.format(name)] = 1000 * (time.time() - start) / n_runs
+            outputs[name] = model.predict_on_batch([x, np.ones_like(mask)])
+        result['max_abs_diff'] = float(np.max(np.abs(outputs[0] - outputs[2])))
+        result['max_abs_diff_padded'] = float(np.max(np.abs(padded[0] - padded[2])))
+        result['max_abs_diff_chunked'] = float(np.max(np.abs(padded[0] - padded['chunked'])))
+        report.append(result)
+
+    print('\nATTENTION BENCHMARK (batch {}, {} heads, d_model {})'.format(batch_size, n_head, d_model))
+    print('=' * 50)
+    for r in report:
+        print('len {:4d} | mode 0: {:8.2f} ms | fused: {:8.2f} ms | speed-up: {:5.2f}x | max diff: {:.2e} '
+              '(padded {:.2e}, chunked {:.2e})'.format(r['seq_len'], r['mode0_ms'], r['mode2_ms'],
+                                                       r['mode0_ms'] / r['mode2_ms'], r['max_abs_diff'],
+                                                       r['max_abs_diff_padded'], r['max_abs_diff_chunked']))
+    return report
+
 class PositionwiseFeedForward(object):
     def __init__(self, d_hid, d_inner_hid, dropout=0.1):
         ''' Feed-forward network portion of encoder/decoder stacks
@@ -237,11 +517,32 @@ class PositionwiseFeedForward(object):
         output = Add()([output, x])
         return self.layer_norm(output)
 
-class SampledSoftmax(Layer):
+class SampledSoftmax(object):
     def __init__(self, num_sampled, num_classes,
                 projection, bias, hidden_size):
+        ''' Sampled-softmax training loss over an existing output projection
+
+        Parameters
+        ----------
+        num_sampled : int
+            Number of negative classes sampled per batch
+
+        num_classes : int
+            Vocabulary size
+
+        projection : tf.Variable
+            Kernel of the logits layer, shape (hidden_size, num_classes)
+
+        bias : tf.Variable
+            Bias of the logits layer, or None
+
+        hidden_size : int
+            Dimension of the hidden states fed to the logits layer
+
+        '''
+
         self.weights_reshaped = tf.transpose(projection)
-        self.bias = bias
+        self.bias = tf.zeros([num_classes]) if bias is None else bias
         self.num_classes = num_classes
         self.num_sampled = num_sampled
         self.hidden_size = hidden_size
@@ -249,7 +550,7 @@ class SampledSoftmax(Layer):
     def __call__(self, y_true, input):
         """ reshaping of y_true and input to make them fit each other """
         input = tf.reshape(input, (-1, self.hidden_size))
-        y_true = tf.reshape(y_true, (-1, 1))
+        y_true = tf.reshape(tf.cast(y_true, 'int64'), (-1, 1))
 
         return tf.nn.sampled_softmax_loss(
             weights=self.weights_reshaped,
@@ -259,3 +560,770 @@ class SampledSoftmax(Layer):
             num_sampled=self.num_sampled,
             num_classes=self.num_classes,
             partition_strategy='div')
+
+    def masked_loss(self, y_true, input, pad_id=0):
+        ''' Mean sampled-softmax loss over non-padding positions '''
+        loss = self(y_true, input)
+        mask = tf.cast(tf.not_equal(tf.reshape(y_true, [-1]), pad_id), 'float32')
+        return tf.reduce_sum(loss * mask) / tf.maximum(tf.reduce_sum(mask), 1.)
+
+class ReusableEmbedding(Embedding):
+    ''' Embedding that also outputs its own matrix, so a `TiedOutputEmbedding` can reuse
+    it as the output projection through the graph and saved models stay loadable
+    (same design as `keras_transformer.extras.ReusableEmbedding`)
+    '''
+
+    def call(self, inputs):
+        return [super(ReusableEmbedding, self).call(inputs), K.identity(self.embeddings)]
+
+    def compute_output_shape(self, input_shape):
+        return [super(ReusableEmbedding, self).compute_output_shape(input_shape), (self.input_dim, self.output_dim)]
+
+    def compute_mask(self, inputs, mask=None):
+        return [super(ReusableEmbedding, self).compute_mask(inputs, mask), None]
+
+class TiedOutputEmbedding(Layer):
+    def __init__(self, use_bias=True, **kwargs):
+        ''' Output projection that reuses an embedding matrix: logits = h . E^T + b
+
+        Call on `[hidden, embedding_matrix]`, the matrix being the second output of a
+        `ReusableEmbedding`; `hidden` must have the embedding dimension
+
+        Parameters
+        ----------
+        use_bias : bool, optional
+            Add a per-word output bias (the default is True)
+
+        '''
+        self.use_bias = use_bias
+        self.supports_masking = True
+        super(TiedOutputEmbedding, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.vocab_size = input_shape[1][0]
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(self.vocab_size,), initializer=Zeros(), trainable=True)
+        super(TiedOutputEmbedding, self).build(input_shape)
+
+    def call(self, inputs, mask=None):
+        hidden, embedding_matrix = inputs
+        logits = K.dot(hidden, K.transpose(embedding_matrix))
+        if self.use_bias:
+            logits = K.bias_add(logits, self.bias)
+        return logits
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0][:-1] + (input_shape[1][0],)
+
+    def compute_mask(self, inputs, mask=None):
+        return mask[0] if mask is not None else None
+
+    def get_config(self):
+        config = {'use_bias': self.use_bias}
+        base_config = super(TiedOutputEmbedding, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def tied_output_logits(hidden, embedding_matrix, embedding_dim, name='logits'):
+    ''' Logits through a `TiedOutputEmbedding`, with a linear projection first when the
+    hidden size differs from the embedding dimension
+    '''
+    if K.int_shape(hidden)[-1] != embedding_dim:
+        hidden = Dense(units=embedding_dim, activation='linear', name=name + '_projection')(hidden)
+    return TiedOutputEmbedding(name=name)([hidden, embedding_matrix])
+
+def find_output_layer(model, vocab_size):
+    ''' Last layer of `model` that projects to `vocab_size` logits (a Dense layer, possibly
+    wrapped in TimeDistributed, or a `TiedOutputEmbedding`) - returns the layer as called
+    and the inner layer
+    '''
+    for layer in reversed(model.layers):
+        inner = getattr(layer, 'layer', layer)
+        if isinstance(inner, Dense) and inner.units == vocab_size:
+            return layer, inner
+        if isinstance(inner, TiedOutputEmbedding) and inner.vocab_size == vocab_size:
+            return layer, inner
+    raise ValueError('No vocab-sized output layer found in model')
+
+def build_sampled_softmax_model(model, vocab_size, num_sampled, optimizer):
+    ''' Training twin of `model` that shares all its layers but is optimized with sampled
+    softmax over the output projection - `model` itself keeps the full softmax for evaluation
+    and decoding
+
+    Parameters
+    ----------
+    model : keras.models.Model
+        Model whose output is (batch, time, vocab_size) logits
+
+    vocab_size : int
+        Size of the output vocabulary
+
+    num_sampled : int
+        Number of negative classes sampled per batch
+
+    optimizer : keras.optimizers.Optimizer
+        Optimizer for the training twin
+
+    Returns
+    -------
+    train_model : keras.models.Model
+        Takes `model.inputs + [targets]`, has no outputs to fit against (use `y=None`)
+
+    '''
+
+    layer, dense = find_output_layer(model, vocab_size)
+    if isinstance(dense, TiedOutputEmbedding):
+        hidden, embedding_matrix = layer.get_input_at(0)
+        projection = K.transpose(embedding_matrix)
+    else:
+        hidden, projection = layer.get_input_at(0), dense.kernel
+    sampled_softmax = SampledSoftmax(num_sampled=num_sampled, num_classes=vocab_size, projection=projection,
+                                     bias=dense.bias if dense.use_bias else None, hidden_size=int(projection.shape[0]))
+
+    y_true = Input(shape=(None,), dtype='int32', name='sampled_softmax_targets')
+    loss = Lambda(lambda args: sampled_softmax.masked_loss(args[0], args[1]))([y_true, hidden])
+
+    train_model = Model(inputs=model.inputs + [y_true], outputs=loss)
+    train_model.add_loss([loss])
+    train_model.compile(optimizer, None)
+    return train_model
+
+def targets_as_inputs(generator):
+    ''' Adapt an (inputs, targets) batch generator to `build_sampled_softmax_model` models '''
+    for x, y in generator:
+        yield list(x) + [np.asarray(y)], None
+
+class GradientAccumulation(Optimizer):
+    def __init__(self, optimizer, accum_steps, n_tokens=None, **kwargs):
+        ''' Wraps an optimizer to sum gradients over `accum_steps` micro-batches and apply
+        one update with their mean - a large effective batch at micro-batch memory cost
+
+        Parameters
+        ----------
+        optimizer : str or keras.optimizers.Optimizer
+            Optimizer applying the accumulated update
+
+        accum_steps : int
+            Number of micro-batches per update
+
+        n_tokens : tf.Tensor
+            Scalar number of target tokens in the current micro-batch. When given, the loss
+            must be summed over tokens and the update is normalized by the tokens seen across
+            all micro-batches; otherwise the micro-batch losses are averaged
+
+        `clipnorm`/`clipvalue` of the wrapped optimizer (or of this wrapper) clip the
+        accumulated update, not the micro-batch gradients
+
+        '''
+        super(GradientAccumulation, self).__init__(**kwargs)
+        self.optimizer = optimizers.get(optimizer)
+        self.accum_steps = accum_steps
+        self.n_tokens = n_tokens
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+        # Learning-rate schedules/annealing act on the wrapped optimizer
+        self.lr = self.optimizer.lr
+
+    def _clip(self, grads):
+        # Same clipping as `Optimizer.get_gradients`, on the accumulated update
+        clipnorm = getattr(self.optimizer, 'clipnorm', 0) or getattr(self, 'clipnorm', 0)
+        clipvalue = getattr(self.optimizer, 'clipvalue', 0) or getattr(self, 'clipvalue', 0)
+        if clipnorm > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [optimizers.clip_norm(g, clipnorm, norm) for g in grads]
+        if clipvalue > 0:
+            grads = [K.clip(g, -clipvalue, clipvalue) for g in grads]
+        return grads
+
+    def get_updates(self, loss, params):
+        grads = K.gradients(loss, params)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. Please make sure that all of your ops have a '
+                             'gradient defined (i.e. are differentiable).')
+        n_tokens = K.constant(1.) if self.n_tokens is None else K.cast(self.n_tokens, 'float32')
+        with K.name_scope(self.__class__.__name__):
+            accum_grads = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+            accum_tokens = K.variable(0., name='accum_tokens')
+        self.weights = [self.iterations, accum_tokens] + accum_grads
+
+        # The wrapped optimizer only moves its weights/slots on the last micro-batch of an update
+        apply_update = K.equal((self.iterations + 1) % self.accum_steps, 0)
+        total_grads = [ag + g for ag, g in zip(accum_grads, grads)]
+        total_tokens = K.maximum(accum_tokens + n_tokens, 1.)
+
+        mean_grads = self._clip([g / total_tokens for g in total_grads])
+
+        # The backend update functions are swapped only while the wrapped optimizer builds its updates
+        update, update_add = K.update, K.update_add
+        self.optimizer.get_gradients = lambda loss, params: mean_grads
+        K.update = lambda x, new_x: update(x, K.switch(apply_update, new_x, x))
+        K.update_add = lambda x, increment: update_add(x, K.switch(apply_update, K.cast(increment, K.dtype(x)), K.zeros_like(x)))
+        try:
+            optimizer_updates = self.optimizer.get_updates(loss, params)
+        finally:
+            K.update, K.update_add = update, update_add
+            del self.optimizer.get_gradients
+
+        # Accumulators are reset only after the update has read them
+        with tf.control_dependencies(optimizer_updates):
+            accum_updates = [K.update(ag, K.switch(apply_update, K.zeros_like(ag), tg)) for ag, tg in zip(accum_grads, total_grads)]
+            accum_updates.append(K.update(accum_tokens, K.switch(apply_update, K.constant(0.), accum_tokens + n_tokens)))
+            accum_updates.append(K.update_add(self.iterations, 1))
+
+        self.updates = optimizer_updates + accum_updates
+        # Slots of the wrapped optimizer are saved/restored with the accumulators
+        self.weights += self.optimizer.weights
+        return self.updates
+
+    def get_config(self):
+        config = {'optimizer': optimizers.serialize(self.optimizer), 'accum_steps': self.accum_steps}
+        base_config = super(GradientAccumulation, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def token_sum_loss(y_true, logits, pad_id=0):
+    ''' Cross-entropy summed over non-padding target tokens, and the number of those tokens '''
+    y_true = K.cast(y_true, 'int32')
+    mask = K.cast(K.not_equal(y_true, pad_id), 'float32')
+    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y_true, logits=logits)
+    return K.sum(loss * mask), K.sum(mask)
+
+def build_accumulation_model(model, optimizer, accum_steps, pad_id=0):
+    ''' Training twin of `model` that accumulates gradients over `accum_steps` micro-batches,
+    with the loss normalized by the number of target tokens across them
+
+    Parameters
+    ----------
+    model : keras.models.Model
+        Model whose output is (batch, time, vocab_size) logits
+
+    optimizer : keras.optimizers.Optimizer
+        Optimizer applying the accumulated update
+
+    accum_steps : int
+        Number of micro-batches per update
+
+    Returns
+    -------
+    train_model : keras.models.Model
+        Takes `model.inputs + [targets]` (see `targets_as_inputs`), has no outputs to fit
+        against (use `y=None`). Its loss is the token sum, `token_loss` the per-token mean
+
+    '''
+
+    y_true = Input(shape=(None,), dtype='int32', name='accumulation_targets')
+    loss_sum, n_tokens = Lambda(lambda args: list(token_sum_loss(args[0], args[1], pad_id=pad_id)))([y_true, model.outputs[0]])
+
+    train_model = Model(inputs=model.inputs + [y_true], outputs=loss_sum)
+    train_model.add_loss([loss_sum])
+    train_model.compile(GradientAccumulation(optimizer, accum_steps, n_tokens=n_tokens), None)
+    train_model.metrics_names.append('token_loss')
+    train_model.metrics_tensors.append(loss_sum / K.maximum(n_tokens, 1.))
+    return train_model
+
+def compare_softmax_training(reset_model, train_steps, eval_fn, train_batches, valid_batches, n_steps=100,
+                             count_tokens=None):
+    ''' Train from the same initial weights with each loss and compare throughput and
+    full-softmax validation perplexity
+
+    Parameters
+    ----------
+    reset_model : keras.models.Model
+        Model holding every trained weight, restored to its initial weights before each run
+
+    train_steps : dict
+        Loss name -> callable taking one (inputs, targets) batch and running one update
+
+    eval_fn : callable
+        Takes one validation batch, returns its full-softmax loss
+
+    count_tokens : callable
+        Takes one training batch, returns its number of target tokens - defaults to the
+        non-padding entries of the batch targets
+
+    Returns
+    -------
+    report : dict
+        Tokens/sec and validation perplexity per loss
+
+    '''
+
+    if count_tokens is None:
+        count_tokens = lambda batch: int((np.asarray(batch[1]) != 0).sum())
+
+    init_weights = reset_model.get_weights()
+    report = {}
+    for name, step in train_steps.items():
+        # One untimed step builds the training function
+        reset_model.set_weights(init_weights)
+        step(train_batches[0])
+        reset_model.set_weights(init_weights)
+
+        n_tokens, start = 0, time.time()
+        for i in range(n_steps):
+            batch = train_batches[i % len(train_batches)]
+            step(batch)
+            n_tokens += count_tokens(batch)
+        elapsed = time.time() - start
+
+        valid_loss = float(np.mean([eval_fn(batch) for batch in valid_batches]))
+        report[name] = {'tokens_per_sec': n_tokens / elapsed, 'valid_loss': valid_loss, 'valid_prpl': float(np.exp(valid_loss))}
+
+    reset_model.set_weights(init_weights)
+    print('\nSOFTMAX TRAINING COMPARISON ({} steps)'.format(n_steps))
+    print('=' * 50)
+    for name, r in report.items():
+        print('{:<10} tokens/sec: {:10.1f} | valid loss: {:8.3f} | valid prpl: {:8.3f}'.format(
+            name, r['tokens_per_sec'], r['valid_loss'], r['valid_prpl']))
+    return report
+
+class QuantizedEmbedding(Embedding):
+    def __init__(self, input_dim, output_dim, quantize_mode='int8', **kwargs):
+        ''' Embedding table stored as int8 (one scale per row) or float16
+
+        Only the looked-up rows are de-quantized, so the full float32 table never
+        exists at inference time.
+
+        Parameters
+        ----------
+        quantize_mode : str, optional
+            `int8` or `float16` (the default is 'int8')
+
+        '''
+
+        self.quantize_mode = quantize_mode
+        kwargs['trainable'] = False
+        super(QuantizedEmbedding, self).__init__(input_dim, output_dim, **kwargs)
+
+    def build(self, input_shape):
+        dtype = 'int8' if self.quantize_mode == 'int8' else 'float16'
+        self.embeddings = self.add_weight(shape=(self.input_dim, self.output_dim), initializer='zeros',
+                                          name='embeddings', dtype=dtype, trainable=False)
+        if self.quantize_mode == 'int8':
+            self.scales = self.add_weight(shape=(self.input_dim,), initializer='ones', name='scales', trainable=False)
+        self.built = True
+
+    def call(self, inputs):
+        if K.dtype(inputs) != 'int32':
+            inputs = K.cast(inputs, 'int32')
+        out = K.cast(K.gather(self.embeddings, inputs), K.floatx())
+        if self.quantize_mode == 'int8':
+            out = out * K.expand_dims(K.gather(self.scales, inputs), -1)
+        return out
+
+    def set_float_weights(self, weights):
+        q_W, scales = quantize_matrix(weights[0], mode=self.quantize_mode, axis=1)
+        self.set_weights([q_W] if scales is None else [q_W, scales])
+
+    @classmethod
+    def from_layer(cls, layer, quantize_mode='int8'):
+        config = layer.get_config()
+        config['quantize_mode'] = quantize_mode
+        q_layer = cls.from_config(config)
+        q_layer.build(None)
+        q_layer.set_float_weights(layer.get_weights())
+        return q_layer
+
+    def get_config(self):
+        config = super(QuantizedEmbedding, self).get_config()
+        config['quantize_mode'] = self.quantize_mode
+        return config
+
+class QuantizedDense(Dense):
+    def __init__(self, units, quantize_mode='int8', **kwargs):
+        ''' Dense layer whose kernel is stored as int8 (one scale per output unit) or float16
+
+        For int8 the per-unit scale is applied after the matmul, `x.(q*s) = (x.q)*s`,
+        so de-quantizing costs a cast and one multiply over the output.
+
+        Parameters
+        ----------
+        quantize_mode : str, optional
+            `int8` or `float16` (the default is 'int8')
+
+        '''
+
+        self.quantize_mode = quantize_mode
+        kwargs['trainable'] = False
+        super(QuantizedDense, self).__init__(units, **kwargs)
+
+    def build(self, input_shape):
+        input_dim = input_shape[-1]
+        dtype = 'int8' if self.quantize_mode == 'int8' else 'float16'
+        self.kernel = self.add_weight(shape=(input_dim, self.units), initializer='zeros',
+                                      name='kernel', dtype=dtype, trainable=False)
+        if self.quantize_mode == 'int8':
+            self.scales = self.add_weight(shape=(self.units,), initializer='ones', name='scales', trainable=False)
+        if self.use_bias:
+            self.bias = self.add_weight(shape=(self.units,), initializer='zeros', name='bias', trainable=False)
+        else:
+            self.bias = None
+        self.input_spec = InputSpec(min_ndim=2, axes={-1: input_dim})
+        self.built = True
+
+    def call(self, inputs):
+        output = K.dot(inputs, K.cast(self.kernel, K.floatx()))
+        if self.quantize_mode == 'int8':
+            output = output * self.scales
+        if self.use_bias:
+            output = K.bias_add(output, self.bias)
+        if self.activation is not None:
+            output = self.activation(output)
+        return output
+
+    def set_float_weights(self, weights):
+        q_W, scales = quantize_matrix(weights[0], mode=self.quantize_mode, axis=0)
+        self.set_weights([q_W] + ([] if scales is None else [scales]) + list(weights[1:]))
+
+    @classmethod
+    def from_layer(cls, layer, quantize_mode='int8'):
+        config = layer.get_config()
+        config['quantize_mode'] = quantize_mode
+        q_layer = cls.from_config(config)
+        weights = layer.get_weights()
+        q_layer.build((None, weights[0].shape[0]))
+        q_layer.set_float_weights(weights)
+        return q_layer
+
+    def get_config(self):
+        config = super(QuantizedDense, self).get_config()
+        config['quantize_mode'] = self.quantize_mode
+        return config
+
+class QuantizedReusableEmbedding(QuantizedEmbedding):
+    ''' `ReusableEmbedding` stored quantized: outputs the de-quantized rows, the stored
+    table and, for int8, the per-row scales, so a `QuantizedTiedOutputEmbedding` reads
+    the one quantized table
+    '''
+
+    def call(self, inputs):
+        outputs = [super(QuantizedReusableEmbedding, self).call(inputs), K.identity(self.embeddings)]
+        if self.quantize_mode == 'int8':
+            outputs.append(K.identity(self.scales))
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        shapes = [super(QuantizedReusableEmbedding, self).compute_output_shape(input_shape), (self.input_dim, self.output_dim)]
+        return shapes + ([(self.input_dim,)] if self.quantize_mode == 'int8' else [])
+
+    def compute_mask(self, inputs, mask=None):
+        n_outputs = 3 if self.quantize_mode == 'int8' else 2
+        return [super(QuantizedReusableEmbedding, self).compute_mask(inputs, mask)] + [None] * (n_outputs - 1)
+
+class QuantizedTiedOutputEmbedding(TiedOutputEmbedding):
+    ''' `TiedOutputEmbedding` over a `QuantizedReusableEmbedding` table, called on
+    `[hidden, table]` (float16) or `[hidden, table, scales]` (int8). The per-row int8
+    scale is applied to the logits, `h.(q_v*s_v) = (h.q_v)*s_v`
+    '''
+
+    def call(self, inputs, mask=None):
+        hidden, table = inputs[0], inputs[1]
+        logits = K.dot(hidden, K.transpose(K.cast(table, K.floatx())))
+        if len(inputs) > 2:
+            logits = logits * inputs[2]
+        if self.use_bias:
+            logits = K.bias_add(logits, self.bias)
+        return logits
+
+def _vocab_dim(layer):
+    if isinstance(layer, TiedOutputEmbedding):
+        return layer.vocab_size
+    return layer.input_dim if isinstance(layer, Embedding) else layer.units
+
+def _quantized_class(layer):
+    for float_cls, q_cls in [(ReusableEmbedding, QuantizedReusableEmbedding), (TiedOutputEmbedding, QuantizedTiedOutputEmbedding),
+                             (Embedding, QuantizedEmbedding), (Dense, QuantizedDense)]:
+        if isinstance(layer, float_cls):
+            return q_cls
+
+def quantize_keras_model(model, quantize_mode='int8', vocab_size=None, custom_objects=None, release=False):
+    ''' Build an inference copy of a (compiled or loaded) Keras model whose vocabulary-sized
+    `Embedding` tables and `Dense` logits layers are stored quantized. A tied
+    `ReusableEmbedding`/`TiedOutputEmbedding` pair shares one quantized table
+
+    The model is rebuilt from its config with those layers' classes swapped for quantized
+    twins, and weights are copied over from host memory. With `release` the session is
+    cleared before rebuilding, so the float variables are freed and only the quantized copy
+    stays on the device; `model` (and every other graph of the session) is unusable after.
+
+    Parameters
+    ----------
+    model : keras.models.Model
+        Functional model with trained weights
+
+    quantize_mode : str, optional
+        `int8` or `float16` (the default is 'int8')
+
+    vocab_size : int, optional
+        Embeddings with `input_dim`, Dense layers with `units` and tied output layers with
+        `vocab_size` equal to this are quantized (the default is None, which takes the largest)
+
+    custom_objects : dict, optional
+        Custom layers/functions of `model` beyond the ones in this module (the default is None)
+
+    release : bool, optional
+        Free the float model's graph and variables, for deployment (the default is False,
+        keeping `model` usable, e.g. for comparisons)
+
+    Returns
+    -------
+    q_model : keras.models.Model
+        Quantized model, not compiled
+
+    q_weights : list
+        Weight arrays the quantized graph reads, for memory reporting
+
+    '''
+
+    candidates = [l for l in model.layers if isinstance(l, (Embedding, Dense, TiedOutputEmbedding))
+                  and not isinstance(l, (QuantizedEmbedding, QuantizedDense, QuantizedTiedOutputEmbedding))]
+    if vocab_size is None:
+        vocab_size = max(_vocab_dim(l) for l in candidates)
+    targets = [l for l in candidates if _vocab_dim(l) == vocab_size]
+    assert len(targets) > 0, 'No vocabulary-sized Embedding/Dense layers found'
+    q_classes = {l.name: _quantized_class(l) for l in targets}
+    reusable = {l.name for l in targets if isinstance(l, ReusableEmbedding)}
+
+    config = model.get_config()
+    for layer_config in config['layers']:
+        q_cls = q_classes.get(layer_config['name'])
+        if q_cls is None:
+            continue
+        layer_config['class_name'] = q_cls.__name__
+        if q_cls is QuantizedTiedOutputEmbedding:
+            if quantize_mode == 'int8':
+                # Also read the table's scales, output 2 of the embedding that feeds it the table
+                for node in layer_config['inbound_nodes']:
+                    node.extend([[name, node_index, 2, {}] for name, node_index, tensor_index, _ in node
+                                 if name in reusable and tensor_index == 1])
+        else:
+            layer_config['config']['quantize_mode'] = quantize_mode
+
+    # Host copies, the only float weights left once the session is cleared
+    float_weights = {l.name: l.get_weights() for l in model.layers}
+    if release:
+        K.get_session().close()
+        K.clear_session()
+
+    # Module-level names cover the globals Lambda functions are deserialized with
+    objects = {'tf': tf, 'K': K, 'np': np, 'LayerNormalization': LayerNormalization, 'ReusableEmbedding': ReusableEmbedding,
+               'TiedOutputEmbedding': TiedOutputEmbedding, 'QuantizedEmbedding': QuantizedEmbedding,
+               'QuantizedDense': QuantizedDense, 'QuantizedReusableEmbedding': QuantizedReusableEmbedding,
+               'QuantizedTiedOutputEmbedding': QuantizedTiedOutputEmbedding}
+    objects.update(custom_objects or {})
+    q_model = Model.from_config(config, custom_objects=objects)
+    for layer in q_model.layers:
+        weights = float_weights.pop(layer.name)
+        if hasattr(layer, 'set_float_weights'):
+            layer.set_float_weights(weights)
+        elif weights:
+            layer.set_weights(weights)
+
+    q_weights = [w for l in q_model.layers for w in l.get_weights()]
+    return q_model, q_weights
+
+def check_tied_quantization(vocab_size=500, embedding_dim=32, quantize_mode='int8', batch_size=8, seq_len=12):
+    ''' Quantize a small tied-embedding LM and check the shared table is stored once and
+    the logits stay close to the float model's
+
+    Returns
+    -------
+    report : dict
+        Number of stored tables, maximum absolute logits difference and top-1 agreement
+
+    '''
+
+    in_words = Input(shape=(None,))
+    embeddings, embedding_matrix = ReusableEmbedding(input_dim=vocab_size, output_dim=embedding_dim, mask_zero=True)(in_words)
+    hidden = LSTM(embedding_dim, return_sequences=True)(embeddings)
+    model = Model(inputs=in_words, outputs=tied_output_logits(hidden, embedding_matrix, embedding_dim))
+
+    x = np.random.randint(1, vocab_size, size=(batch_size, seq_len))
+    float_logits = model.predict_on_batch(x)
+    q_model, q_weights = quantize_keras_model(model, quantize_mode=quantize_mode, vocab_size=vocab_size)
+    q_logits = q_model.predict_on_batch(x)
+
+    report = {'n_tables': sum(1 for w in q_weights if w.shape == (vocab_size, embedding_dim)),
+              'max_abs_diff': float(np.abs(float_logits - q_logits).max()),
+              'top1_agreement': float((float_logits.argmax(-1) == q_logits.argmax(-1)).mean())}
+    print('\nTIED QUANTIZATION CHECK ({})'.format(quantize_mode))
+    print('=' * 50)
+    for k, v in report.items():
+        print('{}: {}'.format(k, v))
+    assert report['n_tables'] == 1, 'Tied table stored {} times'.format(report['n_tables'])
+    assert report['max_abs_diff'] <= 0.05 * np.abs(float_logits).max(), 'Quantized logits drifted from the float model'
+    return report
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
+
+class IncrementalDecoder(object):
+    def __init__(self, model, step_inputs=(0,)):
+        ''' One-token-at-a-time twin of a trained decoder that carries recurrent state between
+        steps instead of re-running the whole prefix
+
+        The graph of `model` is split at the inputs listed in `step_inputs` (the decoder token
+        ID's). Layers that don't depend on them (context encoders, initial-state projections)
+        run once per input in `start` and their outputs are cached; layers that do are re-applied
+        to a (batch, 1) token input, with every recurrent layer cloned with `return_state` and
+        fed its previous state. All weights are shared with (or copied from) `model`.
+
+        Parameters
+        ----------
+        model : keras.models.Model
+            Functional model with unidirectional recurrent decoder layers, outputs (batch, time, ...)
+
+        step_inputs : tuple, optional
+            Indices of the inputs fed one token per step (the default is (0,), e.g. a language model)
+
+        Raises
+        ------
+        ValueError
+            If a step-dependent layer can't be stepped (a nested model, recurrent constants or
+            an initial state that depends on the decoded tokens)
+
+        '''
+
+        self.model = model
+        self.step_indices = list(step_inputs)
+        self.context_inputs = [x for i, x in enumerate(model.inputs) if i not in self.step_indices]
+
+        # Every call of every layer in the model, inputs first (a shared layer, e.g. an embedding
+        # used by the encoder and the decoder, has a node per call)
+        nodes = [node for depth in sorted(model._nodes_by_depth, reverse=True) for node in model._nodes_by_depth[depth]
+                 if not isinstance(node.outbound_layer, InputLayer)]
+        stepped = set(id(model.inputs[i]) for i in self.step_indices)
+        step_nodes = []
+        for node in nodes:
+            if any(id(t) in stepped for t in node.input_tensors):
+                step_nodes.append(node)
+                stepped.update(id(t) for t in node.output_tensors)
+
+        # Step-independent tensors the stepped layers read, computed once in `start`
+        boundary, state_tensors, boundary_ids = [], [], set()
+        for node in step_nodes:
+            layer, node_inputs = node.outbound_layer, list(node.input_tensors)
+            if isinstance(layer, Model) or (isinstance(layer, Wrapper) and isinstance(layer.layer, (Model, RNN))):
+                raise ValueError('Cannot step nested layer {}'.format(layer.name))
+            if isinstance(layer, RNN):
+                if getattr(layer, '_num_constants', None) or layer.go_backwards:
+                    raise ValueError('Cannot step recurrent layer {}'.format(layer.name))
+                if any(id(t) in stepped for t in node_inputs[1:]):
+                    raise ValueError('Initial state of {} depends on the decoded tokens'.format(layer.name))
+                state_tensors.append(node_inputs[1:])
+                node_inputs = node_inputs[:1]
+            for t in node_inputs:
+                if id(t) not in stepped and id(t) not in boundary_ids:
+                    boundary.append(t)
+                    boundary_ids.add(id(t))
+        if any(id(t) not in stepped for t in model.outputs):
+            raise ValueError('Every model output must depend on the stepped inputs')
+
+        self.token_inputs = [Input(batch_shape=(None, 1) + K.int_shape(model.inputs[i])[2:], dtype=K.dtype(model.inputs[i]))
+                             for i in self.step_indices]
+        self.boundary_inputs = [Input(batch_shape=K.int_shape(t), dtype=K.dtype(t)) for t in boundary]
+        tensor_map = dict(zip([id(model.inputs[i]) for i in self.step_indices], self.token_inputs))
+        tensor_map.update(zip([id(t) for t in boundary], self.boundary_inputs))
+
+        self.state_inputs, self.state_outputs, self.state_sizes, initial_states = [], [], [], []
+        rnn_index = 0
+        for node in step_nodes:
+            layer = node.outbound_layer
+            node_inputs = [tensor_map[id(t)] for t in node.input_tensors if id(t) in tensor_map]
+            if isinstance(layer, RNN):
+                config = dict(layer.get_config(), return_sequences=True, return_state=True, stateful=False)
+                step_layer = layer.__class__.from_config(config)
+                sizes = layer.cell.state_size
+                sizes = list(sizes) if hasattr(sizes, '__len__') else [sizes]
+                states = [Input(shape=(size,)) for size in sizes]
+                outputs = step_layer(node_inputs[0], initial_state=states)
+                step_layer.set_weights(layer.get_weights())
+
+                self.state_inputs += states
+                self.state_outputs += outputs[1:]
+                self.state_sizes += sizes
+                # The original call's initial state tensors, or zeros
+                initial_states += state_tensors[rnn_index] or [None] * len(sizes)
+                rnn_index += 1
+                sequence = outputs[0] if layer.return_sequences else Lambda(lambda x: x[:, -1])(outputs[0])
+                outputs = [sequence] + (outputs[1:] if layer.return_state else [])
+            else:
+                outputs = layer(node_inputs[0] if len(node_inputs) == 1 else node_inputs, **(node.arguments or {}))
+            for t, step_t in zip(node.output_tensors, _as_list(outputs)):
+                tensor_map[id(t)] = step_t
+
+        self.output_tensors = [tensor_map[id(t)] for t in model.outputs]
+        self._initial_state_ix = [i for i, t in enumerate(initial_states) if t is not None]
+        self._start_fn = K.function(self.context_inputs, boundary + [initial_states[i] for i in self._initial_state_ix])
+        self._step_fn = None
+
+    @property
+    def inputs(self):
+        ''' Placeholders of one step: tokens, cached context, states (see `step_feed`) '''
+        return self.token_inputs + self.boundary_inputs + self.state_inputs
+
+    @property
+    def outputs(self):
+        ''' Tensors of one step: model outputs (batch, 1, ...) followed by the new states '''
+        return self.output_tensors + self.state_outputs
+
+    def start(self, context_inputs, batch_size=None):
+        ''' Cached context and initial states for a batch
+
+        Parameters
+        ----------
+        context_inputs : list
+            Arrays for the model inputs not listed in `step_inputs`, in model order
+
+        batch_size : int, optional
+            Batch size when there are no context inputs (the default is None, the length of
+            the first context input)
+
+        Returns
+        -------
+        context : list
+            Step-independent tensors read by the decoder
+
+        states : list
+            Initial recurrent states
+
+        '''
+
+        batch_size = len(context_inputs[0]) if batch_size is None else batch_size
+        values = self._start_fn(list(context_inputs)) if (self.boundary_inputs or self._initial_state_ix) else []
+        context = values[:len(self.boundary_inputs)]
+        states = [np.zeros((batch_size, size), dtype=K.floatx()) for size in self.state_sizes]
+        for i, value in zip(self._initial_state_ix, values[len(self.boundary_inputs):]):
+            states[i] = value
+        return context, states
+
+    def step_feed(self, tokens, context, states):
+        ''' Values for `inputs`, `tokens` as (batch,) or (batch, 1) '''
+        tokens = np.reshape(tokens, (-1, 1))
+        return [tokens] * len(self.token_inputs) + list(context) + list(states)
+
+    def step(self, tokens, context, states):
+        ''' Outputs of one step and the new states '''
+        if self._step_fn is None:
+            self._step_fn = K.function(self.inputs, self.outputs)
+        values = self._step_fn(self.step_feed(tokens, context, states))
+        return values[:len(self.output_tensors)], values[len(self.output_tensors):]
+
+
+if __name__ == '__main__':
+    import argparse, os
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', type=str, required=False, default='-1')
+    parser.add_argument('--batch_size', type=int, required=False, default=64)
+    parser.add_argument('--n_head', type=int, required=False, default=4)
+    parser.add_argument('--d_model', type=int, required=False, default=256)
+    parser.add_argument('--seq_lens', type=str, required=False, default='32,64,128,200,300')
+    parser.add_argument('--check_tied_quantize', action='store_true', help='Check quantization of tied embeddings instead')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    if args.check_tied_quantize:
+        for mode in ('int8', 'float16'):
+            check_tied_quantization(quantize_mode=mode)
+    else:
+        benchmark_attention(seq_lens=[int(l) for l in args.seq_lens.split(',')], batch_size=args.batch_size,
+                            n_head=args.n_head, d_model=args.d_model, d_k=args.d_model // args.n_head)
@@ -0,0 +1,150 @@
+import math
+import os
+
+import numpy as np
+
+
+def build_line_offsets(data_file:str, chunk_size:int=1 << 24):
+    """ Byte offset of the start of every line in `data_file`, found by scanning raw chunks
+    for newlines rather than decoding the file line by line
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(data_file, mode='rb') as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    # No line starts after a trailing newline
+    if len(offsets) > 1 and offsets[-1] == position:
+        offsets = offsets[:-1]
+    return offsets if position > 0 else offsets[:0]
+
+class LineIndex(object):
+    def __init__(self, data_file:str, cache:bool=True):
+        """ Line number -> byte offset for one corpus, so an iterator can seek straight to any
+        line. Built once and cached next to the corpus as `<data_file>.lineidx.npz`, rebuilt
+        when the file's size or modification time changes.
+
+        Arguments:
+            data_file {str} -- Local text corpus
+
+        Keyword Arguments:
+            cache {bool} -- Read/write the cached index (default: {True})
+        """
+        self.data_file = data_file
+        self.cache_path = data_file + '.lineidx.npz'
+        stat = os.stat(data_file)
+        self.file_size, mtime = stat.st_size, stat.st_mtime
+
+        self.offsets = None
+        if cache and os.path.exists(self.cache_path):
+            with np.load(self.cache_path) as data:
+                if int(data['file_size']) == self.file_size and float(data['mtime']) == mtime:
+                    self.offsets = data['offsets']
+        if self.offsets is None:
+            self.offsets = build_line_offsets(data_file)
+            if cache:
+                try:
+                    with open(self.cache_path, mode='wb') as outfile:
+                        np.savez(outfile, offsets=self.offsets, file_size=self.file_size, mtime=mtime)
+                except OSError:
+                    # Read-only corpus directory, keep the index in memory only
+                    pass
+
+    @property
+    def n_lines(self):
+        return len(self.offsets)
+
+    def offset(self, line_no:int):
+        """ Byte offset of line `line_no`, the file size past the last line """
+        return int(self.offsets[line_no]) if line_no < self.n_lines else self.file_size
+
+    def batch_state(self, n_batches:int, batch_size:int, seed:int=None, num_shards:int=1, shard_index:int=0, epoch:int=0):
+        """ Iterator state after `n_batches` batches of a generator that reads every
+        `num_shards`-th line from `shard_index`, starts over at the end of the file and yields
+        a last partial batch per pass. With shuffling, `line` is the position in the pass's
+        shuffled order and `pass` picks the permutation.
+
+        Returns:
+            dict -- `offset` and `line` of the next line to read, `pass` over the file, `batch`
+                    and the shuffle `seed`
+        """
+        shard_lines = max(int(math.ceil((self.n_lines - shard_index) / float(num_shards))), 0)
+        batches_per_pass = max(int(math.ceil(shard_lines / float(batch_size))), 1)
+        line_no = shard_index + (n_batches % batches_per_pass) * batch_size * num_shards
+        return {'offset': self.offset(line_no), 'line': line_no, 'pass': epoch + n_batches // batches_per_pass,
+                'batch': n_batches, 'seed': seed}
+
+def shuffled_lines(infile, index:LineIndex, seed:int, epoch:int, start:int=0, block_size:int=256, buffer_size:int=65536):
+    """ (position, decoded line) over the whole file in a shuffled order that only holds
+    `buffer_size` lines in memory
+
+    Lines are grouped into blocks of `block_size` consecutive lines, each read with one seek.
+    The block order is permuted, then every window of `buffer_size // block_size` blocks is
+    loaded and its lines permuted. Both permutations are seeded by (`seed`, `epoch`[, window]),
+    so a pass is reproducible and `start` skips whole windows without reading them.
+
+    Arguments:
+        infile -- Binary file object supporting `seek`
+        index {LineIndex} -- Line offsets of the file
+        seed {int} -- Shuffle seed
+        epoch {int} -- Pass over the file, each gets its own permutation
+
+    Keyword Arguments:
+        start {int} -- Position in the shuffled order to start from (default: {0})
+        block_size {int} -- Consecutive lines read per seek (default: {256})
+        buffer_size {int} -- Lines shuffled together in memory (default: {65536})
+    """
+    n_lines = index.n_lines
+    n_blocks = int(math.ceil(n_lines / float(block_size)))
+    block_order = np.random.RandomState([seed, epoch]).permutation(n_blocks)
+    block_lengths = np.minimum(block_size, n_lines - block_order * block_size)
+    blocks_per_window = max(buffer_size // block_size, 1)
+
+    position = 0
+    for window_start in range(0, n_blocks, blocks_per_window):
+        window_blocks = block_order[window_start: window_start + blocks_per_window]
+        n_window = int(block_lengths[window_start: window_start + blocks_per_window].sum())
+        if position + n_window <= start:
+            position += n_window
+            continue
+
+        lines = []
+        for block in window_blocks:
+            first, last = block * block_size, min((block + 1) * block_size, n_lines)
+            infile.seek(index.offset(first))
+            data = infile.read(index.offset(last) - index.offset(first))
+            lines.extend(data.split(b'\n')[: last - first])
+
+        order = np.random.RandomState([seed, epoch, window_start]).permutation(n_window)
+        skip = max(start - position, 0)
+        for i, line_ix in enumerate(order[skip:], position + skip):
+            yield i, lines[line_ix].decode('utf-8')
+        position += n_window
+
+def iterate_lines(infile, state:dict=None, epoch:int=0, index:LineIndex=None, shuffle_buffer:int=0,
+                  shuffle_block:int=256, seed:int=None):
+    """ (position, decoded line) for one pass over a binary file object, in file order or
+    shuffled when `shuffle_buffer` > 0 (needs `index`), from the start or from an iterator
+    `state` (see `LineIndex.batch_state`)
+    """
+    start = 0 if state is None else state['line']
+    if shuffle_buffer > 0:
+        epoch = epoch if state is None else state.get('pass', epoch)
+        return shuffled_lines(infile, index, 0 if seed is None else seed, epoch, start=start,
+                              block_size=shuffle_block, buffer_size=shuffle_buffer)
+    if state is not None:
+        infile.seek(state['offset'])
+    return read_lines(infile, start_line=start)
+
+def read_lines(infile, start_line:int=0):
+    """ (line number, decoded line) from a binary file object already positioned at the
+    start of line `start_line`. Binary reads keep `seek` valid while iterating.
+    """
+    for line_no, line in enumerate(infile, start_line):
+        yield line_no, line.decode('utf-8')
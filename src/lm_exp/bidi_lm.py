@@ -4,6 +4,7 @@ import numpy as np
 import os
 
 import sys
+import time
 import tensorflow as tf
 import utils
 
@@ -17,6 +18,12 @@ from keras.layers import Activation, Input, Dropout, Embedding, GRU, LSTM, Dense
 from keras.layers.merge import Concatenate
 from keras.layers.wrappers import Bidirectional, TimeDistributed
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from checkpointing import (CheckpointManager, TFCheckpointExport, restore_session, rng_state, session_snapshot, set_rng_state,
+                           skip_batches)
+from layer_utils import QuantizedEmbedding, QuantizedDense
+from quantization import compare_quantized
+
 
 class BidirectionalLM(object):
     def __init__(self, args, vocab, train_file, valid_file, model_name):
@@ -43,12 +50,27 @@ class BidirectionalLM(object):
         self.embedding_dropout = args.embedding_dropout_rate
         self.learning_rate = args.learning_rate
         self.opt_string = args.optimizer
+        # Pipelined training engine (`train_pipelined`): updates per `sess.run`, batches prefetched, log interval in steps
+        self.steps_per_call = getattr(args, 'steps_per_call', 50)
+        self.prefetch_batches = getattr(args, 'prefetch_batches', 8)
+        self.log_every = getattr(args, 'log_every', 500)
+        self.pipeline_iterator = None
+        # Run both directions as one batch through the projection, logits and sampled softmax
+        self.fused_bidirectional = getattr(args, 'fused_bidirectional', False)
+        # Background checkpointing at every `eval_thresh` validation and epoch end, resumable mid-epoch
+        self.checkpoint_dir = getattr(args, 'checkpoint_dir', None) or './checkpoints'
+        self.keep_checkpoints = getattr(args, 'keep_checkpoints', 3)
+        self.resume = getattr(args, 'resume', False)
         # self.visualize_gradients = args.visualize_gradients
         self._choose_optimizer()
         self.build_graph()
         self.compile()
         # self._tboard_setup()
         self.saver = tf.train.Saver()
+        # Same variables the Saver covers (optimizer slots included), in a fixed order
+        self.checkpoint_variables = tf.global_variables()
+        # `tf.train` checkpoints for `load`, written from the resume snapshots off the training thread
+        self.checkpoint_export = TFCheckpointExport(self.checkpoint_variables)
 
     def _set_eval_thresh(self):
         n_train_iters = self.num_train_examples // self.batch_size
@@ -73,9 +95,10 @@ class BidirectionalLM(object):
     def sparse_loss(self, y_true, y_pred, from_logits=True):
         return K.sparse_categorical_crossentropy(y_true, y_pred, from_logits)
 
-    def build_graph(self):
-        self._init_layers()
-        embedded = self.embedding_layer(self.input_seq)
+    def _encode(self, embedding_layer, input_seq=None):
+        """ Final forward and backward LSTM states - the backward ones in reversed time order """
+        input_seq = self.input_seq if input_seq is None else input_seq
+        embedded = embedding_layer(input_seq)
         embedded = self.embedding_dropout_layer(embedded)
         for layer_idx in list(range(len(self.fwd_layers)))[:-1]:
             fw_layer = self.fwd_layers[layer_idx]
@@ -94,41 +117,59 @@ class BidirectionalLM(object):
         # final_fw_context = Lambda(lambda x: x[:, :-2, :])(final_fw)
         # final_bw_context = Lambda(lambda x: x[:, 2:, :])(final_bw)
         # final_encoded_context = Concatenate(axis=-1)([final_fw_context, final_bw_context])
-
+        return final_fw, final_bw
+
+    def _joint_forward(self, embedding_layer, logits_layer, input_seq=None):
+        """ Forward and backward states stacked on the batch axis as [forward; backward], so the
+        projection and logits layers each run as one matmul. The two LSTM stacks have their own
+        weights and stay separate.
+        """
+        final_fw, final_bw = self._encode(embedding_layer, input_seq)
+        joint_projection = self.proj_layer(tf.concat([final_fw, final_bw], axis=0))
+        if logits_layer is None:
+            return joint_projection, None
+        return joint_projection, logits_layer(joint_projection)
+
+    def _forward(self, embedding_layer, logits_layer, input_seq=None):
+        if self.fused_bidirectional:
+            joint_projection, joint_logits = self._joint_forward(embedding_layer, logits_layer, input_seq)
+            fw_encoded_projection, bw_encoded_projection = tf.split(joint_projection, 2, axis=0)
+            if logits_layer is None:
+                return fw_encoded_projection, bw_encoded_projection, None, None
+            return (fw_encoded_projection, bw_encoded_projection) + tuple(tf.split(joint_logits, 2, axis=0))
+
+        final_fw, final_bw = self._encode(embedding_layer, input_seq)
         fw_encoded_projection = self.proj_layer(final_fw)
         bw_encoded_projection = self.proj_layer(final_bw)
+        if logits_layer is None:
+            return fw_encoded_projection, bw_encoded_projection, None, None
 
-        logits_fw = self.logits_layer(fw_encoded_projection)
-        logits_bw = self.logits_layer(bw_encoded_projection)
+        logits_fw = logits_layer(fw_encoded_projection)
+        logits_bw = logits_layer(bw_encoded_projection)
+        return fw_encoded_projection, bw_encoded_projection, logits_fw, logits_bw
 
-        self.W, self.b = self.logits_layer.weights[0], self.logits_layer.weights[-1]
+    def build_graph(self):
+        self._init_layers()
+        if self.fused_bidirectional:
+            self._build_fused_graph()
+        else:
+            fw_encoded_projection, bw_encoded_projection, logits_fw, logits_bw = self._forward(self.embedding_layer,
+                                                                                                self.logits_layer)
+            self.logits_fw, self.logits_bw = logits_fw, logits_bw
+            self.W, self.b = self.logits_layer.weights[0], self.logits_layer.weights[-1]
 
-        # Reshape input for sampled-softmax
-        # inputs_reshaped = tf.reshape(final_encoded_context, [-1, int(final_encoded_context.get_shape()[2])])
-        inputs_reshaped_fw = tf.reshape(fw_encoded_projection, [-1, int(fw_encoded_projection.get_shape()[2])])
-        inputs_reshaped_bw = tf.reshape(bw_encoded_projection, [-1, int(bw_encoded_projection.get_shape()[2])])
-        weights_reshaped = tf.transpose(self.W)
-        labels_reshaped_fw = tf.reshape(self.output_seq, [-1, 1])
-        labels_reshaped_bw = tf.reshape(self.output_seq_bw, [-1, 1])
-
-        # Set up training loss
-        # self.train_step_loss = tf.nn.sampled_softmax_loss(weights=weights_reshaped, biases=self.b, inputs=inputs_reshaped,
-        #                                                   labels=labels_reshaped, num_sampled=self.num_sampled, num_classes=self.vocab_size)
-        self.train_step_loss_fw = tf.nn.sampled_softmax_loss(weights=weights_reshaped, biases=self.b, inputs=inputs_reshaped_fw,
-                                                             labels=labels_reshaped_fw, num_sampled=self.num_sampled, num_classes=self.vocab_size)
-        self.train_step_loss_bw = tf.nn.sampled_softmax_loss(weights=weights_reshaped, biases=self.b, inputs=inputs_reshaped_bw,
-                                                             labels=labels_reshaped_bw, num_sampled=self.num_sampled, num_classes=self.vocab_size)
-        self.train_loss_fw = tf.reduce_mean(self.train_step_loss_fw)
-        self.train_loss_bw = tf.reduce_mean(self.train_step_loss_bw)
-        self.train_loss_joint = self.train_loss_fw + self.train_loss_bw
-        self.train_op = self.optimizer.minimize(self.train_loss_joint)
+            # Set up training loss
+            self.train_loss_fw, self.train_loss_bw = self._sampled_losses(fw_encoded_projection, bw_encoded_projection,
+                                                                          self.output_seq)
 
+            # self.valid_step_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq, logits=logits)
+            self.valid_step_loss_fw = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq, logits=logits_fw)
+            self.valid_step_loss_bw = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq_bw, logits=logits_bw)
+            self.valid_loss_fw = tf.reduce_mean(self.valid_step_loss_fw)
+            self.valid_loss_bw = tf.reduce_mean(self.valid_step_loss_bw)
 
-        # self.valid_step_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq, logits=logits)
-        self.valid_step_loss_fw = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq, logits=logits_fw)
-        self.valid_step_loss_bw = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.output_seq_bw, logits=logits_bw)
-        self.valid_loss_fw = tf.reduce_mean(self.valid_step_loss_fw)
-        self.valid_loss_bw = tf.reduce_mean(self.valid_step_loss_bw)
+        self.train_loss_joint = self.train_loss_fw + self.train_loss_bw
+        self.train_op = self.optimizer.minimize(self.train_loss_joint)
         self.valid_loss_joint = self.train_loss_fw + self.train_loss_bw
 
         # self.train_loss = tf.reduce_mean(self.train_step_loss)
@@ -140,6 +181,49 @@ class BidirectionalLM(object):
         # self.model.compile(loss=self.sparse_loss, optimizer=self.opt_string, target_tensors=[self.output_seq])
         # self.model.summary()
 
+    def _build_fused_graph(self):
+        """ `build_graph` with both directions batched together, see `_joint_forward` """
+        joint_projection, joint_logits = self._joint_forward(self.embedding_layer, self.logits_layer)
+        # Only computed when fetched, e.g. by `quantization_report`
+        self.logits_fw, self.logits_bw = tf.split(joint_logits, 2, axis=0)
+        self.W, self.b = self.logits_layer.weights[0], self.logits_layer.weights[-1]
+
+        self.train_loss_fw, self.train_loss_bw = self._fused_sampled_losses(joint_projection, self.output_seq)
+
+        joint_labels = tf.concat([self.output_seq, self.output_seq_bw], axis=0)
+        valid_step_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=joint_labels, logits=joint_logits)
+        self.valid_step_loss_fw, self.valid_step_loss_bw = tf.split(valid_step_loss, 2, axis=0)
+        self.valid_loss_fw = tf.reduce_mean(self.valid_step_loss_fw)
+        self.valid_loss_bw = tf.reduce_mean(self.valid_step_loss_bw)
+
+    def _fused_sampled_losses(self, joint_projection, output_seq):
+        """ Mean forward and backward sampled-softmax losses from a single `sampled_softmax_loss`
+        call over [forward; backward] states - one set of negative samples, drawn once per batch,
+        serves both directions
+        """
+        inputs_reshaped = tf.reshape(joint_projection, [-1, int(joint_projection.get_shape()[2])])
+        labels_reshaped = tf.reshape(tf.concat([output_seq, tf.reverse(output_seq, axis=[1])], axis=0), [-1, 1])
+
+        step_loss = tf.nn.sampled_softmax_loss(weights=tf.transpose(self.W), biases=self.b, inputs=inputs_reshaped,
+                                               labels=labels_reshaped, num_sampled=self.num_sampled, num_classes=self.vocab_size)
+        step_loss_fw, step_loss_bw = tf.split(step_loss, 2, axis=0)
+        return tf.reduce_mean(step_loss_fw), tf.reduce_mean(step_loss_bw)
+
+    def _sampled_losses(self, fw_encoded_projection, bw_encoded_projection, output_seq):
+        """ Mean forward and backward sampled-softmax losses """
+        # Reshape input for sampled-softmax
+        inputs_reshaped_fw = tf.reshape(fw_encoded_projection, [-1, int(fw_encoded_projection.get_shape()[2])])
+        inputs_reshaped_bw = tf.reshape(bw_encoded_projection, [-1, int(bw_encoded_projection.get_shape()[2])])
+        weights_reshaped = tf.transpose(self.W)
+        labels_reshaped_fw = tf.reshape(output_seq, [-1, 1])
+        labels_reshaped_bw = tf.reshape(tf.reverse(output_seq, axis=[1]), [-1, 1])
+
+        step_loss_fw = tf.nn.sampled_softmax_loss(weights=weights_reshaped, biases=self.b, inputs=inputs_reshaped_fw,
+                                                  labels=labels_reshaped_fw, num_sampled=self.num_sampled, num_classes=self.vocab_size)
+        step_loss_bw = tf.nn.sampled_softmax_loss(weights=weights_reshaped, biases=self.b, inputs=inputs_reshaped_bw,
+                                                  labels=labels_reshaped_bw, num_sampled=self.num_sampled, num_classes=self.vocab_size)
+        return tf.reduce_mean(step_loss_fw), tf.reduce_mean(step_loss_bw)
+
     def _choose_optimizer(self):
         assert self.opt_string in {'adagrad', 'adadelta', 'adam', 'sgd', 'momentum', 'rmsprop'}, 'Please select valid optimizer!'
 
@@ -176,16 +260,42 @@ class BidirectionalLM(object):
                                                                 self.output_seq: y})
         return valid_loss_
 
+    def _lm_data(self):
+        train_data = utils.LanguageModelData(data_file=self.train_file, vocab=self.vocab,
+                                             max_seq_len=self.seq_len, batch_size=self.batch_size)
+        valid_data = utils.LanguageModelData(data_file=self.valid_file, vocab=self.vocab,
+                                             max_seq_len=self.seq_len, batch_size=self.valid_batch_size)
+        return train_data, valid_data
+
+    def _checkpointing(self):
+        """ Checkpoint manager plus the (epoch, batch) to start from, restoring the latest
+        checkpoint's variables and RNG state when resuming
+        """
+        manager = CheckpointManager(self.checkpoint_dir, prefix=self.model_name, keep_last=self.keep_checkpoints, keep_best=1)
+        if not self.resume:
+            return manager, 0, 0
+
+        values, state = manager.latest()
+        if values is None:
+            return manager, 0, 0
+        restore_session(self.sess, self.checkpoint_variables, values)
+        set_rng_state(state['rng'])
+        print('Resuming from epoch {}, batch {}...'.format(state['epoch'] + 1, state['batch']))
+        return manager, state['epoch'], state['batch']
+
+    def _save_checkpoint(self, manager, epoch_state, n_batches, metric=None, ckpt_name='model.ckpt', save_path='./'):
+        """ Queue a resume snapshot and, built from it, the `tf.train` checkpoint read by `load` """
+        # Only the host copy happens here, both writes overlap with the next batches
+        manager.save(session_snapshot(self.sess, self.checkpoint_variables), state=dict(epoch_state, batch=n_batches), metric=metric,
+                     export=(save_path + ckpt_name, self.checkpoint_export))
+
     def train(self):
         np.random.seed(7)
-
+        manager, start_epoch, start_batch = self._checkpointing()
         n_train_iters = self.num_train_examples // self.batch_size
         n_valid_iters = self.num_val_examples // self.valid_batch_size
 
-        train_data = utils.LanguageModelData(data_file=self.train_file, vocab=self.vocab,
-                                             max_seq_len=self.seq_len, batch_size=self.batch_size)
-        valid_data = utils.LanguageModelData(data_file=self.valid_file, vocab=self.vocab,
-                                             max_seq_len=self.seq_len, batch_size=self.valid_batch_size)
+        train_data, valid_data = self._lm_data()
 
         # ckpt_fname = 'bidi_lm_{epoch:02d}-{val_loss:.2f}.h5'
         # ckpt = ModelCheckpoint(ckpt_fname, monitor='val_loss', verbose=1, save_best_only=True, mode='min')
@@ -193,19 +303,20 @@ class BidirectionalLM(object):
         #                         epochs=self.epochs, validation_data=valid_datagen, validation_steps=n_valid_iters,
         #                         callbacks=[ckpt])
 
-        for e in range(self.epochs):
-            train_datagen = train_data.generate_batches(mask=False)
+        for e in range(start_epoch, self.epochs):
+            epoch_state = {'epoch': e, 'rng': rng_state()}
+            train_datagen = skip_batches(train_data.generate_batches(mask=False), start_batch)
             valid_datagen = valid_data.generate_batches(mask=False)
 
             all_train_loss = 0
             batch_cnt = 0
             samples_cnt = 0
 
-            for train_iter in range(n_train_iters):
+            for train_iter in range(start_batch, n_train_iters):
                 x_batch, y_batch = next(train_datagen)
                 if (batch_cnt % self.eval_thresh == 0) and (batch_cnt > 0):
-                    self.evaluate(valid_generator=valid_datagen)
-                    self.save()
+                    valid_loss = self.evaluate(valid_generator=valid_datagen)
+                    self._save_checkpoint(manager, epoch_state, train_iter, metric=valid_loss)
 
                 loss_ = self._train_on_batch(x_batch, y_batch)
 
@@ -219,9 +330,142 @@ class BidirectionalLM(object):
             # Epoch summary metrics
             print('\n\nEPOCH {} METRICS'.format(e+1))
             print('=' * 60)
-            self.evaluate(valid_generator=valid_datagen, num_eval_examples=self.num_val_examples)
+            valid_loss = self.evaluate(valid_generator=valid_datagen, num_eval_examples=self.num_val_examples)
+            print('\n\n')
+            self._save_checkpoint(manager, {'epoch': e + 1, 'rng': rng_state()}, 0, metric=valid_loss,
+                                  ckpt_name='model_epoch{}.ckpt'.format(e+1))
+            start_batch = 0
+
+        manager.wait()
+
+    def _build_pipeline(self):
+        """ Training graph that reads batches from a prefetching tf.data iterator and runs
+        `steps_per_call` updates inside one `tf.while_loop`, so a `sess.run` costs neither a
+        feed_dict copy nor a Python round trip per step. Layers and optimizer slots are shared
+        with the feed_dict graph.
+        """
+        # The source generator is swapped in per epoch, re-initializing the iterator restarts it
+        dataset = tf.data.Dataset.from_generator(lambda: self._pipeline_source, output_types=(tf.int32, tf.int32),
+                                                 output_shapes=(tf.TensorShape([None, None]), tf.TensorShape([None, None])))
+        self.pipeline_iterator = tf.data.make_initializable_iterator(dataset.prefetch(self.prefetch_batches))
+        self.steps_per_call_ph = tf.placeholder_with_default(self.steps_per_call, shape=[], name='steps_per_call')
+
+        def train_step(step, loss_sum):
+            x, y = self.pipeline_iterator.get_next()
+            if self.fused_bidirectional:
+                joint_projection, _ = self._joint_forward(self.embedding_layer, None, input_seq=x)
+                loss_fw, loss_bw = self._fused_sampled_losses(joint_projection, y)
+            else:
+                fw_encoded_projection, bw_encoded_projection, _, _ = self._forward(self.embedding_layer, None, input_seq=x)
+                loss_fw, loss_bw = self._sampled_losses(fw_encoded_projection, bw_encoded_projection, y)
+            with tf.control_dependencies([self.optimizer.minimize(loss_fw + loss_bw)]):
+                return step + 1, loss_sum + loss_fw + loss_bw
+
+        _, loss_sum = tf.while_loop(lambda step, _: step < self.steps_per_call_ph, train_step, [tf.constant(0), tf.constant(0.)],
+                                    parallel_iterations=1, back_prop=False)
+        self.pipeline_train_loss = loss_sum / tf.cast(self.steps_per_call_ph, tf.float32)
+
+    def _start_pipeline(self, generator):
+        if self.pipeline_iterator is None:
+            self._build_pipeline()
+        self._pipeline_source = generator
+        self.sess.run(self.pipeline_iterator.initializer)
+
+    def _run_pipelined(self, n_steps, steps_per_call=None, valid_generator=None, checkpoint_fn=None):
+        """ Run `n_steps` updates from the started pipeline, logging every `log_every` steps and
+        validating every `eval_thresh` steps when given `valid_generator`, then calling
+        `checkpoint_fn(steps_done, valid_loss)` (default: `save`)
+
+        Returns:
+            float -- Steps/sec
+        """
+        steps_per_call = self.steps_per_call if steps_per_call is None else steps_per_call
+        step, all_train_loss = 0, 0.
+        next_log, next_eval = self.log_every, self.eval_thresh
+        start = time.time()
+        while step < n_steps:
+            k = min(steps_per_call, n_steps - step)
+            try:
+                loss_ = self.sess.run(self.pipeline_train_loss, feed_dict={self.steps_per_call_ph: k})
+            except tf.errors.OutOfRangeError:
+                print('\nTraining data exhausted after {} steps'.format(step))
+                break
+            step += k
+            all_train_loss += loss_ * k
+
+            if self.log_every > 0 and step >= next_log:
+                update_loss = all_train_loss / step
+                sys.stdout.write('\r num_samples_trained: {} \t|\t loss : {:8.3f} \t|\t prpl : {:8.3f} \t|\t steps/sec : {:6.2f}'.format(
+                                 step * self.batch_size, (update_loss / 2), (np.exp(update_loss / 2)), step / (time.time() - start)))
+                sys.stdout.flush()
+                next_log += self.log_every
+            if valid_generator is not None and self.eval_thresh > 0 and step >= next_eval:
+                valid_loss = self.evaluate(valid_generator=valid_generator)
+                if checkpoint_fn is None:
+                    self.save()
+                else:
+                    checkpoint_fn(step, valid_loss)
+                next_eval += self.eval_thresh
+
+        return step / (time.time() - start)
+
+    def train_pipelined(self):
+        """ Same schedule as `train`, run through the prefetching, `steps_per_call`-steps-per-run
+        engine built by `_build_pipeline`
+        """
+        np.random.seed(7)
+        manager, start_epoch, start_batch = self._checkpointing()
+        n_train_iters = self.num_train_examples // self.batch_size
+        train_data, valid_data = self._lm_data()
+
+        for e in range(start_epoch, self.epochs):
+            epoch_state = {'epoch': e, 'rng': rng_state()}
+            # The prefetch buffer runs ahead of training, so positions are counted in steps taken
+            checkpoint_fn = lambda step, valid_loss, offset=start_batch, state=epoch_state: \
+                self._save_checkpoint(manager, state, offset + step, metric=valid_loss)
+            valid_datagen = valid_data.generate_batches(mask=False)
+            self._start_pipeline(skip_batches(train_data.generate_batches(mask=False), start_batch))
+            steps_per_sec = self._run_pipelined(max(n_train_iters - start_batch, 1), valid_generator=valid_datagen,
+                                                checkpoint_fn=checkpoint_fn)
+
+            # Epoch summary metrics
+            print('\n\nEPOCH {} METRICS ({:.2f} steps/sec)'.format(e+1, steps_per_sec))
+            print('=' * 60)
+            valid_loss = self.evaluate(valid_generator=valid_datagen, num_eval_examples=self.num_val_examples)
             print('\n\n')
-            self.save(ckpt_name='model_epoch{}.ckpt'.format(e+1))
+            self._save_checkpoint(manager, {'epoch': e + 1, 'rng': rng_state()}, 0, metric=valid_loss,
+                                  ckpt_name='model_epoch{}.ckpt'.format(e+1))
+            start_batch = 0
+
+        manager.wait()
+
+    def training_speed_report(self, n_steps=200, steps_per_call=(1, 10, 50)):
+        """ Steps/sec of the feed_dict loop in `train` against the pipelined engine at each
+        `steps_per_call`. Every run trains the current weights, so use a fresh model.
+        """
+        train_data, _ = self._lm_data()
+
+        # feed_dict loop as in `train`, one untimed step first
+        train_datagen = train_data.generate_batches(mask=False)
+        self._train_on_batch(*next(train_datagen))
+        start = time.time()
+        for i in range(n_steps):
+            x_batch, y_batch = next(train_datagen)
+            loss_ = self._train_on_batch(x_batch, y_batch)
+            sys.stdout.write('\r step: {} \t|\t loss : {:8.3f}'.format(i, loss_ / 2))
+        report = {'feed_dict': n_steps / (time.time() - start)}
+
+        for k in steps_per_call:
+            self._start_pipeline(train_data.generate_batches(mask=False))
+            # Untimed call fills the prefetch buffer
+            self._run_pipelined(k, steps_per_call=k)
+            report['pipelined_k{}'.format(k)] = self._run_pipelined(n_steps, steps_per_call=k)
+
+        print('\n\nTRAINING LOOP COMPARISON ({} steps, batch {})'.format(n_steps, self.batch_size))
+        print('=' * 60)
+        for name, steps_per_sec in report.items():
+            print('{:<16} steps/sec: {:8.2f} | speed-up: {:5.2f}x'.format(name, steps_per_sec, steps_per_sec / report['feed_dict']))
+        return report
 
     def evaluate(self, valid_generator, num_eval_examples=10000):
         n_batch_iters = num_eval_examples // self.valid_batch_size
@@ -237,13 +481,57 @@ class BidirectionalLM(object):
 
         report_loss = total_val_loss / val_batch_cntr
         print('\nValidation metrics - loss: {:8.3f} | prpl: {:8.3f}\n'.format((report_loss / 2), (np.exp(report_loss / 2))))
+        return report_loss / 2
+
+    def quantize(self, quantize_mode='int8'):
+        """ Add an inference-only forward pass that reads int8/float16 copies of the embedding
+        table and logits layer - at 200k words these dwarf every other weight. The LSTM and
+        projection layers are shared with the float graph. Call after `load`.
+
+        Freezing `logits_fw_quantized`/`logits_bw_quantized` with `inference_utils.freeze_graph`
+        gives a graph that holds only the quantized tables.
+        """
+        self.quantize_mode = quantize_mode
+        self.q_embedding_layer = QuantizedEmbedding.from_layer(self.embedding_layer, quantize_mode=quantize_mode)
+        self.q_logits_layer = QuantizedDense.from_layer(self.logits_layer, quantize_mode=quantize_mode)
+        _, _, logits_fw, logits_bw = self._forward(self.q_embedding_layer, self.q_logits_layer)
+        self.logits_fw_q = tf.identity(logits_fw, name='logits_fw_quantized')
+        self.logits_bw_q = tf.identity(logits_bw, name='logits_bw_quantized')
+
+    def quantization_report(self, valid_generator, quantize_mode='int8', n_batches=20):
+        """ Memory, latency and joint forward/backward perplexity of the float model
+        against the quantized forward pass
+
+        Arguments:
+            valid_generator {generator} -- Yields (x, y) batches as in `train`
+        """
+        if getattr(self, 'quantize_mode', None) != quantize_mode:
+            self.quantize(quantize_mode)
+
+        def predict_fn(fetches):
+            def predict(x):
+                fw, bw = self.sess.run(fetches, feed_dict={self.input_seq: x})
+                return np.concatenate([fw, bw], axis=1)
+            return predict
+
+        batches = []
+        for _ in range(n_batches):
+            x, y = next(valid_generator)
+            # Backward LM predicts the reversed targets, see `output_seq_bw`
+            batches.append((x, np.concatenate([y, y[:, ::-1]], axis=1)))
+
+        shared_layers = [self.proj_layer] + self.fwd_layers + self.bwd_layers
+        float_weights = [w for l in shared_layers + [self.embedding_layer, self.logits_layer] for w in l.get_weights()]
+        quant_weights = [w for l in shared_layers + [self.q_embedding_layer, self.q_logits_layer] for w in l.get_weights()]
+        return compare_quantized(predict_fn([self.logits_fw, self.logits_bw]), predict_fn([self.logits_fw_q, self.logits_bw_q]),
+                                 batches, float_weights=float_weights, quant_weights=quant_weights, mode=quantize_mode)
 
     def save(self, save_path='./', ckpt_name='model.ckpt'):
         self.saver.save(self.sess, save_path + ckpt_name)
         print("Model saved to file:", save_path)
 
     def load(self, load_path='./', ckpt_name='model.ckpt'):
-        self.saver.restore(self.sess, save_path + ckpt_name)
+        self.saver.restore(self.sess, load_path + ckpt_name)
         print('Model restored.')
 
 
@@ -265,6 +553,13 @@ if __name__ == '__main__':
     parser.add_argument('--embedding_dropout', type=float, required=False, default=0.2)
     parser.add_argument('--learning_rate', type=float, required=False, default=0.01)
     parser.add_argument('--visualize_gradients', type=bool, required=False, default=False)
+    parser.add_argument('--steps_per_call', type=int, required=False, default=50, help='Training steps per session call in `train_pipelined`')
+    parser.add_argument('--prefetch_batches', type=int, required=False, default=8)
+    parser.add_argument('--fused_bidirectional', action='store_true', help='Batch both directions through projection/softmax')
+    parser.add_argument('--log_every', type=int, required=False, default=500, help='Log training loss every N steps, 0 = never')
+    parser.add_argument('--checkpoint_dir', type=str, required=False, default='./checkpoints')
+    parser.add_argument('--keep_checkpoints', type=int, required=False, default=3, help='Most recent checkpoints kept (plus the best)')
+    parser.add_argument('--resume', action='store_true', help='Resume from the latest checkpoint, mid-epoch included')
 
     args = parser.parse_args()
 
@@ -2,8 +2,10 @@ import argparse
 import json
 import os
 import sys
+import time
 
 sys.path.append('/home/kyle.shaffer/cakechat')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from cakechat.utils.dataset_loader import load_conditioned_dataset
 from cakechat.dialog_model.model_utils import get_training_batch
 
@@ -14,11 +16,17 @@ from keras.models import Model, load_model
 from keras.layers import Add, Lambda
 from keras.preprocessing.sequence import pad_sequences
 
+from layer_utils import IncrementalDecoder
+from metrics import StreamingMetrics, fusion_sweep_stats, log_softmax
+from shallow_fusion import beam_search, fused_log_probs, greedy_search
+
 
 class FuseModel(object):
     def __init__(self, s2s_path:str, lm_path:str):
         self.s2s_model = self._load_model(s2s_path)
         self.lm_model = self._load_model(lm_path)
+        self._decoders = None
+        self._step_fns = {}
         # self.fuse_model = self._build_fuse_model(s2s_model=self.s2s_model, lm_model=self.lm_model)
 
     def _train_loss(self, y_true, y_pred, from_logits=True):
@@ -82,48 +90,28 @@ class FuseModel(object):
 
                 yield [context_tokens_ids, input_response_tokens_ids, init_dec_hs], target_response_tokens_ids
 
-    def eval_loss(self, valid_data, batch_size=256, mode='s2s'):
+    def eval_loss(self, valid_data, batch_size=256, mode='s2s', steps=10, pad_id=0):
+        """ Token-level loss, perplexity and accuracy of the S2S model (`mode='s2s'`) or of
+        the LM on the response inputs over `steps` batches, computed on the predicted logits
+        in NumPy without adding anything to the graph
+
+        Returns:
+            dict -- `loss`, `prpl`, `accuracy` and `n_tokens`
+        """
         # S2S Loss = 4.036
         # LM Loss = 4.79
-
-        total_loss = 0
-        steps = 10
-
+        metrics = StreamingMetrics(pad_id=pad_id)
         datagen = self._get_batch_generator(input_data=(valid_data.x, valid_data.y), batch_size=batch_size)
 
-        if mode == 's2s':
-            print("EVALUATING S2S")
-            for i in range(steps):
-                x, y = next(datagen)
-                logits = self.s2s_model.predict_on_batch(x)
-                loss = K.eval(K.sparse_categorical_crossentropy(K.variable(y), K.variable(logits), from_logits=True))
-                batch_loss = 0
-
-                for row in loss:
-                    batch_loss += np.mean(row.squeeze())
-
-                total_loss += (batch_loss / row.shape[0])
-                
-            print('Loss:', total_loss / steps)
-        else:
-            print("EVALUATING LM")
-            for i in range(steps):
-                sys.stdout.write('\r {}...'.format(i))
-                x, y = next(datagen)
-                x_in = x[1]
-                # logits = self.lm_model.predict_on_batch(x_in)
-                # print(logits.shape)
-                # loss = K.eval(K.sparse_categorical_crossentropy(K.variable(y), K.variable(logits), from_logits=True))
-                # batch_loss = 0
-
-                # for row in loss:
-                #     batch_loss += np.mean(row.squeeze())
-
-                # total_loss += (batch_loss / row.shape[0])
-                batch_loss = self.lm_model.test_on_batch(x_in, y)
-                total_loss += batch_loss
+        print("EVALUATING {}".format(mode.upper()))
+        for i in range(steps):
+            sys.stdout.write('\r {}...'.format(i))
+            x, y = next(datagen)
+            logits = self.s2s_model.predict_on_batch(x) if mode == 's2s' else self.lm_model.predict_on_batch(x[1])
+            metrics.update(logits, y)
 
-            print('\nLoss:', total_loss / steps)
+        print('\nLoss: {:.4f} | prpl: {:.4f} | accuracy: {:.4f}'.format(metrics.loss, metrics.perplexity, metrics.accuracy))
+        return metrics.result()
 
     def combo_eval(self, lm_coef:float, valid_data, batch_size:int):
         combo_graph = self._build_fuse_model(s2s_model=self.s2s_model, lm_model=self.lm_model, lm_coef=lm_coef)
@@ -148,18 +136,188 @@ class FuseModel(object):
         return {'lm_coef': lm_coef, 'combined_loss': (total_loss_combined / n_valid_iters),
                 's2s_loss': (total_loss_s2s / n_valid_iters)}
 
+    def sweep_lm_coefs(self, lm_coefs:list, valid_data, batch_size:int, pad_id:int=0):
+        """ Score every LM coefficient in one pass over the validation set: each batch runs the
+        S2S model and the LM once, and their cached log-softmax outputs are fused for all
+        coefficients in NumPy (see `metrics.fusion_sweep_stats`). No fused graph is built.
+
+        Losses are means over non-padding tokens, not `combo_eval`'s mean of per-batch Keras
+        losses, so they are stored as `combined_token_loss`/`s2s_token_loss` rather than under
+        `combo_eval`'s `combined_loss`/`s2s_loss` keys; the two are not directly comparable.
+
+        Returns:
+            list -- One result per coefficient: `lm_coef`, `combined_token_loss`, `s2s_token_loss`,
+            `combined_prpl` and `combined_accuracy`
+        """
+        n_valid_iters = (valid_data.x.shape[0] // batch_size) + 1
+        print('No. validation iters:', n_valid_iters)
+        datagen = self._get_batch_generator(input_data=(valid_data.x, valid_data.y), batch_size=batch_size)
+
+        # Coefficient 0 is the S2S model alone
+        coefs = [0.] + list(lm_coefs)
+        loss_sums, n_correct, n_tokens = np.zeros(len(coefs)), np.zeros(len(coefs), dtype=np.int64), 0
+        start = time.time()
+        for i in range(n_valid_iters):
+            sys.stdout.write('\rEvaluating batch {}...'.format(i))
+            x, y = next(datagen)
+            s2s_log_probs = log_softmax(self.s2s_model.predict_on_batch(x))
+            lm_log_probs = log_softmax(self.lm_model.predict_on_batch(x[1]))
+            batch_losses, batch_tokens, batch_correct = fusion_sweep_stats(s2s_log_probs, lm_log_probs, y, coefs, pad_id=pad_id)
+            loss_sums += batch_losses
+            n_correct += batch_correct
+            n_tokens += batch_tokens
+        print('\nSwept {} coefficients in {:.1f}s'.format(len(lm_coefs), time.time() - start))
+
+        losses = loss_sums / max(n_tokens, 1)
+        return [{'lm_coef': float(coef), 'combined_token_loss': float(losses[k]), 's2s_token_loss': float(losses[0]),
+                 'combined_prpl': float(np.exp(losses[k])), 'combined_accuracy': float(n_correct[k]) / max(n_tokens, 1)}
+                for k, coef in enumerate(coefs) if k > 0]
+
+    def _fusion_decoders(self):
+        """ Incremental twins of the S2S model (stepping its response input) and the LM, built
+        once. The S2S graph is a third-party one; if it can't be split into an encoder and a
+        steppable decoder, `None` is returned for it and its prefix is re-run every step.
+        """
+        if self._decoders is None:
+            lm_decoder = IncrementalDecoder(self.lm_model, step_inputs=(0,))
+            try:
+                s2s_decoder = IncrementalDecoder(self.s2s_model, step_inputs=(1,))
+            except ValueError as e:
+                print('S2S model cannot be stepped ({}), re-running the response prefix every step'.format(e))
+                s2s_decoder = None
+            self._decoders = (s2s_decoder, lm_decoder)
+        return self._decoders
+
+    def _fusion_stepper(self, context_tokens_ids, lm_coef:float, use_lm:bool=True):
+        """ Stepper for `shallow_fusion.greedy_search`/`beam_search` over a batch of contexts,
+        scoring `log_softmax(s2s) + lm_coef * log_softmax(lm)`
+
+        The S2S context encoding and both models' recurrent states are cached per row and
+        gathered by the parent rows every step. Both models' next-token logits for all rows come
+        out of one session run, so the LM adds no extra round trip.
+        """
+        s2s_decoder, lm_decoder = self._fusion_decoders()
+        if use_lm not in self._step_fns:
+            if s2s_decoder is not None:
+                inputs, outputs = list(s2s_decoder.inputs), list(s2s_decoder.outputs)
+            else:
+                inputs, outputs = list(self.s2s_model.inputs), [self.s2s_model.output[:, -1:]]
+            if use_lm:
+                inputs += lm_decoder.inputs
+                outputs += lm_decoder.outputs
+            self._step_fns[use_lm] = K.function(inputs, outputs)
+        step_fn = self._step_fns[use_lm]
+
+        batch_size = context_tokens_ids.shape[0]
+        init_dec_hs = np.zeros((batch_size,) + K.int_shape(self.s2s_model.inputs[2])[1:], dtype=K.floatx())
+        cache = {'origin': np.arange(batch_size), 'prefix': np.zeros((batch_size, 0), dtype=np.int64), 's2s_states': [],
+                 'lm_states': lm_decoder.start([], batch_size=batch_size)[1]}
+        if s2s_decoder is not None:
+            s2s_context, cache['s2s_states'] = s2s_decoder.start([context_tokens_ids, init_dec_hs])
+
+        def step(tokens, parents):
+            origin = cache['origin'] = cache['origin'][parents]
+            if s2s_decoder is not None:
+                feed = s2s_decoder.step_feed(tokens, [c[origin] for c in s2s_context], [s[parents] for s in cache['s2s_states']])
+            else:
+                cache['prefix'] = np.concatenate([cache['prefix'][parents], np.reshape(tokens, (-1, 1))], axis=1)
+                feed = [context_tokens_ids[origin], cache['prefix'], init_dec_hs[origin]]
+            if use_lm:
+                feed += lm_decoder.step_feed(tokens, [], [s[parents] for s in cache['lm_states']])
+
+            values = step_fn(feed)
+            n_s2s = len(s2s_decoder.outputs) if s2s_decoder is not None else 1
+            s2s_values, lm_values = values[:n_s2s], values[n_s2s:]
+            if s2s_decoder is not None:
+                cache['s2s_states'] = s2s_values[len(s2s_decoder.output_tensors):]
+            if not use_lm:
+                return fused_log_probs(s2s_values[0][:, -1])
+            cache['lm_states'] = lm_values[len(lm_decoder.output_tensors):]
+            return fused_log_probs(s2s_values[0][:, -1], lm_values[0][:, -1], lm_coef)
+
+        return step
+
+    def fused_greedy_decode(self, context_tokens_ids, bos:int, eos:int, lm_coef:float, max_len:int=40, use_lm:bool=True):
+        """ Greedy shallow-fusion decoding of a batch of contexts
+
+        Arguments:
+            context_tokens_ids {np.ndarray} -- Contexts as fed to the S2S model
+            bos {int} -- `_start_` token ID
+            eos {int} -- `_end_` token ID
+            lm_coef {float} -- LM weight, as tuned with `sweep_lm_coefs`
+
+        Keyword Arguments:
+            max_len {int} -- Maximum response length (default: {40})
+            use_lm {bool} -- False decodes with the S2S model alone (default: {True})
+
+        Returns:
+            list -- Response token ID's per context
+        """
+        step = self._fusion_stepper(context_tokens_ids, lm_coef, use_lm=use_lm)
+        return greedy_search(step, context_tokens_ids.shape[0], bos, eos, max_len=max_len)
+
+    def fused_beam_decode(self, context_tokens_ids, bos:int, eos:int, lm_coef:float, beam_width:int=5, max_len:int=40,
+                          length_penalty:float=0., n_best:int=1, use_lm:bool=True):
+        """ Beam-search shallow-fusion decoding of a batch of contexts, every beam of every
+        context scored in one step (see `fused_greedy_decode` and `shallow_fusion.beam_search`)
+
+        Returns:
+            list -- Per context, `n_best` (response token ID's, fused log-probability) pairs
+        """
+        step = self._fusion_stepper(context_tokens_ids, lm_coef, use_lm=use_lm)
+        return beam_search(step, context_tokens_ids.shape[0], bos, eos, beam_width=beam_width, max_len=max_len,
+                           length_penalty=length_penalty, n_best=n_best)
+
+    def decoding_report(self, context_tokens_ids, bos:int, eos:int, lm_coef:float, beam_width:int=5, max_len:int=40,
+                        batch_size:int=64):
+        """ Latency of S2S-only vs. fused decoding (greedy and beam) over the same contexts
+
+        Returns:
+            dict -- Milliseconds per context for each decoder, and responses of the fused ones
+        """
+        decoders = [('s2s_greedy', lambda x: self.fused_greedy_decode(x, bos, eos, lm_coef, max_len=max_len, use_lm=False)),
+                    ('fused_greedy', lambda x: self.fused_greedy_decode(x, bos, eos, lm_coef, max_len=max_len)),
+                    ('s2s_beam', lambda x: [h[0][0] for h in self.fused_beam_decode(x, bos, eos, lm_coef, beam_width=beam_width,
+                                                                                   max_len=max_len, use_lm=False)]),
+                    ('fused_beam', lambda x: [h[0][0] for h in self.fused_beam_decode(x, bos, eos, lm_coef, beam_width=beam_width,
+                                                                                     max_len=max_len)])]
+        n_contexts = context_tokens_ids.shape[0]
+        # Builds the step functions outside of the timed runs
+        for _, decode in decoders:
+            decode(context_tokens_ids[:1])
+
+        report = {'lm_coef': lm_coef, 'beam_width': beam_width, 'n_contexts': n_contexts}
+        print('\nSHALLOW FUSION DECODING REPORT')
+        print('=' * 50)
+        for name, decode in decoders:
+            start = time.time()
+            responses = []
+            for i in range(0, n_contexts, batch_size):
+                responses += decode(context_tokens_ids[i: i + batch_size])
+            report[name + '_ms'] = 1000. * (time.time() - start) / max(n_contexts, 1)
+            report[name + '_responses'] = responses
+            print('{:<12} | {:8.2f} ms/context | mean length: {:5.2f}'.format(
+                name, report[name + '_ms'], np.mean([len(r) for r in responses])))
+        for mode in ['greedy', 'beam']:
+            print('{} fusion overhead: {:.2f}x'.format(mode, report['fused_' + mode + '_ms'] / max(report['s2s_' + mode + '_ms'], 1e-9)))
+        return report
+
     def debug_lm(self, valid_data, batch_size=256):
         total_loss = 0
         return
 
 
-def run_combo_eval(fuse_model, valid_data:tuple, batch_size:int, result_path:str, lm_coefs:list):
+def run_combo_eval(fuse_model, valid_data:tuple, batch_size:int, result_path:str, lm_coefs:list, sweep:bool=True):
     print('Running LM coef eval....')
-    result_container = []
-    for coef in lm_coefs:
-        print('Evaluating with coefficient:', coef)
-        result = fuse_model.combo_eval(lm_coef=coef, valid_data=valid_data, batch_size=batch_size)
-        result_container.append(result)
+    if sweep:
+        # One pass over the data for all coefficients, losses are per-token (see `sweep_lm_coefs`)
+        result_container = fuse_model.sweep_lm_coefs(lm_coefs=lm_coefs, valid_data=valid_data, batch_size=batch_size)
+    else:
+        result_container = []
+        for coef in lm_coefs:
+            print('Evaluating with coefficient:', coef)
+            result = fuse_model.combo_eval(lm_coef=coef, valid_data=valid_data, batch_size=batch_size)
+            result_container.append(result)
 
     with open(result_path, mode='w') as outfile:
         json.dump(result_container, outfile)
@@ -170,6 +328,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--batch_size', type=int, required=False, default=256)
     parser.add_argument('--gpu', type=int, required=False, default=0)
+    parser.add_argument('--no_sweep', action='store_true',
+                        help='Evaluate LM coefficients one fused graph at a time, writing combo_eval\'s per-batch losses')
+    parser.add_argument('--decode_coef', type=float, required=False, default=None,
+                        help='Compare S2S-only and shallow-fusion decoding latency with this LM coefficient instead')
+    parser.add_argument('--decode_contexts', type=int, required=False, default=256)
+    parser.add_argument('--beam_width', type=int, required=False, default=5)
     args = parser.parse_args()
     
     # from lm import load_cakechat_data_with_tok
@@ -221,6 +385,15 @@ if __name__ == '__main__':
     # loss = fuse_model.lm_model.evaluate(x_valid, y_valid, batch_size=128, verbose=1)
     # print(loss)
 
+    if args.decode_coef is not None:
+        contexts = valid_data.x[:args.decode_contexts]
+        report = fuse_model.decoding_report(contexts, bos=token_to_index['_start_'], eos=token_to_index['_end_'],
+                                            lm_coef=args.decode_coef, beam_width=args.beam_width)
+        for response in report['fused_beam_responses'][:5]:
+            print(' '.join(index_to_token[t] for t in response))
+        sys.exit(0)
+
     # RUN COEF SEARCH EVAL
     lm_coefs = [np.round(i, 2) for i in np.arange(0.1, 1.1, 0.1)]
-    run_combo_eval(fuse_model, valid_data=valid_data, batch_size=256, result_path='results/combo_eval.json', lm_coefs=lm_coefs)
+    run_combo_eval(fuse_model, valid_data=valid_data, batch_size=256, result_path='results/combo_eval.json', lm_coefs=lm_coefs,
+                   sweep=not args.no_sweep)
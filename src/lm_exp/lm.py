@@ -12,10 +12,15 @@ from keras.layers import Layer
 from keras.layers import Input, Dense, Dropout, Embedding, GRU, LSTM
 from keras.preprocessing.sequence import pad_sequences
 from keras.optimizers import SGD, Adagrad, Adam
-from keras.callbacks import ModelCheckpoint, LearningRateScheduler
+from keras.callbacks import Callback, ModelCheckpoint, LearningRateScheduler
 
 from pytorch_pretrained_bert import OpenAIGPTTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from layer_utils import (ReusableEmbedding, build_sampled_softmax_model, compare_softmax_training, quantize_keras_model,
+                         tied_output_logits)
+from quantization import compare_quantized
+
 """
 IDEAS
 1. Train on entire sequence of conversation to use LM score over entire convo.
@@ -100,10 +105,35 @@ class BahdanauAttention(K.tf.keras.Model):
         return context_vector, attention_weights
 
 
+class FullSoftmaxCheckpoint(Callback):
+    def __init__(self, eval_model, valid_data, filepath, batch_size):
+        """ Validate `eval_model` with the full softmax after every epoch of sampled-softmax training
+        and save it when `val_loss` improves - the sampled-loss model being fit is never saved
+        """
+        super(FullSoftmaxCheckpoint, self).__init__()
+        self.eval_model = eval_model
+        self.valid_data = valid_data
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.best = np.inf
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        x_valid, y_valid = self.valid_data
+        logs['val_loss'] = self.eval_model.evaluate(x_valid, y_valid, batch_size=self.batch_size, verbose=0)
+        print('\nval_loss (full softmax): {:.4f}'.format(logs['val_loss']))
+        if logs['val_loss'] < self.best:
+            self.best = logs['val_loss']
+            self.eval_model.save(self.filepath.format(epoch=epoch + 1, **logs))
+
 class LanguageModel(object):
-    def __init__(self, vocab_size, batch_size):
+    def __init__(self, vocab_size, batch_size, softmax='full', num_sampled=8192, tie_embeddings=False):
         self.vocab_size = vocab_size
         self.batch_size = batch_size
+        self.softmax = softmax
+        self.num_sampled = num_sampled
+        self.tie_embeddings = tie_embeddings
+        assert self.softmax in {'full', 'sampled'}, 'Softmax must be `full` or `sampled`!'
         self.embedding_dim = 300
         self.hidden_dim = 1024
         self.hidden_dense_dim = 400
@@ -113,17 +143,40 @@ class LanguageModel(object):
 
     def _build_model(self):
         in_words = Input(shape=(None,))
-        embeddings = Embedding(input_dim=self.vocab_size, output_dim=self.embedding_dim, mask_zero=True)(in_words)
+        if self.tie_embeddings:
+            embeddings, embedding_matrix = ReusableEmbedding(input_dim=self.vocab_size, output_dim=self.embedding_dim,
+                                                             mask_zero=True)(in_words)
+        else:
+            embeddings = Embedding(input_dim=self.vocab_size, output_dim=self.embedding_dim, mask_zero=True)(in_words)
         embeddings = Dropout(0.3)(embeddings)
         encoded_1 = self.rec_cell(units=self.hidden_dim, return_sequences=True)(embeddings)
         encoded_2 = self.rec_cell(units=self.hidden_dim, return_sequences=True)(encoded_1)
         dense_hidden = Dense(units=self.hidden_dense_dim, activation='relu')(encoded_2)
         dense_hidden = Dropout(0.2)(dense_hidden)
-        logits = Dense(units=self.vocab_size, activation='linear')(dense_hidden)
+        if self.tie_embeddings:
+            # Output scores are dot products with the input embedding table
+            logits = tied_output_logits(dense_hidden, embedding_matrix, self.embedding_dim)
+        else:
+            logits = Dense(units=self.vocab_size, activation='linear')(dense_hidden)
 
         lm = Model(inputs=in_words, outputs=logits)
         self.model = lm
 
+    def quantize(self, quantize_mode='int8'):
+        """ Replace `self.model` with a copy whose embedding table and logits layer are
+        stored as int8/float16. Inference only: the float model is released to free its memory.
+        """
+        self.model, self.quantized_weights = quantize_keras_model(self.model, quantize_mode=quantize_mode,
+                                                                  vocab_size=self.vocab_size, release=True)
+
+    def quantization_report(self, x_valid, y_valid, quantize_mode='int8', batch_size=256):
+        """ Memory/latency/perplexity of the float model against its quantized copy on held-out data """
+        # Both models have to stay alive for the comparison
+        q_model, q_weights = quantize_keras_model(self.model, quantize_mode=quantize_mode, vocab_size=self.vocab_size)
+        batches = [(x_valid[i:i+batch_size], y_valid[i:i+batch_size]) for i in range(0, len(x_valid), batch_size)]
+        return compare_quantized(self.model.predict_on_batch, q_model.predict_on_batch, batches,
+                                 float_weights=self.model.get_weights(), quant_weights=q_weights, mode=quantize_mode)
+
     def _loss(self, y_true, y_pred, from_logits=True):
         return K.sparse_categorical_crossentropy(y_true, y_pred, from_logits=from_logits)
 
@@ -139,15 +192,41 @@ class LanguageModel(object):
         if self.lr_schedule:
             print('Setting up step-based LR schedule...')
             opt = Adagrad()
-            lr_schedule = LearningRateScheduler(step_decay, verbose=1)
-            self.model.compile(optimizer=opt, loss=self._loss)
-            self.model.fit(x_train, y_train, validation_data=valid_data, batch_size=self.batch_size,
-                       epochs=n_epochs, callbacks=[ckpt, lr_schedule])
+            callbacks = [LearningRateScheduler(step_decay, verbose=1)]
         else:
             opt = 'adam'
-            self.model.compile(optimizer=opt, loss=self._loss)
+            callbacks = []
+        self.model.compile(optimizer=opt, loss=self._loss)
+
+        if self.softmax == 'sampled':
+            print('Training with sampled softmax over {} classes...'.format(self.num_sampled))
+            train_model = self._sampled_model(self.model.optimizer)
+            ckpt = FullSoftmaxCheckpoint(self.model, valid_data, ckpt_fname, batch_size=self.batch_size)
+            train_model.fit([x_train, y_train[..., 0]], None, batch_size=self.batch_size,
+                            epochs=n_epochs, callbacks=[ckpt] + callbacks)
+        else:
             self.model.fit(x_train, y_train, validation_data=valid_data, batch_size=self.batch_size,
-                       epochs=n_epochs, callbacks=[ckpt])
+                       epochs=n_epochs, callbacks=[ckpt] + callbacks)
+
+    def _sampled_model(self, optimizer):
+        return build_sampled_softmax_model(self.model, vocab_size=self.vocab_size, num_sampled=self.num_sampled,
+                                           optimizer=optimizer)
+
+    def softmax_report(self, train_data, valid_data, n_steps=100, n_valid_batches=20):
+        """ Throughput of full against sampled softmax training from the same initial weights,
+        and the full-softmax validation perplexity each reaches after `n_steps` updates
+        """
+        (x_train, y_train), (x_valid, y_valid) = train_data, valid_data
+        self.model.compile(optimizer=Adagrad(), loss=self._loss)
+        sampled_model = self._sampled_model(Adagrad())
+
+        bs = self.batch_size
+        train_batches = [(x_train[i:i+bs], y_train[i:i+bs]) for i in range(0, min(len(x_train), 50 * bs), bs)]
+        valid_batches = [(x_valid[i:i+bs], y_valid[i:i+bs]) for i in range(0, min(len(x_valid), n_valid_batches * bs), bs)]
+        train_steps = {'full': lambda batch: self.model.train_on_batch(batch[0], batch[1]),
+                       'sampled': lambda batch: sampled_model.train_on_batch([batch[0], batch[1][..., 0]], None)}
+        return compare_softmax_training(self.model, train_steps, lambda batch: self.model.test_on_batch(batch[0], batch[1]),
+                                        train_batches, valid_batches, n_steps=n_steps)
 
 if __name__ == '__main__':
     batch_size = 128
@@ -0,0 +1,124 @@
+import numpy as np
+
+
+def token_cross_entropy(logits, y_true):
+    """ Per-token cross-entropy from raw logits via log-sum-exp, and top-1 predictions
+
+    Arguments:
+        logits {np.ndarray} -- (..., vocab)
+        y_true {np.ndarray} -- Target ID's, (...) or (..., 1)
+
+    Returns:
+        tuple -- (cross-entropy (...), argmax predictions (...))
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    max_logits = logits.max(axis=-1, keepdims=True)
+    log_norm = np.log(np.exp(logits - max_logits).sum(axis=-1)) + max_logits[..., 0]
+    y_true = np.reshape(y_true, log_norm.shape).astype(np.int64)
+    true_logits = np.take_along_axis(logits, y_true[..., None], axis=-1)[..., 0]
+    return log_norm - true_logits, logits.argmax(axis=-1)
+
+def log_softmax(logits):
+    logits = np.asarray(logits, dtype=np.float32)
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+def fusion_sweep_stats(base_log_probs, lm_log_probs, y_true, coefs, pad_id=0):
+    """ Cross-entropy and accuracy of `base + coef * lm` fused scores for every coefficient
+    from one pair of cached log-softmax outputs. Adding logits or log-probabilities gives the
+    same softmax, so the log-probabilities of each model are computed once per batch.
+
+    Arguments:
+        base_log_probs {np.ndarray} -- Log-softmax of the base (S2S) model, (batch, time, vocab)
+        lm_log_probs {np.ndarray} -- Log-softmax of the LM, same shape
+        y_true {np.ndarray} -- Target ID's, (batch, time) or (batch, time, 1)
+        coefs {list} -- LM coefficients
+
+    Returns:
+        tuple -- (summed loss per coefficient, number of tokens, correct predictions per coefficient)
+    """
+    coefs = np.asarray(coefs, dtype=np.float32)
+    y_true = np.reshape(y_true, base_log_probs.shape[:-1]).astype(np.int64)
+    mask = y_true != pad_id
+    # Target scores of every coefficient at once, (coefs, batch, time)
+    base_true = np.take_along_axis(base_log_probs, y_true[..., None], axis=-1)[..., 0]
+    lm_true = np.take_along_axis(lm_log_probs, y_true[..., None], axis=-1)[..., 0]
+    true_scores = base_true[None] + coefs[:, None, None] * lm_true[None]
+
+    # The vocab-wide normalizer still needs a pass per coefficient, through one reused buffer
+    fused = np.empty_like(base_log_probs)
+    loss_sums, n_correct = np.zeros(len(coefs)), np.zeros(len(coefs), dtype=np.int64)
+    for k, coef in enumerate(coefs):
+        np.multiply(lm_log_probs, coef, out=fused)
+        fused += base_log_probs
+        argmax = fused.argmax(axis=-1)
+        max_scores = fused.max(axis=-1, keepdims=True)
+        fused -= max_scores
+        np.exp(fused, out=fused)
+        log_norm = np.log(fused.sum(axis=-1)) + max_scores[..., 0]
+        loss_sums[k] = (log_norm - true_scores[k])[mask].sum(dtype=np.float64)
+        n_correct[k] = ((argmax == y_true) & mask).sum()
+    return loss_sums, int(mask.sum()), n_correct
+
+def masked_cross_entropy(logits, y_true, pad_id=0):
+    """ Token-level cross-entropy and top-1 predictions from raw logits, skipping padding
+
+    Returns:
+        tuple -- (summed loss, number of tokens, argmax predictions)
+    """
+    loss, argmax = token_cross_entropy(logits, y_true)
+    mask = np.reshape(y_true, loss.shape) != pad_id
+    return float(loss[mask].sum(dtype=np.float64)), int(mask.sum()), argmax
+
+class StreamingMetrics(object):
+    def __init__(self, pad_id:int=0):
+        """ Token-level cross-entropy, perplexity and accuracy accumulated over batches of
+        NumPy logits. Only running sums are kept, so memory does not grow with the number of
+        batches and the result is the exact per-token mean rather than a mean of batch means.
+
+        Keyword Arguments:
+            pad_id {int} -- Target ID excluded from every metric (default: {0})
+        """
+        self.pad_id = pad_id
+        self.reset()
+
+    def reset(self):
+        self.loss_sum, self.n_tokens, self.n_correct = 0., 0, 0
+
+    def update(self, logits, y_true, mask=None):
+        """ Add one batch
+
+        Arguments:
+            logits {np.ndarray} -- (batch, time, vocab)
+            y_true {np.ndarray} -- (batch, time) or (batch, time, 1)
+
+        Keyword Arguments:
+            mask {np.ndarray} -- Tokens to count, default every non-padding target (default: {None})
+
+        Returns:
+            float -- Mean loss of this batch
+        """
+        loss, argmax = token_cross_entropy(logits, y_true)
+        y_true = np.reshape(y_true, loss.shape)
+        mask = (y_true != self.pad_id) if mask is None else np.reshape(mask, loss.shape).astype(bool)
+
+        batch_loss, batch_tokens = float(loss[mask].sum(dtype=np.float64)), int(mask.sum())
+        self.loss_sum += batch_loss
+        self.n_tokens += batch_tokens
+        self.n_correct += int(((argmax == y_true) & mask).sum())
+        return batch_loss / max(batch_tokens, 1)
+
+    @property
+    def loss(self):
+        return self.loss_sum / max(self.n_tokens, 1)
+
+    @property
+    def perplexity(self):
+        return float(np.exp(self.loss))
+
+    @property
+    def accuracy(self):
+        return float(self.n_correct) / max(self.n_tokens, 1)
+
+    def result(self):
+        return {'loss': self.loss, 'prpl': self.perplexity, 'accuracy': self.accuracy, 'n_tokens': self.n_tokens}
@@ -40,6 +40,8 @@ class ModelPredictor(object):
         self.x_ph = self.graph.get_tensor_by_name('lstm_chatbot/x_input:0')
         self.predictions= self.graph.get_tensor_by_name('lstm_chatbot/logits/MatMul:0')
         self.sess = tf.Session(graph=self.graph)
+        self.shortlist = None
+        self._shortlist_ops = {}
 
     def tokenize(self, input_sent, use_nltk=False):
         if use_nltk:
@@ -67,12 +69,61 @@ class ModelPredictor(object):
             output = self.sess.run(self.predictions, feed_dict={self.x_ph: src_seq})
         return
 
+    def enable_shortlist(self, shortlist):
+        """ Only compute logits for `shortlist.candidates(sentence)` plus the sentence's own
+        words - every other word gets -inf. Scores of in-sentence words are unchanged.
+
+        Arguments:
+            shortlist {shortlist.Shortlist} -- Candidate lists built from training data
+        """
+        self.shortlist = shortlist
+
+    def disable_shortlist(self):
+        self.shortlist = None
+
+    def _run_logits(self, logits_tensor, sent_ids):
+        """ Evaluate a `MatMul` logits tensor, over the full vocab or only the shortlisted
+        columns of its kernel
+        """
+        if self.shortlist is None:
+            return self.sess.run(logits_tensor, feed_dict={self.x_ph: sent_ids})
+
+        if logits_tensor.name not in self._shortlist_ops:
+            hidden, kernel = logits_tensor.op.inputs[0], logits_tensor.op.inputs[1]
+            with self.graph.as_default():
+                candidates_ph = tf.placeholder(dtype=tf.int32, shape=[None])
+                sub_logits = tf.matmul(hidden, tf.gather(kernel, candidates_ph, axis=1))
+            self._shortlist_ops[logits_tensor.name] = (candidates_ph, sub_logits, int(kernel.shape[1]))
+        candidates_ph, sub_logits, vocab_size = self._shortlist_ops[logits_tensor.name]
+
+        candidates = np.union1d(self.shortlist.candidates(sent_ids), sent_ids.ravel())
+        logits = self.sess.run(sub_logits, feed_dict={self.x_ph: sent_ids, candidates_ph: candidates})
+        full_logits = np.full((logits.shape[0], vocab_size), -np.inf, dtype=np.float32)
+        full_logits[:, candidates] = logits
+        return full_logits
+
+    def shortlist_report(self, sentences:list, shortlist):
+        """ Speed-up of shortlist scoring against the full vocabulary, and how often the
+        sentence scores agree to 3 decimal places
+        """
+        from shortlist import compare_decoding
+
+        def score(use_shortlist):
+            def fn(sent):
+                self.shortlist = shortlist if use_shortlist else None
+                return [round(float(self.score_sent(sent)), 3)]
+            return fn
+
+        report = compare_decoding(score(False), score(True), sentences)
+        self.shortlist = shortlist
+        return report
+
     def score_sent(self, sent, use_nltk=False, normalize_with_length=True):
         sent_ids = self.tokenize(sent, use_nltk=use_nltk)
         prediction_sent_ids = np.reshape(a=np.array(sent_ids), newshape=(1, len(sent_ids)))
 
-        logprobs_fw = self.sess.run(self.predictions_fw, feed_dict={self.x_ph: prediction_sent_ids})
-        logprobs_bw = np.flip(self.sess.run(self.predictions_bw, feed_dict={self.x_ph: prediction_sent_ids}), axis=0)
+        logprobs_fw = self._run_logits(self.predictions_fw, prediction_sent_ids)
+        logprobs_bw = np.flip(self._run_logits(self.predictions_bw, prediction_sent_ids), axis=0)
         print(logprobs_bw.shape)
 
         output_fw, output_bw = [], []
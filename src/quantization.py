@@ -0,0 +1,89 @@
+import time
+
+import numpy as np
+
+from metrics import masked_cross_entropy
+
+QUANTIZE_MODES = {'int8', 'float16'}
+
+
+def quantize_matrix(W, mode='int8', axis=1):
+    """ Quantize a weight matrix for storage
+
+    For `int8` every slice along `axis` gets its own symmetric scale, so a single
+    large-norm row (e.g. a frequent word's embedding) doesn't flatten the rest.
+
+    Arguments:
+        W {np.ndarray} -- Float weight matrix
+
+    Keyword Arguments:
+        mode {str} -- `int8` or `float16` (default: {'int8'})
+        axis {int} -- Axis reduced when computing scales - 1 gives one scale per row of an
+        embedding table, 0 gives one scale per output unit of a Dense kernel (default: {1})
+
+    Returns:
+        tuple -- (quantized values, float32 scales or None for float16)
+    """
+    assert mode in QUANTIZE_MODES, 'Quantize mode must be one of {}'.format(QUANTIZE_MODES)
+    W = np.asarray(W, dtype=np.float32)
+    if mode == 'float16':
+        return W.astype(np.float16), None
+
+    scales = np.maximum(np.abs(W).max(axis=axis), 1e-8) / 127.
+    q_W = np.clip(np.round(W / np.expand_dims(scales, axis)), -127, 127).astype(np.int8)
+    return q_W, scales.astype(np.float32)
+
+def dequantize_matrix(q_W, scales=None, axis=1):
+    if scales is None:
+        return q_W.astype(np.float32)
+    return q_W.astype(np.float32) * np.expand_dims(scales, axis)
+
+def weight_memory_mb(weights:list):
+    """ Bytes held by a list of weight arrays, in MB """
+    return sum(np.asarray(w).nbytes for w in weights) / 1e6
+
+def compare_quantized(float_predict, quant_predict, batches:list, float_weights:list, quant_weights:list,
+                      mode:str='int8', pad_id:int=0):
+    """ Memory, latency and validation loss/perplexity of a model against its quantized copy
+
+    Arguments:
+        float_predict {callable} -- Maps one batch of inputs to logits (batch, time, vocab)
+        quant_predict {callable} -- Same, for the quantized model
+        batches {list} -- List of (inputs, targets) validation batches
+        float_weights {list} -- Weight arrays of the original model
+        quant_weights {list} -- Weight arrays of the quantized model
+
+    Returns:
+        dict -- Report, also printed
+    """
+    stats = {}
+    for name, predict in [('float32', float_predict), (mode, quant_predict)]:
+        # First call builds the predict function, keep it out of the timings
+        predict(batches[0][0])
+        total_loss, total_tokens, elapsed, preds = 0., 0, 0., []
+        for x, y in batches:
+            start = time.time()
+            logits = predict(x)
+            elapsed += time.time() - start
+            loss, n_tokens, argmax = masked_cross_entropy(logits, y, pad_id=pad_id)
+            total_loss += loss
+            total_tokens += n_tokens
+            preds.append((argmax, np.reshape(y, argmax.shape) != pad_id))
+        mean_loss = total_loss / max(total_tokens, 1)
+        stats[name] = {'loss': mean_loss, 'prpl': float(np.exp(mean_loss)),
+                       'latency_ms': 1000 * elapsed / len(batches), 'preds': preds}
+
+    agree = sum(((f == q) & m).sum() for (f, m), (q, _) in zip(stats['float32']['preds'], stats[mode]['preds']))
+    n_tokens = sum(m.sum() for _, m in stats['float32']['preds'])
+
+    report = {'float32_mb': weight_memory_mb(float_weights), '{}_mb'.format(mode): weight_memory_mb(quant_weights),
+              'float32_latency_ms': stats['float32']['latency_ms'], '{}_latency_ms'.format(mode): stats[mode]['latency_ms'],
+              'float32_prpl': stats['float32']['prpl'], '{}_prpl'.format(mode): stats[mode]['prpl'],
+              'prpl_delta': stats[mode]['prpl'] - stats['float32']['prpl'],
+              'top1_agreement': float(agree) / max(n_tokens, 1)}
+
+    print('\nQUANTIZATION REPORT ({})'.format(mode))
+    print('=' * 50)
+    for k, v in report.items():
+        print('{}: {:.4f}'.format(k, v))
+    return report
@@ -5,8 +5,9 @@ import math
 import os
 import re
 import sys
+import tempfile
+import time
 
-from nltk.translate.bleu_score import sentence_bleu
 from subword_nmt.apply_bpe import BPE
 
 import keras.backend as K
@@ -22,6 +23,14 @@ from keras.optimizers import Adagrad, Adam, RMSprop, SGD
 
 from transformer import Transformer
 from attention import AttLayer
+from layer_utils import quantize_keras_model, build_sampled_softmax_model, targets_as_inputs, compare_softmax_training
+from layer_utils import ReusableEmbedding, TiedOutputEmbedding, tied_output_logits, build_accumulation_model
+from quantization import compare_quantized
+from dataset_manifest import example_count
+from metrics import StreamingMetrics
+from bleu_eval import bleu_report, greedy_decode_batch, parallel_decode
+from checkpointing import (CheckpointManager, KerasModelExport, PeriodicCheckpoint, keras_snapshot, restore_keras, rng_state,
+                           set_rng_state)
 from data_utils import *
 
 
@@ -38,8 +47,9 @@ class RNNSeq2Seq(Transformer):
         self.num_encoder_layers = args.num_encoder_layers
         self.num_decoder_layers = args.num_decoder_layers
         self.model_name = args.model_name
-        self.n_train_examples = args.n_train_examples
-        self.n_valid_examples = args.n_valid_examples
+        # Counted once from the corpus manifests unless given
+        self.n_train_examples = example_count(args.train_file, args.n_train_examples)
+        self.n_valid_examples = example_count(args.valid_file, args.n_valid_examples)
         self.train_file = args.train_file
         self.valid_file = args.valid_file
         self.n_epochs = args.n_epochs
@@ -47,14 +57,31 @@ class RNNSeq2Seq(Transformer):
         self.vocab = vocab
         self.inverse_vocab = {v: k for k, v in self.vocab.items()}
         self.vocab_size = len(self.vocab)
-        self.num_sampled = 20000
+        self.softmax = getattr(args, 'softmax', 'full')
+        self.num_sampled = getattr(args, 'num_sampled', 20000)
+        # Share one matrix between the encoder/decoder embedding and the output projection
+        self.tie_embeddings = getattr(args, 'tie_embeddings', False)
+        # Micro-batches whose gradients are summed into one update, effective batch = batch_size * grad_accum_steps
+        self.grad_accum_steps = getattr(args, 'grad_accum_steps', 1)
+        # Background checkpointing: directory (None = under the model dir), batches between snapshots (0 = per epoch only)
+        self.checkpoint_dir = getattr(args, 'checkpoint_dir', None)
+        self.checkpoint_every = getattr(args, 'checkpoint_every', 0)
+        self.keep_checkpoints = getattr(args, 'keep_checkpoints', 3)
+        self.resume = getattr(args, 'resume', False)
+        # Lines of training data shuffled together in memory (None = default buffer, 0 = file order)
+        self.shuffle_buffer = getattr(args, 'shuffle_buffer', None)
         self.eval_thresh = 500000
 
+        assert self.softmax in {'full', 'sampled'}, 'Softmax must be `full` or `sampled`!'
+        assert self.grad_accum_steps == 1 or self.softmax == 'full', 'Gradient accumulation needs the full softmax!'
         self._choose_optimizer()
         if (self.train_from == '') or (self.train_from is None):
             self.build_model()
+            self._build_train_model()
         else:
-            self.model = load_model(self.train_from, custom_objects={'sparse_loss': lambda x, y: K.sparse_categorical_crossentropy(x, y, True)})
+            self.model = load_model(self.train_from, custom_objects={'sparse_loss': lambda x, y: K.sparse_categorical_crossentropy(x, y, True),
+                                                                     'ReusableEmbedding': ReusableEmbedding,
+                                                                     'TiedOutputEmbedding': TiedOutputEmbedding})
             print('Model loaded from {}...'.format(self.train_from))
             print('Current learning rate: {}'.format(K.get_value(self.model.optimizer.lr)))
             orig_opt = self.model.optimizer
@@ -65,6 +92,7 @@ class RNNSeq2Seq(Transformer):
             decoder_target = tf.placeholder(dtype='int32', shape=[None, None])
             self.model.summary()
             self.model.compile(loss=self.sparse_loss, optimizer=orig_opt, target_tensors=[decoder_target])
+            self._build_train_model()
 
     def _choose_optimizer(self):
         assert self.opt_string in {'adagrad', 'adam', 'sgd', 'momentum', 'rmsprop'}, 'Please select valid optimizer!'
@@ -157,8 +185,12 @@ class RNNSeq2Seq(Transformer):
         decoder_target = tf.placeholder(dtype='int32', shape=[None, None])
         
         # Encoder
-        embedding_layer = Embedding(input_dim=self.vocab_size, output_dim=self.embedding_dim, mask_zero=True)
-        encoder_embedding = embedding_layer(encoder_in_layer)
+        if self.tie_embeddings:
+            embedding_layer = ReusableEmbedding(input_dim=self.vocab_size, output_dim=self.embedding_dim, mask_zero=True)
+            encoder_embedding, _ = embedding_layer(encoder_in_layer)
+        else:
+            embedding_layer = Embedding(input_dim=self.vocab_size, output_dim=self.embedding_dim, mask_zero=True)
+            encoder_embedding = embedding_layer(encoder_in_layer)
         encoder_embedding = Dropout(0.3)(encoder_embedding)
         encoder = LSTM(units=self.encoder_dim, return_state=True, return_sequences=True)
         encoder2 = LSTM(units=self.encoder_dim, return_state=True, return_sequences=True)
@@ -167,7 +199,10 @@ class RNNSeq2Seq(Transformer):
         encoder_states = [state_h, state_c]
 
         # Decoder
-        decoder_embedding = embedding_layer(decoder_in_layer)
+        if self.tie_embeddings:
+            decoder_embedding, embedding_matrix = embedding_layer(decoder_in_layer)
+        else:
+            decoder_embedding = embedding_layer(decoder_in_layer)
         decoder_embedding = Dropout(0.3)(decoder_embedding)
         decoder = LSTM(units=self.encoder_dim, return_sequences=True)
         decoder_outputs = decoder(decoder_embedding, initial_state=encoder_states)
@@ -179,7 +214,10 @@ class RNNSeq2Seq(Transformer):
         decoder_combined_context = Concatenate()([context, decoder_outputs])
         decoder_combined_context = Dropout(0.2)(decoder_combined_context)
 
-        decoder_logits = Dense(units=self.vocab_size, activation='linear')(decoder_outputs)
+        if self.tie_embeddings:
+            decoder_logits = tied_output_logits(decoder_outputs, embedding_matrix, self.embedding_dim)
+        else:
+            decoder_logits = Dense(units=self.vocab_size, activation='linear')(decoder_outputs)
 
         self.model = Model(inputs=[encoder_in_layer, decoder_in_layer], outputs=decoder_logits)
         self.model.compile(loss=self.sparse_loss, optimizer=self.optimizer, target_tensors=[decoder_target])
@@ -188,6 +226,56 @@ class RNNSeq2Seq(Transformer):
     def sparse_loss(self, y_true, y_pred):
         return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y_true, logits=y_pred, name='sparse_loss')
 
+    def _build_train_model(self):
+        """ Model that gets optimized - `self.model` itself for full softmax, otherwise a twin sharing
+        all its layers with a sampled-softmax or gradient-accumulation loss. `self.model` keeps the full
+        softmax for validation and decoding.
+        """
+        if self.softmax == 'sampled':
+            self.train_model = build_sampled_softmax_model(self.model, vocab_size=self.vocab_size,
+                                                           num_sampled=self.num_sampled, optimizer=self.model.optimizer)
+            print('Training with sampled softmax over {} classes...'.format(self.num_sampled))
+        elif self.grad_accum_steps > 1:
+            self.train_model = build_accumulation_model(self.model, optimizer=self.model.optimizer,
+                                                        accum_steps=self.grad_accum_steps)
+            print('Accumulating gradients over {} batches of {}...'.format(self.grad_accum_steps, self.batch_size))
+        else:
+            self.train_model = self.model
+
+    def _fit_epoch(self, train_datagen, valid_datagen, n_train_iters, n_valid_iters, callbacks=None):
+        """ Train for one epoch, return the full-softmax validation loss """
+        if self.train_model is self.model:
+            hist = self.model.fit_generator(generator=train_datagen, steps_per_epoch=n_train_iters, validation_data=valid_datagen,
+                                validation_steps=n_valid_iters, epochs=1, shuffle=False, callbacks=callbacks)
+            return sum(hist.history['val_loss']) / len(hist.history['val_loss'])
+
+        self.train_model.fit_generator(generator=targets_as_inputs(train_datagen), steps_per_epoch=n_train_iters,
+                                       epochs=1, shuffle=False, callbacks=callbacks)
+        val_loss = self.model.evaluate_generator(valid_datagen, steps=n_valid_iters)
+        print('val_loss (full softmax): {:.4f}'.format(val_loss))
+        return val_loss
+
+    def softmax_report(self, train_generator, valid_generator, n_steps=100, n_valid_batches=20):
+        """ Throughput of full against sampled softmax training from the same initial weights,
+        and the full-softmax validation perplexity each reaches after `n_steps` updates
+
+        Arguments:
+            train_generator {generator} -- Yields (inputs, targets) batches, e.g. `generate_s2s_batches(mode='train')`
+            valid_generator {generator} -- Same, for validation
+        """
+        if getattr(self, 'train_model', self.model) is self.model:
+            sampled_model = build_sampled_softmax_model(self.model, vocab_size=self.vocab_size, num_sampled=self.num_sampled,
+                                                        optimizer=self.model.optimizer.__class__(**self.model.optimizer.get_config()))
+        else:
+            sampled_model = self.train_model
+
+        train_batches = [next(train_generator) for _ in range(min(n_steps, 50))]
+        valid_batches = [next(valid_generator) for _ in range(n_valid_batches)]
+        train_steps = {'full': lambda batch: self.model.train_on_batch(batch[0], batch[1]),
+                       'sampled': lambda batch: sampled_model.train_on_batch(list(batch[0]) + [batch[1]], None)}
+        return compare_softmax_training(self.model, train_steps, lambda batch: self.model.test_on_batch(batch[0], batch[1]),
+                                        train_batches, valid_batches, n_steps=n_steps)
+
     def _train_on_batch(self, x_batch, y_in_batch, y_out_batch, length_batch):
         _, loss_ = self.sess.run([self.train_op, self.train_loss],
                                   feed_dict={self.encoder_in_layer: x_batch,
@@ -220,7 +308,8 @@ class RNNSeq2Seq(Transformer):
 
         s2s_processor = data_utils.S2SProcessing(train_file=self.train_file, valid_file=self.valid_file, vocab=self.vocab,
                                                  batch_size=self.batch_size, encoder_max_len=250, decoder_max_len=250,
-                                                 shuffle_batch=True, model_type='recurrent')
+                                                 shuffle_batch=True, model_type='recurrent', seed=7,
+                                                 shuffle_buffer=self.shuffle_buffer)
 
         if debug:
             print('TRAINING')
@@ -238,28 +327,53 @@ class RNNSeq2Seq(Transformer):
         min_lr = 1e-8
         lr_scale = 0.7
         best_loss = 99.
-        for e in range(self.n_epochs):
-            train_datagen = s2s_processor.generate_s2s_batches(mode='train')
+        # Checkpoints are written on a background thread, `resume` restarts from the latest one mid-epoch
+        manager = CheckpointManager(self.checkpoint_dir or os.path.join(model_dir, 'checkpoints'), prefix='rnn_s2s',
+                                    keep_last=self.keep_checkpoints, keep_best=1)
+        snapshot = lambda: keras_snapshot(self.model, optimizer=self.train_model.optimizer)
+        start_epoch, start_batch, data_state = 0, 0, None
+        if self.resume:
+            weights, state = manager.latest()
+            if weights is not None:
+                restore_keras(self.model, weights, optimizer=self.train_model.optimizer, train_model=self.train_model)
+                K.set_value(self.train_model.optimizer.lr, state['lr'])
+                set_rng_state(state['rng'])
+                start_epoch, start_batch, best_loss = state['epoch'], state['batch'], state['best_loss']
+                data_state = state.get('data')
+                if data_state is None and start_batch > 0:
+                    data_state = s2s_processor.iterator_state('train', start_batch, epoch=start_epoch)
+                print('Resuming from epoch {}, batch {}...'.format(start_epoch + 1, start_batch))
+
+        for e in range(start_epoch, self.n_epochs):
+            epoch_state = {'epoch': e, 'rng': rng_state(), 'best_loss': best_loss, 'lr': float(K.get_value(self.train_model.optimizer.lr))}
+            # A mid-epoch checkpoint's iterator state seeks straight to the next batch
+            train_datagen = s2s_processor.generate_s2s_batches(mode='train', state=data_state, epoch=e)
             valid_datagen = s2s_processor.generate_s2s_batches(mode='valid')
+            ckpt = PeriodicCheckpoint(manager, snapshot, self.checkpoint_every, epoch_state, start_batch=start_batch,
+                                      data_state_fn=lambda n, e=e: s2s_processor.iterator_state('train', n, epoch=e))
             # Train and validate for an epoch
-            hist = self.model.fit_generator(generator=train_datagen, steps_per_epoch=n_train_iters, validation_data=valid_datagen,
-                                validation_steps=n_valid_iters, epochs=1, shuffle=False)
+            val_loss = self._fit_epoch(train_datagen, valid_datagen, max(n_train_iters - start_batch, 1), n_valid_iters,
+                                       callbacks=[ckpt])
+            start_batch, data_state = 0, None
             # Optionally change learning rate if model does not improve
-            val_loss = sum(hist.history['val_loss']) / len(hist.history['val_loss'])
             if val_loss < best_loss:
                 best_loss = val_loss
-            elif K.get_value(self.model.optimizer.lr) <= min_lr:
+            elif K.get_value(self.train_model.optimizer.lr) <= min_lr:
                 print('Minimum LR reached - exiting training!')
                 break
             else:
                 print('Annealing learning rate...')
-                curr_lr = K.get_value(self.model.optimizer.lr)
+                curr_lr = K.get_value(self.train_model.optimizer.lr)
                 new_lr = curr_lr * lr_scale
                 print('Updating LR to:', new_lr)
-                K.set_value(self.model.optimizer.lr, new_lr)
+                K.set_value(self.train_model.optimizer.lr, new_lr)
             
-            # Save out model
-            self.model.save(os.path.join(model_dir, self.model_name.format(e+1, val_loss)))
+            # Queue the epoch checkpoint and, built from the same snapshot, the full model for `--train_from` /
+            # `load_trained_model` - both writes overlap with decoding and the next epoch
+            export = KerasModelExport(self.model, optimizer=self.train_model.optimizer)
+            manager.save(snapshot(), metric=val_loss, state={'epoch': e + 1, 'batch': 0, 'rng': rng_state(), 'best_loss': best_loss,
+                                                            'lr': float(K.get_value(self.train_model.optimizer.lr))},
+                         export=(os.path.join(model_dir, self.model_name.format(e+1, val_loss)), export))
 
             # Look at qualitative output
             print('Testing input sentences...')
@@ -269,24 +383,62 @@ class RNNSeq2Seq(Transformer):
                 print('==>', response)
                 print()
 
+        manager.wait()
         print('DONE TRAINING')
         return
 
     def evaluate(self, valid_generator, num_eval_examples=10000):
-        n_batch_iters = num_eval_examples // self.batch_size
-        total_val_loss = 0
-        val_batch_cntr = 0
+        """ Token-level validation loss, perplexity and accuracy from the logits model over
+        `num_eval_examples` examples of `generate_s2s_batches(mode='valid')`
+
+        Returns:
+            dict -- `loss`, `prpl`, `accuracy` and `n_tokens`
+        """
+        n_batch_iters = max(num_eval_examples // self.batch_size, 1)
+        metrics = StreamingMetrics(pad_id=self.vocab['<PAD>'])
         print('\n\nvalidating')
         for i in range(n_batch_iters):
-            print('=', end='', flush=True)
-            val_batch_cntr += 1
-            x_val_batch, y_in_val_batch, y_out_val_batch, length_batch = next(valid_generator)
-            valid_loss_ = self._eval_on_batch(x=x_val_batch, y_in=y_in_val_batch, y_out=y_out_val_batch, length_batch=length_batch)
-            total_val_loss += valid_loss_
-
-        report_loss = total_val_loss / val_batch_cntr
-        print('\nValidation metrics - loss: {:8.3f} | prpl: {:8.3f}\n'.format(report_loss, np.exp(report_loss)))
-        return report_loss
+            x_val_batch, y_val_batch = next(valid_generator)
+            metrics.update(self.model.predict_on_batch(x_val_batch), y_val_batch)
+
+        print('\nValidation metrics - loss: {:8.3f} | prpl: {:8.3f} | accuracy: {:6.3f}\n'.format(
+              metrics.loss, metrics.perplexity, metrics.accuracy))
+        return metrics.result()
+
+    def quantize(self, quantize_mode='int8'):
+        """ Swap `self.model` for a copy with int8/float16 vocab-sized embeddings and logits,
+        used by every decode method from here on. Inference only: the float model and the
+        training graph are released to free their memory.
+        """
+        self.model, self.quantized_weights = quantize_keras_model(self.model, quantize_mode=quantize_mode,
+                                                                  vocab_size=self.vocab_size,
+                                                                  custom_objects={'AttLayer': AttLayer}, release=True)
+        self.train_model = None
+        print('Model quantized to {}...'.format(quantize_mode))
+
+    def quantization_report(self, valid_generator, quantize_mode='int8', n_batches=20):
+        """ Compare weight memory, predict latency and validation perplexity of the
+        float model against its quantized copy
+
+        Arguments:
+            valid_generator {generator} -- Yields (inputs, targets) batches, e.g. `generate_s2s_batches(mode='valid')`
+
+        Keyword Arguments:
+            quantize_mode {str} -- `int8` or `float16` (default: {'int8'})
+            n_batches {int} -- Number of validation batches to score (default: {20})
+        """
+        batches = [next(valid_generator) for _ in range(n_batches)]
+        # Both models have to stay alive for the comparison
+        q_model, q_weights = quantize_keras_model(self.model, quantize_mode=quantize_mode, vocab_size=self.vocab_size,
+                                                  custom_objects={'AttLayer': AttLayer})
+        return compare_quantized(self.model.predict_on_batch, q_model.predict_on_batch, batches,
+                                 float_weights=self.model.get_weights(), quant_weights=q_weights, mode=quantize_mode)
+
+    def _decode_model(self):
+        return self.model
+
+    def shortlist_report(self, sentences:list, shortlist, decode_fn=None):
+        return super(RNNSeq2Seq, self).shortlist_report(sentences, shortlist, decode_fn=decode_fn or self.greedy_decode)
 
     def greedy_decode(self, input_seq:list, delimiter='', model_type='rnn'):
         stop_tok = self.vocab['</s>']
@@ -296,6 +448,7 @@ class RNNSeq2Seq(Transformer):
         input_seq.insert(0, '<s>')
         src_seq = np.asarray([self.vocab[w] if w in self.vocab.keys() else self.vocab['<UNK>'] for w in input_seq])
         src_seq = np.reshape(a=src_seq, newshape=(1, len(src_seq)))
+        restricted = self._restrict_vocab(src_seq)
 
         # Set up decoder input data
         decoded_tokens = []
@@ -306,8 +459,7 @@ class RNNSeq2Seq(Transformer):
         print('Generating output...')
         for i in range(len_limit - 1):
             print('=', end='', flush=True)
-            output = self.model.predict_on_batch([src_seq, target_seq])
-            sampled_index = np.argmax(output[0, i, :])
+            sampled_index = self._next_token([src_seq, target_seq], i, restricted)
             if sampled_index == stop_tok:
                 break
             decoded_tokens.append(self.inverse_vocab[int(sampled_index)])
@@ -328,8 +480,9 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
         self.num_encoder_layers = args.num_encoder_layers
         self.num_decoder_layers = args.num_decoder_layers
         self.model_name = 'bpe_lstm_context_chatbot_epoch{:02d}_loss{:.3f}.h5' # args.model_name
-        self.n_train_examples = args.n_train_examples
-        self.n_valid_examples = args.n_valid_examples
+        # Counted once from the corpus manifests unless given
+        self.n_train_examples = example_count(args.train_file, args.n_train_examples)
+        self.n_valid_examples = example_count(args.valid_file, args.n_valid_examples)
         self.train_file = args.train_file
         self.valid_file = args.valid_file
         self.n_epochs = args.n_epochs
@@ -339,6 +492,7 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
         self.vocab_size = len(self.vocab)
         self.num_sampled = 20000
         self.eval_thresh = 500000
+        self.shuffle_buffer = getattr(args, 'shuffle_buffer', None)
         self._choose_optimizer()
         self._log_params()
         self.build_model()
@@ -357,9 +511,8 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
         print()
 
     def load_trained_model(self, model_path):
-        from attention import DummyAttLayer
         self.model = load_model(model_path, custom_objects={'sparse_loss': self.sparse_loss,
-                                                            'AttLayer': DummyAttLayer})
+                                                            'AttLayer': AttLayer})
         print('Model loaded...')
 
     def masked_loss(self, y_true, y_hat):
@@ -489,11 +642,14 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
 
         han_s2s_processing = HanS2SProcessing(train_file=self.train_file, valid_file=self.valid_file, vocab=self.vocab,
                                               batch_size=self.batch_size, encoder_max_len=150, decoder_max_len=150,
-                                              shuffle_batch=False, model_type=model_type)
+                                              shuffle_batch=False, model_type=model_type, seed=7,
+                                              shuffle_buffer=self.shuffle_buffer)
 
         min_lr = 1e-8
         lr_scale = 0.6
         best_loss = 99.
+        # Only the host copy of the weights happens on this thread, model files are written in the background
+        exporter = CheckpointManager(os.path.join(model_dir, 'checkpoints'), prefix='han_s2s')
         
         train_datagen = han_s2s_processing.generate_s2s_batches(mode='train')
         valid_datagen = han_s2s_processing.generate_s2s_batches(mode='valid')
@@ -515,8 +671,9 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
                 print('Updating LR to:', new_lr)
                 K.set_value(self.model.optimizer.lr, new_lr)
             
-            # Save out model
-            self.model.save(os.path.join(model_dir, self.model_name.format(e+1, val_loss)))
+            # Save out model, written in the background while decoding and the next epoch run
+            exporter.export(keras_snapshot(self.model), os.path.join(model_dir, self.model_name.format(e+1, val_loss)),
+                            KerasModelExport(self.model, optimizer=self.model.optimizer))
             
             # Get sample BLEU score
             # self.get_bleu_score(bleu_datagen)
@@ -538,55 +695,50 @@ class HanRnnSeq2Seq(RNNSeq2Seq):
             # print('====== FINISHED EPOCH {} ======'.format(e + 1))
             # print()
 
+        exporter.wait()
         print('DONE TRAINING')
         return
 
-    def get_bleu_score(self, valid_datagen, num_batches=10):
-        # Loop through and report BLEU score on sample of validations set
-        print('Calculating sapled BLEU score...')
-        BLEU = 0
-        len_limit = 250
+    def get_bleu_score(self, valid_datagen, num_batches=10, len_limit=250, n_processes=0, model_path=None):
+        """ Corpus BLEU of batched greedy decoding over `num_batches` validation batches
+
+        Arguments:
+            valid_datagen {generator} -- `HanS2SProcessing.generate_s2s_batches(mode='valid')` with `model_type='recurrent'`
+
+        Keyword Arguments:
+            num_batches {int} -- Validation batches to decode (default: {10})
+            len_limit {int} -- Maximum decoded length (default: {250})
+            n_processes {int} -- Decode on this many CPU model replicas, 0 = in this process (default: {0})
+            model_path {str} -- Saved model for the replicas, the current model is saved if not given (default: {None})
+
+        Returns:
+            dict -- BLEU, n-gram precisions and sentences/sec, also printed
+        """
+        print('Calculating sampled BLEU score...')
         bos, eos, pad = self.vocab['<s>'], self.vocab['</s>'], self.vocab['<PAD>']
-        skip_toks = {bos, eos}
+        skip_toks = {bos, eos, pad}
 
-        sent_count = 0
-        # Loop over eval batches
+        batches, references = [], []
         for _ in range(num_batches):
-            x, decoder_target = next(valid_datagen)
-            context, current, decoder_in = x
-            # Loop over individual sentences
-            for i in range(context.shape[0]):
-                context_i, current_i, decoder_in_i, decoder_target_i = context[i], current[i], decoder_in[i], decoder_target[i]
-                # Reshape all input
-                context_i = np.reshape(a=context_i, newshape=(1, context.shape[1]))
-                current_i = np.reshape(a=current_i, newshape=(1, current.shape[1]))
-                decoder_in_i = np.reshape(a=decoder_in_i, newshape=(1, decoder_in.shape[1]))
-                decoder_target_i = np.reshape(a=decoder_target_i, newshape=(1, decoder_target.shape[1]))
-
-                predicted_tokens = []
-                target_seq = np.zeros((1, len_limit))
-                target_seq[0, 0] = self.vocab['<s>']
-
-                for ix in range(len_limit):
-                    print('=', end='', flush=True)
-                    y_logits = self.model.predict_on_batch([context_i, current_i, decoder_in_i])
-                    sampled_index = np.argmax(y_logits[0, i, :])
-                    if sampled_index == self.vocab['</s>']:
-                        break
-                    predicted_tokens.append(sampled_index)
-                    target_seq[0, i+1] = sampled_index
-
-                candidate = [w_id for w_id in predicted_tokens if not(w_id in skip_toks)]
-                reference = [[w_id for w_id in decoder_target_i.squeeze() if not(w_id in skip_toks)]]
-                sent_bleu_score = sentence_bleu(reference, candidate)
-                BLEU += sent_bleu_score
-                sent_count += 1
-
-        print('Calculated sent count:', num_batches * self.batch_size)
-        print('Actual counted sent count:', sent_count)
-        print('SAMPLED BLEU SCORE:', BLEU / sent_count)
-        print()
-    
+            (context, current, _), decoder_target = next(valid_datagen)
+            batches.append([context, current])
+            references += [[w_id for w_id in row if w_id not in skip_toks] for row in decoder_target.tolist()]
+
+        start = time.time()
+        if n_processes > 0:
+            if model_path is None:
+                model_path = os.path.join(tempfile.mkdtemp(), 'bleu_replica.h5')
+                self.model.save(model_path)
+            candidates = parallel_decode(model_path, batches, bos, eos, len_limit=len_limit, n_processes=n_processes,
+                                         custom_objects={'AttLayer': AttLayer})
+        else:
+            candidates = [seq for batch in batches
+                          for seq in greedy_decode_batch(self.model.predict_on_batch, batch, bos, eos, len_limit=len_limit)]
+        decode_sec = time.time() - start
+
+        candidates = [[w_id for w_id in seq if w_id not in skip_toks] for seq in candidates]
+        return bleu_report(references, candidates, decode_sec)
+
     def greedy_decode(self, input_seq:str, delimiter:str=' ', use_bpe=False):
         def separate_punct(s):
             patt = r"[\w']+|[.,!?;]"
@@ -664,8 +816,8 @@ if __name__ == '__main__':
     parser.add_argument('--decoder_dim', type=int, required=False, default=256)
     parser.add_argument('--num_encoder_layers', type=int, required=False, default=2)
     parser.add_argument('--num_decoder_layers', type=int, required=False, default=1)
-    parser.add_argument('--n_train_examples', type=int, required=False, default=100000)
-    parser.add_argument('--n_valid_examples', type=int, required=False, default=50000)
+    parser.add_argument('--n_train_examples', type=int, required=False, default=None, help='Default: line count of --train_file')
+    parser.add_argument('--n_valid_examples', type=int, required=False, default=None, help='Default: line count of --valid_file')
 
     args = parser.parse_args()
 
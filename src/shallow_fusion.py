@@ -0,0 +1,133 @@
+import numpy as np
+
+from metrics import log_softmax
+
+
+def fused_log_probs(base_logits, lm_logits=None, lm_coef:float=0.):
+    """ Shallow fusion scores `log_softmax(base) + lm_coef * log_softmax(lm)` of one decoding
+    step. Ranking by these is the same as ranking by `base + lm_coef * lm` logits, but a beam's
+    running sum of them stays a proper (fused) sequence log-probability.
+
+    Arguments:
+        base_logits {np.ndarray} -- Seq2seq logits, (rows, vocab)
+
+    Keyword Arguments:
+        lm_logits {np.ndarray} -- LM logits, same shape (default: {None})
+        lm_coef {float} -- LM weight (default: {0.})
+    """
+    scores = log_softmax(base_logits)
+    if lm_logits is not None and lm_coef != 0:
+        scores += lm_coef * log_softmax(lm_logits)
+    return scores
+
+def greedy_search(step_fn, batch_size:int, bos:int, eos:int, max_len:int=40):
+    """ Greedy decoding of a batch through a cached stepper
+
+    `step_fn(tokens, parents)` scores the next token of every row: row i extends row
+    `parents[i]` of the previous call (of the initial batch on the first call) with `tokens[i]`,
+    so the stepper gathers its cached states by `parents` before running. Finished rows are
+    dropped from later steps.
+
+    Arguments:
+        step_fn {callable} -- (tokens (rows,), parents (rows,)) -> log-probabilities (rows, vocab)
+
+    Returns:
+        list -- Decoded token ID's per input, without `bos`/`eos`
+    """
+    decoded = [[] for _ in range(batch_size)]
+    rows = np.arange(batch_size)
+    tokens, parents = np.full(batch_size, bos, dtype=np.int64), np.arange(batch_size)
+
+    for _ in range(max_len):
+        next_tokens = step_fn(tokens, parents).argmax(axis=-1)
+        keep = np.flatnonzero(next_tokens != eos)
+        for row, token in zip(rows[keep], next_tokens[keep]):
+            decoded[row].append(int(token))
+        rows, tokens, parents = rows[keep], next_tokens[keep], keep
+        if len(rows) == 0:
+            break
+    return decoded
+
+def beam_search(step_fn, batch_size:int, bos:int, eos:int, beam_width:int=5, max_len:int=40, length_penalty:float=0.,
+                n_best:int=1):
+    """ Beam search over a batch through a cached stepper, all beams of all inputs scored in
+    one `step_fn` call per step (see `greedy_search` for the stepper contract). The first call
+    has `batch_size * beam_width` rows whose parents repeat each input `beam_width` times.
+
+    A hypothesis ending in `eos` is set aside, and an input is done once it has `beam_width`
+    finished hypotheses or none of its live beams can still beat the best of them. Final
+    hypotheses are ranked by `score / length ** length_penalty`.
+
+    Keyword Arguments:
+        beam_width {int} -- Live hypotheses per input (default: {5})
+        max_len {int} -- Maximum number of decoded tokens (default: {40})
+        length_penalty {float} -- Length normalization exponent, 0 ranks by raw log-probability (default: {0.})
+        n_best {int} -- Hypotheses returned per input (default: {1})
+
+    Returns:
+        list -- Per input, `n_best` (token ID's, score) pairs, best first
+    """
+    def normalized(score, length):
+        return score / max(length, 1) ** length_penalty
+
+    beam_scores = np.full((batch_size, beam_width), -np.inf)
+    # Only the first beam is live at the start, the others would duplicate it
+    beam_scores[:, 0] = 0.
+    histories = np.zeros((batch_size, beam_width, 0), dtype=np.int64)
+    finished = [[] for _ in range(batch_size)]
+    done = np.zeros(batch_size, dtype=bool)
+
+    tokens = np.full(batch_size * beam_width, bos, dtype=np.int64)
+    parents = np.repeat(np.arange(batch_size), beam_width)
+    for t in range(max_len):
+        log_probs = step_fn(tokens, parents)
+        vocab_size = log_probs.shape[-1]
+        # Twice the beam so `beam_width` candidates survive even if the rest end in `eos`
+        candidates = (beam_scores[..., None] + log_probs.reshape(batch_size, beam_width, vocab_size)).reshape(batch_size, -1)
+        n_candidates = min(2 * beam_width, candidates.shape[1])
+        top = np.argpartition(-candidates, n_candidates - 1, axis=1)[:, :n_candidates]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(candidates, top, axis=1), axis=1), axis=1)
+
+        new_scores = np.full((batch_size, beam_width), -np.inf)
+        new_beams = np.zeros((batch_size, beam_width), dtype=np.int64)
+        new_tokens = np.full((batch_size, beam_width), eos, dtype=np.int64)
+        for b in range(batch_size):
+            if done[b]:
+                continue
+            n_live = 0
+            for flat in top[b]:
+                score = candidates[b, flat]
+                if not np.isfinite(score):
+                    break
+                beam, token = divmod(int(flat), vocab_size)
+                if token == eos:
+                    finished[b].append((histories[b, beam].tolist(), float(score)))
+                    continue
+                new_scores[b, n_live], new_beams[b, n_live], new_tokens[b, n_live] = score, beam, token
+                n_live += 1
+                if n_live == beam_width:
+                    break
+
+            if len(finished[b]) >= beam_width:
+                done[b] = True
+            elif finished[b] and length_penalty == 0 and new_scores[b].max() <= max(s for _, s in finished[b]):
+                # Log-probabilities only fall, no live beam can overtake
+                done[b] = True
+
+        histories = np.concatenate([np.take_along_axis(histories, new_beams[..., None], axis=1), new_tokens[..., None]], axis=2)
+        beam_scores = np.where(done[:, None], -np.inf, new_scores)
+        if done.all():
+            break
+        tokens = new_tokens.ravel()
+        parents = (np.arange(batch_size)[:, None] * beam_width + new_beams).ravel()
+
+    results = []
+    for b in range(batch_size):
+        hypotheses = finished[b]
+        if len(hypotheses) < n_best:
+            # Out of steps, live beams count as finished
+            hypotheses = hypotheses + [(histories[b, k].tolist(), float(beam_scores[b, k]))
+                                       for k in range(beam_width) if np.isfinite(beam_scores[b, k])]
+        hypotheses.sort(key=lambda h: normalized(h[1], len(h[0]) + 1), reverse=True)
+        results.append(hypotheses[:n_best])
+    return results
@@ -0,0 +1,180 @@
+import argparse
+import time
+
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+class Shortlist(object):
+    def __init__(self, frequent_ids, cooccurrence:dict, always_include=()):
+        """ Per-input candidate vocabulary for decode-time softmax
+
+        Candidates for an input are the most frequent target words, the target words that
+        co-occur most with each source word in training data, the source words themselves
+        and any `always_include` ID's (e.g. end-of-sequence).
+
+        Arguments:
+            frequent_ids {list} -- Word ID's always on the shortlist
+            cooccurrence {dict} -- Source word ID -> array of target word ID's
+        """
+        self.frequent_ids = np.asarray(frequent_ids, dtype=np.int32)
+        self.cooccurrence = cooccurrence
+        self.always_include = np.asarray(always_include, dtype=np.int32)
+
+    @classmethod
+    def build(cls, pairs, top_frequent:int=2000, top_per_source:int=50, always_include=(), max_pairs:int=None):
+        """ Count target-word frequency and source/target co-occurrence over (source, target) pairs
+
+        Arguments:
+            pairs {iterable} -- Yields (source word ID's, target word ID's)
+
+        Keyword Arguments:
+            top_frequent {int} -- Number of globally most frequent target words to keep (default: {2000})
+            top_per_source {int} -- Number of co-occurring target words kept per source word (default: {50})
+            always_include {tuple} -- Word ID's added to every shortlist (default: {()})
+            max_pairs {int} -- Stop after this many pairs (default: {None})
+        """
+        target_counts = Counter()
+        cooc_counts = defaultdict(Counter)
+        for n_pairs, (source_ids, target_ids) in enumerate(pairs):
+            if max_pairs is not None and n_pairs >= max_pairs:
+                break
+            target_counts.update(target_ids)
+            targets = set(target_ids)
+            for s in set(source_ids):
+                cooc_counts[s].update(targets)
+
+        frequent_ids = [w for w, _ in target_counts.most_common(top_frequent)]
+        cooccurrence = {s: np.asarray([w for w, _ in c.most_common(top_per_source)], dtype=np.int32)
+                        for s, c in cooc_counts.items()}
+        return cls(frequent_ids, cooccurrence, always_include=always_include)
+
+    def candidates(self, source_ids):
+        """ Sorted, de-duplicated word ID's to score for one input """
+        source_ids = np.asarray(source_ids, dtype=np.int32).ravel()
+        parts = [self.frequent_ids, self.always_include, source_ids]
+        parts += [self.cooccurrence[s] for s in set(source_ids.tolist()) if s in self.cooccurrence]
+        return np.unique(np.concatenate(parts))
+
+    def save(self, path:str):
+        keys = np.asarray(sorted(self.cooccurrence.keys()), dtype=np.int32)
+        values = [self.cooccurrence[k] for k in keys]
+        offsets = np.cumsum([0] + [len(v) for v in values]).astype(np.int64)
+        with open(path, mode='wb') as outfile:
+            np.savez(outfile, frequent_ids=self.frequent_ids, always_include=self.always_include, cooc_keys=keys,
+                     cooc_offsets=offsets, cooc_values=np.concatenate(values) if values else np.zeros(0, np.int32))
+        print('Shortlist saved to {}'.format(path))
+
+    @classmethod
+    def load(cls, path:str):
+        with np.load(path) as data:
+            offsets, values = data['cooc_offsets'], data['cooc_values']
+            cooccurrence = {int(k): values[offsets[i]:offsets[i+1]] for i, k in enumerate(data['cooc_keys'])}
+            return cls(data['frequent_ids'], cooccurrence, always_include=data['always_include'])
+
+class ShortlistProjection(object):
+    def __init__(self, W, b=None):
+        """ Output projection that only scores a subset of the vocabulary
+
+        Arguments:
+            W {np.ndarray} -- Logits kernel, (hidden, vocab)
+
+        Keyword Arguments:
+            b {np.ndarray} -- Logits bias, (vocab,) (default: {None})
+        """
+        self.W = np.asarray(W, dtype=np.float32)
+        self.b = np.zeros(self.W.shape[1], dtype=np.float32) if b is None else np.asarray(b, dtype=np.float32)
+
+    def restrict(self, candidates):
+        """ Slice the kernel once per input - every decode step then multiplies against
+        `len(candidates)` columns instead of the full vocabulary
+
+        Returns:
+            tuple -- (candidate ID's, contiguous kernel slice, bias slice)
+        """
+        return candidates, np.ascontiguousarray(self.W[:, candidates]), self.b[candidates]
+
+def logits_over(hidden, restricted):
+    """ Logits over a shortlist; `hidden` is (..., hidden_dim) """
+    _, W_sub, b_sub = restricted
+    return np.dot(hidden, W_sub) + b_sub
+
+def split_output_layer(model, vocab_size:int):
+    """ Split a Keras model into the part producing the final hidden states and the
+    vocab-sized output projection (a linear `Dense`, possibly wrapped in `TimeDistributed`)
+
+    Returns:
+        tuple -- (hidden-state model, ShortlistProjection)
+    """
+    from keras.models import Model
+
+    for layer in reversed(model.layers):
+        inner = getattr(layer, 'layer', layer)
+        if type(inner).__name__ != 'Dense' or inner.units != vocab_size:
+            continue
+        assert inner.get_config()['activation'] == 'linear', 'Shortlist decoding needs a linear logits layer'
+        weights = inner.get_weights()
+        hidden_model = Model(inputs=model.inputs, outputs=layer.get_input_at(0))
+        return hidden_model, ShortlistProjection(weights[0], weights[1] if len(weights) > 1 else None)
+
+    raise ValueError('No vocab-sized linear Dense layer found in model')
+
+def compare_decoding(full_decode, shortlist_decode, inputs:list):
+    """ Speed-up and agreement of shortlist decoding against full-softmax decoding
+
+    Arguments:
+        full_decode {callable} -- Decodes one input with the full softmax
+        shortlist_decode {callable} -- Decodes one input with the shortlist
+        inputs {list} -- Inputs to decode
+
+    Returns:
+        dict -- Report, also printed
+    """
+    outputs, timings = {}, {}
+    for name, decode in [('full', full_decode), ('shortlist', shortlist_decode)]:
+        # First call builds the predict function, keep it out of the timings
+        decode(inputs[0])
+        start = time.time()
+        outputs[name] = [decode(x) for x in inputs]
+        timings[name] = time.time() - start
+
+    def tokens(output):
+        return output.split() if isinstance(output, str) else list(output)
+
+    exact, tok_agree, tok_total = 0, 0, 0
+    for full, short in zip(outputs['full'], outputs['shortlist']):
+        full_toks, short_toks = tokens(full), tokens(short)
+        exact += int(full_toks == short_toks)
+        tok_agree += sum(f == s for f, s in zip(full_toks, short_toks))
+        tok_total += max(len(full_toks), len(short_toks), 1)
+
+    report = {'inputs': len(inputs), 'full_sec': timings['full'], 'shortlist_sec': timings['shortlist'],
+              'speedup': timings['full'] / max(timings['shortlist'], 1e-9),
+              'exact_agreement': float(exact) / len(inputs), 'token_agreement': float(tok_agree) / tok_total}
+    print('\nSHORTLIST DECODING REPORT')
+    print('=' * 50)
+    for k, v in report.items():
+        print('{}: {}'.format(k, round(v, 4) if isinstance(v, float) else v))
+    return report
+
+
+if __name__ == '__main__':
+    import data_utils
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_file', type=str, required=True)
+    parser.add_argument('--vocab_file', type=str, required=True)
+    parser.add_argument('--min_vocab_freq', type=int, required=False, default=3)
+    parser.add_argument('--output_path', type=str, required=False, default='shortlist.npz')
+    parser.add_argument('--top_frequent', type=int, required=False, default=2000)
+    parser.add_argument('--top_per_source', type=int, required=False, default=50)
+    parser.add_argument('--max_pairs', type=int, required=False, default=None)
+    args = parser.parse_args()
+
+    vocab = data_utils.get_vocab(vocab_file=args.vocab_file, min_freq=args.min_vocab_freq)
+    processor = data_utils.S2SProcessing(train_file=args.train_file, valid_file=args.train_file, vocab=vocab)
+    pairs = ((enc, dec_out) for enc, _, dec_out in processor.get_line(args.train_file))
+    shortlist = Shortlist.build(pairs, top_frequent=args.top_frequent, top_per_source=args.top_per_source,
+                                always_include=[vocab['</s>'], vocab['<UNK>']], max_pairs=args.max_pairs)
+    shortlist.save(args.output_path)
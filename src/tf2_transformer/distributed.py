@@ -0,0 +1,76 @@
+import json
+import os
+import subprocess
+import sys
+
+
+def local_tf_config(n_workers:int, index:int, base_port:int=23456):
+    """ TF_CONFIG for worker `index` of a cluster of `n_workers` processes on this machine """
+    workers = ['localhost:{}'.format(base_port + i) for i in range(n_workers)]
+    return {'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}}
+
+def task_info():
+    """ (task type, task index, number of workers) from TF_CONFIG, a lone worker when unset """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    cluster, task = tf_config.get('cluster', {}), tf_config.get('task', {})
+    n_workers = len(cluster.get('worker', [])) + len(cluster.get('chief', []))
+    return task.get('type', 'worker'), task.get('index', 0), max(n_workers, 1)
+
+def is_chief():
+    """ The chief task if the cluster has one, otherwise worker 0 """
+    task_type, index, _ = task_info()
+    has_chief = 'chief' in json.loads(os.environ.get('TF_CONFIG', '{}')).get('cluster', {})
+    return task_type == 'chief' or (not has_chief and task_type == 'worker' and index == 0)
+
+def launch_local_workers(n_workers:int, script:str, script_args:list, base_port:int=23456):
+    """ Run `script` as `n_workers` CPU processes forming one multi-worker cluster and wait
+    for all of them
+
+    Returns:
+        str -- Stdout of the chief (worker 0)
+    """
+    procs = []
+    for index in range(n_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps(local_tf_config(n_workers, index, base_port)), CUDA_VISIBLE_DEVICES='-1')
+        # Only the chief's output is captured, the other workers would just repeat it
+        stdout = subprocess.PIPE if index == 0 else subprocess.DEVNULL
+        procs.append(subprocess.Popen([sys.executable, script] + list(script_args), env=env, stdout=stdout,
+                                      cwd=os.path.dirname(os.path.abspath(script))))
+
+    chief_output = procs[0].communicate()[0].decode('utf-8')
+    for proc in procs[1:]:
+        proc.wait()
+    failed = [i for i, proc in enumerate(procs) if proc.returncode != 0]
+    if failed:
+        raise RuntimeError('Workers {} exited with an error'.format(failed))
+    return chief_output
+
+def scaling_report(script:str, script_args:list, worker_counts=(1, 2, 4), n_steps:int=50, base_port:int=23456):
+    """ Training throughput and scaling efficiency from 1 to N local workers
+
+    Every worker keeps the per-worker batch size, so N workers process N times as many
+    examples per step and efficiency is throughput(N) / (N * throughput(1)). The script
+    must accept `--distributed --measure_throughput N` and print a JSON line with
+    `examples_per_sec` last (see `train.py`).
+
+    Returns:
+        list -- One dict per worker count, also printed
+    """
+    report = []
+    for n_workers in worker_counts:
+        output = launch_local_workers(n_workers, script, list(script_args) + ['--distributed', '--measure_throughput', str(n_steps)],
+                                      base_port=base_port)
+        result = json.loads(output.strip().split('\n')[-1])
+        result['n_workers'] = n_workers
+        report.append(result)
+        # Fresh ports per run, the previous cluster's sockets may linger in TIME_WAIT
+        base_port += n_workers
+
+    baseline = report[0]['examples_per_sec'] / report[0]['n_workers']
+    print('\nDATA-PARALLEL SCALING REPORT ({} steps)'.format(n_steps))
+    print('=' * 50)
+    for r in report:
+        r['efficiency'] = r['examples_per_sec'] / (r['n_workers'] * baseline)
+        print('workers {:3d} | examples/sec: {:10.1f} | speed-up: {:5.2f}x | efficiency: {:6.1%}'.format(
+            r['n_workers'], r['examples_per_sec'], r['examples_per_sec'] / baseline, r['efficiency']))
+    return report
@@ -2,6 +2,7 @@
 # Try install 1.2.1 - if that fails isntall 1.13
 import os
 import re
+import sys
 
 import numpy as np
 
@@ -9,6 +10,9 @@ import keras
 import keras.backend as K
 import tensorflow as tf
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset_manifest import DatasetManifest
+
 
 def scaled_dot_product_attention(query, key, value, mask):
     """Calculate the attention weights. """
@@ -327,17 +331,12 @@ class Trainer(object):
         self.build_transformer()
 
     def _get_train_valid_instances(self):
-        self.train_cnt, self.valid_cnt = 0, 0
-        with open(self.data_generator.train_file, mode='r') as infile:
-            for line in infile:
-                self.train_cnt += 1
-
-        with open(self.data_generator.valid_file, mode='r') as infile:
-            for line in infile:
-                self.valid_cnt += 1
+        train_manifest = DatasetManifest.load_or_build(self.data_generator.train_file)
+        valid_manifest = DatasetManifest.load_or_build(self.data_generator.valid_file)
+        self.train_cnt, self.valid_cnt = train_manifest.n_lines, valid_manifest.n_lines
 
-        self.n_train_iters = self.train_cnt // self.batch_size
-        self.n_valid_iters = self.valid_cnt // self.batch_size
+        self.n_train_iters = train_manifest.steps_per_epoch(self.batch_size, drop_remainder=True)
+        self.n_valid_iters = valid_manifest.steps_per_epoch(self.batch_size, drop_remainder=True)
 
     def build_transformer(self, name="transformer"):
         inputs = tf.keras.Input(shape=(None,), name="inputs")
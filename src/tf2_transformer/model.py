@@ -1,14 +1,29 @@
 import os
 import re
+import sys
+
+import contextlib
+import time
 
 import numpy as np
 
 import keras
 import tensorflow as tf
 
+from distributed import is_chief, task_info
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from quantization import quantize_matrix, compare_quantized
+from chunked_attention import chunked_attention, local_attention
+from dataset_manifest import DatasetManifest
+
+
+def scaled_dot_product_attention(query, key, value, mask, chunk_size=None):
+    """Calculate the attention weights. With `chunk_size`, queries are processed in chunks
+    so only (chunk_size, seq_len_k) logits exist at once - same outputs, see `chunked_attention`. """
+    if chunk_size is not None:
+        return chunked_attention(query, key, value, bias=None if mask is None else mask * -1e9, chunk_size=chunk_size)
 
-def scaled_dot_product_attention(query, key, value, mask):
-    """Calculate the attention weights. """
     matmul_qk = tf.matmul(query, key, transpose_b=True)
 
     # scale matmul_qk
@@ -38,10 +53,19 @@ def create_look_ahead_mask(x):
     return tf.maximum(look_ahead_mask, padding_mask)
 
 class MultiHeadAttention(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, name="multi_head_attention"):
+    def __init__(self, d_model, num_heads, name="multi_head_attention", chunk_size=None, window=None, n_global=1,
+                 causal=False):
+        """ `window` makes this sliding-window self-attention: every position attends to the
+        `window` positions on either side (earlier ones only with `causal`) plus the first
+        `n_global` ones (see `local_attention`) - only for layers whose query, key and value
+        are the same sequence """
         super(MultiHeadAttention, self).__init__(name=name)
         self.num_heads = num_heads
         self.d_model = d_model
+        self.chunk_size = chunk_size
+        self.window = window
+        self.n_global = n_global
+        self.causal = causal
 
         assert d_model % self.num_heads == 0
 
@@ -74,7 +98,13 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         value = self.split_heads(value, batch_size)
 
         # scaled dot-product attention
-        scaled_attention = scaled_dot_product_attention(query, key, value, mask)
+        if self.window is not None:
+            # Masks are 1 at hidden positions - a key is padding if every query hides it
+            key_bias = None if mask is None else tf.reduce_min(mask, axis=-2) * -1e9
+            scaled_attention = local_attention(query, key, value, key_bias=key_bias, window=self.window,
+                                               n_global=self.n_global, causal=self.causal)
+        else:
+            scaled_attention = scaled_dot_product_attention(query, key, value, mask, chunk_size=self.chunk_size)
 
         scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
 
@@ -113,12 +143,12 @@ class PositionalEncoding(tf.keras.layers.Layer):
     def call(self, inputs):
         return inputs + self.pos_encoding[:, :tf.shape(inputs)[1], :]
 
-def encoder_layer(units, d_model, num_heads, dropout, name="encoder_layer"):
+def encoder_layer(units, d_model, num_heads, dropout, name="encoder_layer", chunk_size=None, window=None, n_global=1):
     inputs = tf.keras.Input(shape=(None, d_model), name="inputs")
     padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
 
     attention = MultiHeadAttention(
-        d_model, num_heads, name="attention")({
+        d_model, num_heads, name="attention", chunk_size=chunk_size, window=window, n_global=n_global)({
             'query': inputs,
             'key': inputs,
             'value': inputs,
@@ -137,13 +167,111 @@ def encoder_layer(units, d_model, num_heads, dropout, name="encoder_layer"):
     return tf.keras.Model(
         inputs=[inputs, padding_mask], outputs=outputs, name=name)
 
+class QuantizedEmbedding(tf.keras.layers.Embedding):
+    def __init__(self, input_dim, output_dim, quantize_mode='int8', **kwargs):
+        """ Embedding table stored as int8 (one scale per row) or float16, only the
+        looked-up rows are de-quantized
+        """
+        self.quantize_mode = quantize_mode
+        kwargs['trainable'] = False
+        super(QuantizedEmbedding, self).__init__(input_dim, output_dim, **kwargs)
+
+    def build(self, input_shape):
+        dtype = tf.int8 if self.quantize_mode == 'int8' else tf.float16
+        self.embeddings = self.add_weight(name='embeddings', shape=(self.input_dim, self.output_dim),
+                                          dtype=dtype, initializer='zeros', trainable=False)
+        if self.quantize_mode == 'int8':
+            self.scales = self.add_weight(name='scales', shape=(self.input_dim,), initializer='ones', trainable=False)
+        self.built = True
+
+    def call(self, inputs):
+        inputs = tf.cast(inputs, tf.int32)
+        outputs = tf.cast(tf.gather(self.embeddings, inputs), tf.float32)
+        if self.quantize_mode == 'int8':
+            outputs *= tf.expand_dims(tf.gather(self.scales, inputs), -1)
+        return outputs
+
+    def set_float_weights(self, weights):
+        q_W, scales = quantize_matrix(weights[0], mode=self.quantize_mode, axis=1)
+        self.set_weights([q_W] if scales is None else [q_W, scales])
+
+class QuantizedDense(tf.keras.layers.Dense):
+    def __init__(self, units, quantize_mode='int8', **kwargs):
+        """ Dense layer with an int8 (one scale per output unit) or float16 kernel,
+        the int8 scales are applied after the matmul
+        """
+        self.quantize_mode = quantize_mode
+        kwargs['trainable'] = False
+        super(QuantizedDense, self).__init__(units, **kwargs)
+
+    def build(self, input_shape):
+        input_dim = int(input_shape[-1])
+        dtype = tf.int8 if self.quantize_mode == 'int8' else tf.float16
+        self.kernel = self.add_weight(name='kernel', shape=(input_dim, self.units),
+                                      dtype=dtype, initializer='zeros', trainable=False)
+        if self.quantize_mode == 'int8':
+            self.scales = self.add_weight(name='scales', shape=(self.units,), initializer='ones', trainable=False)
+        self.bias = self.add_weight(name='bias', shape=(self.units,), initializer='zeros', trainable=False) if self.use_bias else None
+        self.built = True
+
+    def call(self, inputs):
+        outputs = tf.tensordot(inputs, tf.cast(self.kernel, tf.float32), axes=[[-1], [0]])
+        if self.quantize_mode == 'int8':
+            outputs *= self.scales
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, self.bias)
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+    def set_float_weights(self, weights):
+        q_W, scales = quantize_matrix(weights[0], mode=self.quantize_mode, axis=0)
+        self.set_weights([q_W] + ([] if scales is None else [scales]) + list(weights[1:]))
+
+class TiedOutputEmbedding(tf.keras.layers.Layer):
+    def __init__(self, embedding_layer, **kwargs):
+        """ Output projection scoring hidden states against the rows of `embedding_layer`,
+        only a bias of its own is trained. A quantized embedding table is de-quantized here.
+        """
+        super(TiedOutputEmbedding, self).__init__(**kwargs)
+        # Kept behind a callable so the shared table is tracked once, by the embedding layer
+        self._get_embedding = lambda: embedding_layer
+
+    def build(self, input_shape):
+        embedding_layer = self._get_embedding()
+        self.bias = self.add_weight(name='bias', shape=(embedding_layer.input_dim,), initializer='zeros',
+                                    trainable=not isinstance(embedding_layer, QuantizedEmbedding))
+        self.built = True
+
+    def call(self, inputs):
+        embedding_layer = self._get_embedding()
+        W = tf.cast(embedding_layer.embeddings, tf.float32)
+        if isinstance(embedding_layer, QuantizedEmbedding) and embedding_layer.quantize_mode == 'int8':
+            W *= tf.expand_dims(embedding_layer.scales, -1)
+        return tf.nn.bias_add(tf.matmul(inputs, W, transpose_b=True), self.bias)
+
+def copy_weights(src_layers, dst_layers):
+    """ Copy weights between two builds of the same architecture, quantizing where the
+    destination layer is quantized and descending into nested encoder/decoder models
+    """
+    for src, dst in zip(src_layers, dst_layers):
+        if isinstance(dst, (QuantizedEmbedding, QuantizedDense)):
+            dst.set_float_weights(src.get_weights())
+        elif isinstance(dst, tf.keras.Model):
+            copy_weights(src.layers, dst.layers)
+        elif src.weights:
+            dst.set_weights(src.get_weights())
+
 def encoder(embedding_layer, vocab_size,
             num_layers,
             units,
             d_model,
             num_heads,
             dropout,
-            name="encoder"):
+            name="encoder",
+            chunk_size=None,
+            window=None,
+            n_global=1):
     inputs = tf.keras.Input(shape=(None,), name="inputs")
     padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
 
@@ -161,12 +289,15 @@ def encoder(embedding_layer, vocab_size,
             num_heads=num_heads,
             dropout=dropout,
             name="encoder_layer_{}".format(i),
+            chunk_size=chunk_size,
+            window=window,
+            n_global=n_global,
         )([outputs, padding_mask])
 
     return tf.keras.Model(
         inputs=[inputs, padding_mask], outputs=outputs, name=name)
 
-def decoder_layer(units, d_model, num_heads, dropout, name="decoder_layer"):
+def decoder_layer(units, d_model, num_heads, dropout, name="decoder_layer", chunk_size=None, window=None, n_global=1):
     inputs = tf.keras.Input(shape=(None, d_model), name="inputs")
     enc_outputs = tf.keras.Input(shape=(None, d_model), name="encoder_outputs")
     look_ahead_mask = tf.keras.Input(
@@ -174,7 +305,8 @@ def decoder_layer(units, d_model, num_heads, dropout, name="decoder_layer"):
     padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
 
     attention1 = MultiHeadAttention(
-        d_model, num_heads, name="attention_1")(inputs={
+        d_model, num_heads, name="attention_1", chunk_size=chunk_size, window=window, n_global=n_global,
+        causal=True)(inputs={
             'query': inputs,
             'key': inputs,
             'value': inputs,
@@ -184,7 +316,7 @@ def decoder_layer(units, d_model, num_heads, dropout, name="decoder_layer"):
         epsilon=1e-6)(attention1 + inputs)
 
     attention2 = MultiHeadAttention(
-        d_model, num_heads, name="attention_2")(inputs={
+        d_model, num_heads, name="attention_2", chunk_size=chunk_size)(inputs={
             'query': attention1,
             'key': enc_outputs,
             'value': enc_outputs,
@@ -207,7 +339,7 @@ def decoder_layer(units, d_model, num_heads, dropout, name="decoder_layer"):
 
 def decoder(vocab_size, num_layers, units,
             d_model, num_heads, dropout,
-            embedding_layer, name='decoder'):
+            embedding_layer, name='decoder', chunk_size=None, window=None, n_global=1):
     inputs = tf.keras.Input(shape=(None,), name='inputs')
     enc_outputs = tf.keras.Input(shape=(None, d_model), name='encoder_outputs')
     look_ahead_mask = tf.keras.Input(
@@ -228,6 +360,9 @@ def decoder(vocab_size, num_layers, units,
             num_heads=num_heads,
             dropout=dropout,
             name='decoder_layer_{}'.format(i),
+            chunk_size=chunk_size,
+            window=window,
+            n_global=n_global,
         )(inputs=[outputs, enc_outputs, look_ahead_mask, padding_mask])
 
     return tf.keras.Model(
@@ -284,7 +419,9 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
 
 class Trainer(object):
     def __init__(self, d_model:int, units:int, vocab_size:int, num_layers:int,
-                 num_heads:int, dropout:float, epochs:int, batch_size:int, data_generator):
+                 num_heads:int, dropout:float, epochs:int, batch_size:int, data_generator,
+                 attention_chunk_size:int=None, attention_window:int=None, attention_n_global:int=1,
+                 tie_embeddings:bool=False, grad_accum_steps:int=1, strategy=None):
         self.d_model = d_model
         self.units = units
         self.vocab_size = vocab_size
@@ -294,29 +431,49 @@ class Trainer(object):
         self.epochs = epochs
         self.batch_size = batch_size
         self.data_generator = data_generator
+        self.attention_chunk_size = attention_chunk_size
+        self.attention_window = attention_window
+        self.attention_n_global = attention_n_global
+        self.tie_embeddings = tie_embeddings
+        # Batches whose gradients are summed into one update, effective batch = batch_size * grad_accum_steps
+        self.grad_accum_steps = grad_accum_steps
+        # Data-parallel training across the workers in TF_CONFIG, None = single device
+        self.strategy = strategy
+        self.is_chief = strategy is None or is_chief()
+        self.num_workers = 1 if strategy is None else task_info()[2]
+        assert strategy is None or grad_accum_steps == 1, 'Gradient accumulation is not supported with a distribution strategy!'
+        if strategy is not None:
+            self.data_generator.shard(self.num_workers, task_info()[1])
         self._get_train_valid_instances()
-        self.build_transformer()
+        with (strategy.scope() if strategy is not None else contextlib.suppress()):
+            self.build_transformer()
 
     def _get_train_valid_instances(self):
-        self.train_cnt, self.valid_cnt = 0, 0
-        with open(self.data_generator.train_file, mode='r') as infile:
-            for line in infile:
-                self.train_cnt += 1
+        # Counts come from manifests stored next to the corpora, built on first use
+        train_manifest = DatasetManifest.load_or_build(self.data_generator.train_file)
+        valid_manifest = DatasetManifest.load_or_build(self.data_generator.valid_file)
+        self.train_cnt, self.valid_cnt = train_manifest.n_lines, valid_manifest.n_lines
 
-        with open(self.data_generator.valid_file, mode='r') as infile:
-            for line in infile:
-                self.valid_cnt += 1
+        # Per worker - every worker must run the same number of steps to stay in sync
+        self.n_train_iters = train_manifest.steps_per_epoch(self.batch_size, num_workers=self.num_workers, drop_remainder=True)
+        self.n_valid_iters = valid_manifest.steps_per_epoch(self.batch_size, num_workers=self.num_workers, drop_remainder=True)
 
-        self.n_train_iters = self.train_cnt // self.batch_size
-        self.n_valid_iters = self.valid_cnt // self.batch_size
-
-    def build_transformer(self, name="transformer"):
+    def build_transformer(self, name="transformer", quantize_mode=None):
         inputs = tf.keras.Input(shape=(None,), name="inputs")
         dec_inputs = tf.keras.Input(shape=(None,), name="dec_inputs")
 
+        if quantize_mode is None:
+            embedding_cls, outputs_cls, q_kwargs = tf.keras.layers.Embedding, tf.keras.layers.Dense, {}
+        else:
+            embedding_cls, outputs_cls, q_kwargs = QuantizedEmbedding, QuantizedDense, {'quantize_mode': quantize_mode}
+
         # embedding_layer = tf.keras.layers.Embedding(self.vocab_size, self.d_model, mask_zero=True)
-        context_embedding = tf.keras.layers.Embedding(self.vocab_size, self.d_model, mask_zero=True)
-        response_embedding = tf.keras.layers.Embedding(self.vocab_size, self.d_model, mask_zero=True)
+        context_embedding = embedding_cls(self.vocab_size, self.d_model, mask_zero=True, **q_kwargs)
+        if self.tie_embeddings:
+            # Context, response and output projection all share one table
+            response_embedding = context_embedding
+        else:
+            response_embedding = embedding_cls(self.vocab_size, self.d_model, mask_zero=True, **q_kwargs)
 
         enc_padding_mask = tf.keras.layers.Lambda(
             create_padding_mask, output_shape=(1, 1, None),
@@ -339,6 +496,9 @@ class Trainer(object):
             d_model=self.d_model,
             num_heads=self.num_heads,
             dropout=self.dropout,
+            chunk_size=self.attention_chunk_size,
+            window=self.attention_window,
+            n_global=self.attention_n_global,
         )(inputs=[inputs, enc_padding_mask])
 
         dec_outputs = decoder(
@@ -349,9 +509,15 @@ class Trainer(object):
             d_model=self.d_model,
             num_heads=self.num_heads,
             dropout=self.dropout,
+            chunk_size=self.attention_chunk_size,
+            window=self.attention_window,
+            n_global=self.attention_n_global,
         )(inputs=[dec_inputs, enc_outputs, look_ahead_mask, dec_padding_mask])
 
-        outputs = tf.keras.layers.Dense(units=self.vocab_size, name="outputs")(dec_outputs)
+        if self.tie_embeddings:
+            outputs = TiedOutputEmbedding(response_embedding, name="outputs")(dec_outputs)
+        else:
+            outputs = outputs_cls(units=self.vocab_size, name="outputs", **q_kwargs)(dec_outputs)
         transformer_model = tf.keras.Model(inputs=[inputs, dec_inputs], outputs=outputs, name=name)
 
         learning_rate = CustomSchedule(self.d_model)
@@ -367,10 +533,31 @@ class Trainer(object):
         train_datagen = self.data_generator.batch_generator(mode='train')
         valid_datagen = self.data_generator.batch_generator(mode='valid')
 
+        if self.grad_accum_steps > 1:
+            print('Accumulating gradients over {} batches of {}...'.format(self.grad_accum_steps, self.batch_size))
+            self._build_accumulation()
+        elif self.strategy is not None:
+            print('Data-parallel training on {} workers, {} examples per worker per step...'.format(self.num_workers, self.batch_size))
+            self._build_distributed_steps()
+
         for e in range(self.epochs):
-            hist = self.model.fit_generator(train_datagen, steps_per_epoch=self.n_train_iters, epochs=1,
-                                    verbose=1, validation_data=valid_datagen, validation_steps=self.n_valid_iters)
-            val_loss = sum(hist.history['val_loss']) / len(hist.history['val_loss'])
+            if self.strategy is not None:
+                self._fit_distributed_epoch(train_datagen)
+                val_loss = self._evaluate_distributed(valid_datagen)
+                print('val_loss: {:.4f}'.format(val_loss))
+                # Weights are identical on every worker, one copy is enough
+                if self.is_chief:
+                    self.model.save_weights(model_name.format(e+1, val_loss))
+                else:
+                    continue
+            elif self.grad_accum_steps > 1:
+                self._fit_accumulated_epoch(train_datagen)
+                val_loss = self.model.evaluate_generator(valid_datagen, steps=self.n_valid_iters)
+                print('val_loss: {:.4f}'.format(val_loss))
+            else:
+                hist = self.model.fit_generator(train_datagen, steps_per_epoch=self.n_train_iters, epochs=1,
+                                        verbose=1, validation_data=valid_datagen, validation_steps=self.n_valid_iters)
+                val_loss = sum(hist.history['val_loss']) / len(hist.history['val_loss'])
 
             # self.model.save_weights(model_name.format(e+1, val_loss))
 
@@ -379,6 +566,136 @@ class Trainer(object):
 
         print('DONE TRAINING')
 
+    def _build_distributed_steps(self):
+        """ Compiled train/eval steps run on every replica of `self.strategy`. The loss is divided by
+        the number of target tokens on all workers, so the all-reduced gradient is a per-token mean.
+        """
+        variables = self.model.trainable_variables
+        # `Strategy.run` was `experimental_run_v2` up to TF 2.1
+        run = getattr(self.strategy, 'run', None) or self.strategy.experimental_run_v2
+        SUM = tf.distribute.ReduceOp.SUM
+
+        def train_step(inputs, dec_inputs, labels):
+            mask = tf.cast(tf.not_equal(labels, 0), tf.float32)
+            global_tokens = tf.distribute.get_replica_context().all_reduce(SUM, tf.reduce_sum(mask))
+            with tf.GradientTape() as tape:
+                logits = self.model([inputs, dec_inputs], training=True)
+                loss_sum = tf.reduce_sum(loss_fn(labels, logits) * mask)
+            grads = tape.gradient(loss_sum / tf.maximum(global_tokens, 1.), variables)
+            self.model.optimizer.apply_gradients(zip(grads, variables))
+            return loss_sum, tf.reduce_sum(mask)
+
+        def eval_step(inputs, dec_inputs, labels):
+            mask = tf.cast(tf.not_equal(labels, 0), tf.float32)
+            logits = self.model([inputs, dec_inputs], training=False)
+            return tf.reduce_sum(loss_fn(labels, logits) * mask), tf.reduce_sum(mask)
+
+        def distributed(step):
+            @tf.function(experimental_relax_shapes=True)
+            def fn(inputs, dec_inputs, labels):
+                loss_sum, n_tokens = run(step, args=(inputs, dec_inputs, labels))
+                return self.strategy.reduce(SUM, loss_sum, axis=None), self.strategy.reduce(SUM, n_tokens, axis=None)
+            return fn
+
+        self._distributed_train_step, self._distributed_eval_step = distributed(train_step), distributed(eval_step)
+
+    def _fit_distributed_epoch(self, train_datagen, n_steps:int=None):
+        """ One epoch on this worker's shard, returns examples/sec over all workers """
+        n_steps = self.n_train_iters if n_steps is None else n_steps
+        progbar = tf.keras.utils.Progbar(n_steps, verbose=1 if self.is_chief else 0)
+        start = time.time()
+        for step in range(n_steps):
+            (enc_batch, dec_in_batch), dec_out_batch = next(train_datagen)
+            loss_sum, n_tokens = self._distributed_train_step(enc_batch, dec_in_batch, dec_out_batch)
+            progbar.update(step + 1, [('loss', float(loss_sum) / max(float(n_tokens), 1.))])
+        return n_steps * self.batch_size * self.num_workers / (time.time() - start)
+
+    def _evaluate_distributed(self, valid_datagen):
+        """ Per-token validation loss over every worker's valid shard """
+        total_loss, total_tokens = 0., 0.
+        for _ in range(self.n_valid_iters):
+            (enc_batch, dec_in_batch), dec_out_batch = next(valid_datagen)
+            loss_sum, n_tokens = self._distributed_eval_step(enc_batch, dec_in_batch, dec_out_batch)
+            total_loss, total_tokens = total_loss + float(loss_sum), total_tokens + float(n_tokens)
+        return total_loss / max(total_tokens, 1.)
+
+    def measure_throughput(self, n_steps:int=50):
+        """ Examples/sec of distributed training over `n_steps` steps, after one untimed step
+        that builds the step function (see `distributed.scaling_report`)
+        """
+        self._build_distributed_steps()
+        train_datagen = self.data_generator.batch_generator(mode='train')
+        self._fit_distributed_epoch(train_datagen, n_steps=1)
+        return self._fit_distributed_epoch(train_datagen, n_steps=n_steps)
+
+    def _build_accumulation(self):
+        """ Gradient accumulators and the two compiled steps of accumulated training: summing
+        token-level loss gradients for one batch, and applying their per-token mean
+        """
+        variables = self.model.trainable_variables
+        self.accum_grads = [tf.Variable(tf.zeros_like(v), trainable=False) for v in variables]
+        self.accum_tokens = tf.Variable(0., trainable=False)
+
+        @tf.function(experimental_relax_shapes=True)
+        def accumulate(inputs, dec_inputs, labels):
+            mask = tf.cast(tf.not_equal(labels, 0), tf.float32)
+            with tf.GradientTape() as tape:
+                logits = self.model([inputs, dec_inputs], training=True)
+                loss_sum = tf.reduce_sum(loss_fn(labels, logits) * mask)
+            for accum_grad, grad in zip(self.accum_grads, tape.gradient(loss_sum, variables)):
+                if grad is not None:
+                    accum_grad.assign_add(tf.convert_to_tensor(grad))
+            self.accum_tokens.assign_add(tf.reduce_sum(mask))
+            return loss_sum, tf.reduce_sum(mask)
+
+        @tf.function
+        def apply_accumulated():
+            n_tokens = tf.maximum(self.accum_tokens, 1.)
+            self.model.optimizer.apply_gradients([(g / n_tokens, v) for g, v in zip(self.accum_grads, variables)])
+            for accum_grad in self.accum_grads:
+                accum_grad.assign(tf.zeros_like(accum_grad))
+            self.accum_tokens.assign(0.)
+
+        self._accumulate, self._apply_accumulated = accumulate, apply_accumulated
+
+    def _fit_accumulated_epoch(self, train_datagen):
+        """ One epoch of `n_train_iters` batches with an optimizer update every `grad_accum_steps`,
+        returns the mean per-token training loss
+        """
+        progbar = tf.keras.utils.Progbar(self.n_train_iters)
+        total_loss, total_tokens = 0., 0.
+        for step in range(self.n_train_iters):
+            (enc_batch, dec_in_batch), dec_out_batch = next(train_datagen)
+            loss_sum, n_tokens = self._accumulate(enc_batch, dec_in_batch, dec_out_batch)
+            # A short last group still gets its update, normalized by its own token count
+            if (step + 1) % self.grad_accum_steps == 0 or step + 1 == self.n_train_iters:
+                self._apply_accumulated()
+            total_loss, total_tokens = total_loss + float(loss_sum), total_tokens + float(n_tokens)
+            progbar.update(step + 1, [('loss', float(loss_sum) / max(float(n_tokens), 1.))])
+        return total_loss / max(total_tokens, 1.)
+
+    def quantize(self, quantize_mode='int8'):
+        """ Rebuild the transformer with int8/float16 embeddings and output layer and copy the
+        trained weights in, so `evaluate`/`predict` decode with the quantized model. The float
+        model is kept as `self.float_model`.
+        """
+        self.float_model = getattr(self, 'float_model', self.model)
+        self.build_transformer(name='transformer_{}'.format(quantize_mode), quantize_mode=quantize_mode)
+        copy_weights(self.float_model.layers, self.model.layers)
+
+    def quantization_report(self, quantize_mode='int8', n_batches=20):
+        """ Memory, latency and validation perplexity of the float model against its quantized copy """
+        valid_datagen = self.data_generator.batch_generator(mode='valid')
+        batches = [next(valid_datagen) for _ in range(n_batches)]
+        self.quantize(quantize_mode)
+
+        def predict_fn(model):
+            return lambda x: model(inputs=x, training=False).numpy()
+
+        return compare_quantized(predict_fn(self.float_model), predict_fn(self.model), batches,
+                                 float_weights=self.float_model.get_weights(), quant_weights=self.model.get_weights(),
+                                 mode=quantize_mode)
+
     def evaluate(self, sentence):
         START_TOKEN = self.data_generator.bos
         END_TOKEN = self.data_generator.eos
@@ -1,10 +1,12 @@
 import argparse
+import json
 import os
 import sys
 sys.path.append('..')
 
 from utils import *
 from model import *
+from distributed import is_chief, launch_local_workers, scaling_report
 # from transformer import *
 
 def log_params(args):
@@ -23,6 +25,9 @@ def log_params(args):
     return
 
 def train(args):
+    # The strategy has to exist before any other TF op is created
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy() if args.distributed else None
+
     # Log training parameters for sanity-check
     log_params(args)
 
@@ -34,14 +39,24 @@ def train(args):
     bpe_tok = get_bpe_tokenizer(input_text=movie_lines, tgt_vocab_size=args.target_voc_size)
     del movie_lines
 
-    bpe_tok.save_to_file('cornell_bpe_tokenizer.tok')
+    if is_chief():
+        bpe_tok.save_to_file('cornell_bpe_tokenizer.tok')
 
     data_processor = DataProcessor(max_len=100, tokenizer=bpe_tok, train_file=args.train_file,
-                                   valid_file=args.valid_file, batch_size=args.batch_size)
+                                   valid_file=args.valid_file, batch_size=args.batch_size, seed=args.shuffle_seed,
+                                   shuffle_buffer=args.shuffle_buffer)
 
     trainer = Trainer(d_model=args.d_model, units=args.units, vocab_size=data_processor.vocab_size,
                       num_layers=args.num_layers, num_heads=args.num_heads, dropout=args.dropout,
-                      epochs=args.n_epochs, batch_size=args.batch_size, data_generator=data_processor)
+                      epochs=args.n_epochs, batch_size=args.batch_size, data_generator=data_processor,
+                      attention_chunk_size=args.attention_chunk_size, attention_window=args.attention_window,
+                      attention_n_global=args.attention_n_global, tie_embeddings=args.tie_embeddings,
+                      grad_accum_steps=args.grad_accum_steps, strategy=strategy)
+
+    if args.measure_throughput is not None:
+        # Last line is read back by `distributed.scaling_report`
+        print(json.dumps({'examples_per_sec': trainer.measure_throughput(args.measure_throughput)}))
+        return
 
     # Train
     trainer.train()
@@ -57,6 +72,13 @@ if __name__ == '__main__':
     parser.add_argument('--num_layers', type=int, required=False, default=6)
     parser.add_argument('--num_heads', type=int, required=False, default=8)
     parser.add_argument('--dropout', type=float, required=False, default=0.3)
+    parser.add_argument('--attention_chunk_size', type=int, required=False, default=None, help='Query chunk size for memory-efficient attention')
+    parser.add_argument('--attention_window', type=int, required=False, default=None, help='Sliding-window size for self-attention')
+    parser.add_argument('--attention_n_global', type=int, required=False, default=1, help='Global leading tokens with --attention_window')
+    parser.add_argument('--tie_embeddings', action='store_true', help='Share context/response embeddings and the output projection')
+    parser.add_argument('--grad_accum_steps', type=int, required=False, default=1, help='Batches of gradients accumulated per optimizer update')
+    parser.add_argument('--shuffle_buffer', type=int, required=False, default=0, help='Training lines shuffled together in memory, 0 = file order')
+    parser.add_argument('--shuffle_seed', type=int, required=False, default=7)
 
     # Data params
     parser.add_argument('--all_data_file', type=str, required=False, default='/data/users/kyle.shaffer/dialog_data/cornell_movie/dialogs_text.txt')
@@ -69,8 +91,25 @@ if __name__ == '__main__':
     parser.add_argument('--n_epochs', type=int, required=False, default=50)
     parser.add_argument('--gpu', type=int, required=False, default=0)
 
+    # Distributed params
+    parser.add_argument('--distributed', action='store_true', help='Data-parallel training over the workers in TF_CONFIG')
+    parser.add_argument('--n_local_workers', type=int, required=False, default=1, help='Launch this many local CPU workers')
+    parser.add_argument('--scaling_report', type=str, required=False, default=None, help='Comma-separated worker counts to benchmark, e.g. 1,2,4')
+    parser.add_argument('--scaling_steps', type=int, required=False, default=50)
+    parser.add_argument('--measure_throughput', type=int, required=False, default=None, help=argparse.SUPPRESS)
+
     args = parser.parse_args()
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
-    train(args)
+    # Arguments forwarded to locally launched workers, which run on CPU
+    launch_flags = {'--n_local_workers', '--scaling_report', '--scaling_steps'}
+    worker_args = [a for i, a in enumerate(sys.argv[1:]) if a not in launch_flags and sys.argv[i] not in launch_flags] + ['--gpu', '-1']
+
+    if args.scaling_report is not None:
+        scaling_report(os.path.abspath(__file__), worker_args, worker_counts=[int(n) for n in args.scaling_report.split(',')],
+                       n_steps=args.scaling_steps)
+    elif args.n_local_workers > 1:
+        print(launch_local_workers(args.n_local_workers, os.path.abspath(__file__), worker_args + ['--distributed']))
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+        train(args)
 
@@ -1,10 +1,14 @@
 import os
 import re
+import sys
 
 import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from line_index import LineIndex, iterate_lines
+
 def get_bpe_tokenizer(input_text:list, tgt_vocab_size:int, save_filename:str=None):
     print('Getting BPE vocab...')
     tokenizer = tfds.features.text.SubwordTextEncoder.build_from_corpus(
@@ -18,7 +22,8 @@ def get_bpe_tokenizer(input_text:list, tgt_vocab_size:int, save_filename:str=Non
     return tokenizer
 
 class DataProcessor(object):
-    def __init__(self, max_len:int, tokenizer, train_file:str, valid_file:str, batch_size:int):
+    def __init__(self, max_len:int, tokenizer, train_file:str, valid_file:str, batch_size:int, seed:int=None,
+                 shuffle_buffer:int=0, shuffle_block:int=256):
         self.max_len = max_len
         self.tokenizer = tokenizer
         self.train_file = train_file
@@ -27,7 +32,36 @@ class DataProcessor(object):
         self.eos = self.tokenizer.vocab_size + 1
         self.vocab_size = self.tokenizer.vocab_size + 2
         self.batch_size = batch_size
-        
+        self.num_shards, self.shard_index = 1, 0
+        self.line_indexes = {}
+        # Training lines are shuffled `shuffle_buffer` at a time (0 = file order), read in blocks of
+        # `shuffle_block` lines. Workers share `seed`, so shards split the same permutation.
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_block = shuffle_block
+
+    def shard(self, num_shards:int, shard_index:int):
+        """ Only yield every `num_shards`-th line starting at `shard_index`, so data-parallel
+        workers each read a disjoint part of the train/valid files
+        """
+        assert 0 <= shard_index < num_shards, 'Shard index must be in [0, num_shards)!'
+        self.num_shards, self.shard_index = num_shards, shard_index
+        return self
+
+    def line_index(self, mode:str='train'):
+        data_file = self.train_file if mode == 'train' else self.valid_file
+        if data_file not in self.line_indexes:
+            self.line_indexes[data_file] = LineIndex(data_file)
+        return self.line_indexes[data_file]
+
+    def iterator_state(self, mode:str='train', n_batches:int=0, epoch:int=0):
+        """ State of `batch_generator(mode, epoch=epoch)` after `n_batches` batches of this
+        shard - save it with a checkpoint and pass it back as `state` to seek straight to the
+        next batch
+        """
+        return self.line_index(mode).batch_state(n_batches, self.batch_size, seed=self.seed, num_shards=self.num_shards,
+                                                 shard_index=self.shard_index, epoch=epoch)
+
     def pad_batch(self, encoder_batch, decoder_batch):
         max_enc_length = self.max_len # max([len(s) for s in encoder_batch])
         max_dec_length = self.max_len # max([len(s) for s in decoder_batch])
@@ -60,21 +94,31 @@ class DataProcessor(object):
 
         return enc_padded, dec_in_padded, dec_out_padded
 
-    def get_line(self, data_file):
-        with open(data_file, mode='r') as infile:
-            for line in infile:
+    def get_line(self, data_file, state=None, epoch:int=0):
+        # Only training data is shuffled, with a fresh permutation per epoch
+        shuffle = self.shuffle_buffer > 0 and data_file == self.train_file
+        with open(data_file, mode='rb') as infile:
+            lines = iterate_lines(infile, state=state, epoch=epoch, index=self.line_index('train') if shuffle else None,
+                                  shuffle_buffer=self.shuffle_buffer if shuffle else 0, shuffle_block=self.shuffle_block,
+                                  seed=self.seed)
+            for ix, line in lines:
+                # Skipped before tokenizing, so sharding also splits the encoding work
+                if ix % self.num_shards != self.shard_index:
+                    continue
                 context, response, _ = line.strip().split('\t')
                 context_bpe, response_bpe = self.tokenizer.encode(context), self.tokenizer.encode(response)
                 
                 yield context_bpe, response_bpe
 
-    def batch_generator(self, mode:str='train'):
+    def batch_generator(self, mode:str='train', state:dict=None, epoch:int=0):
         assert mode in {'train', 'valid'}, "Please select as valid mode from: {train, valid}!"
         data_file = self.train_file if mode == 'train' else self.valid_file
+        # Each pass over the file counts as an epoch for shuffling
+        n_pass = epoch if state is None else state.get('pass', epoch)
         
         while True:
             encoder_batch, decoder_batch = [], []
-            for context, resp in self.get_line(data_file):
+            for context, resp in self.get_line(data_file, state=state, epoch=n_pass):
                 encoder_batch.append(context)
                 decoder_batch.append(resp)
                 if len(encoder_batch) == self.batch_size:
@@ -82,6 +126,9 @@ class DataProcessor(object):
                     yield [enc_padded, dec_in_padded], dec_out_padded
 
                     encoder_batch, decoder_batch = [], []
+            # Later passes start from the top of the file
+            state = None
+            n_pass += 1
 
             # Check for non-empty batches
             if len(encoder_batch) > 0:
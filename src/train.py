@@ -47,8 +47,8 @@ if __name__ == '__main__':
     parser.add_argument('--vocab_file', type=str, required=False, default='/data/users/kyle.shaffer/dialog_data/ubuntu_vocab.txt')
     parser.add_argument('--min_vocab_freq', type=int, required=False, default=3)
     parser.add_argument('--model_name', type=str, required=False, default='transformer')
-    parser.add_argument('--n_train_examples', type=int, required=False, default=1190799)
-    parser.add_argument('--n_valid_examples', type=int, required=False, default=43837)
+    parser.add_argument('--n_train_examples', type=int, required=False, default=None, help='Default: line count of --train_file')
+    parser.add_argument('--n_valid_examples', type=int, required=False, default=None, help='Default: line count of --valid_file')
     parser.add_argument('--train_from', type=str, required=False, default='')
     # Model training params
     parser.add_argument('--n_epochs', type=int, required=False, default=10, help='Number of epochs for training')
@@ -57,6 +57,19 @@ if __name__ == '__main__':
     parser.add_argument('--n_heads', type=int, required=False, default=6)
     parser.add_argument('--embedding_dim', type=int, required=False, default=256)
     parser.add_argument('--optimizer', type=str, required=False, default='adam')
+    parser.add_argument('--softmax', type=str, required=False, default='full', help='Training loss: `full` or `sampled` softmax')
+    parser.add_argument('--num_sampled', type=int, required=False, default=20000, help='Negative classes per batch for sampled softmax')
+    parser.add_argument('--attention_mode', type=int, required=False, default=0, help='MultiHeadAttention mode, 2 = fused QKV')
+    parser.add_argument('--attention_chunk_size', type=int, required=False, default=None, help='Query chunk size for memory-efficient attention, dropout is applied per chunk and attention weights are not returned. Modes 0/1 need --fix_attention_mask')
+    parser.add_argument('--attention_window', type=int, required=False, default=None, help='Sliding-window size for self-attention. Modes 0/1 need --fix_attention_mask')
+    parser.add_argument('--attention_n_global', type=int, required=False, default=1, help='Global leading tokens with --attention_window')
+    parser.add_argument('--fix_attention_mask', action='store_true', help='Mask padding correctly in attention modes 0/1, whose default inverted mask is kept for existing checkpoints')
+    parser.add_argument('--grad_accum_steps', type=int, required=False, default=1, help='Batches of gradients accumulated per optimizer update')
+    parser.add_argument('--checkpoint_dir', type=str, required=False, default=None, help='Background checkpoint directory')
+    parser.add_argument('--checkpoint_every', type=int, required=False, default=0, help='Batches between mid-epoch checkpoints, 0 = epoch end only')
+    parser.add_argument('--keep_checkpoints', type=int, required=False, default=3, help='Most recent checkpoints kept besides the best')
+    parser.add_argument('--resume', action='store_true', help='Resume from the latest checkpoint, mid-epoch if needed')
+    parser.add_argument('--shuffle_buffer', type=int, required=False, default=None, help='Training lines shuffled together in memory, 0 = file order')
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
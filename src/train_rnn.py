@@ -19,6 +19,39 @@ def train(args):
         han_rnn = HanRnnSeq2Seq(args=args, vocab=vocab)
         han_rnn.train()
 
+def quantization_report(args):
+    vocab = data_utils.get_vocab(vocab_file=args.vocab_file, min_freq=args.min_vocab_freq)
+
+    if args.model_type == 'rnn':
+        model = RNNSeq2Seq(args=args, vocab=vocab)
+        processor = data_utils.S2SProcessing(train_file=args.train_file, valid_file=args.valid_file, vocab=vocab,
+                                             batch_size=args.batch_size, model_type='recurrent')
+    else:
+        model = HanRnnSeq2Seq(args=args, vocab=vocab)
+        processor = data_utils.HanS2SProcessing(train_file=args.train_file, valid_file=args.valid_file, vocab=vocab,
+                                                batch_size=args.batch_size, model_type='recurrent')
+
+    model.quantization_report(processor.generate_s2s_batches(mode='valid'), quantize_mode=args.quantize_mode)
+
+def softmax_report(args):
+    vocab = data_utils.get_vocab(vocab_file=args.vocab_file, min_freq=args.min_vocab_freq)
+    model = RNNSeq2Seq(args=args, vocab=vocab)
+    processor = data_utils.S2SProcessing(train_file=args.train_file, valid_file=args.valid_file, vocab=vocab,
+                                         batch_size=args.batch_size, model_type='recurrent')
+
+    model.softmax_report(processor.generate_s2s_batches(mode='train'), processor.generate_s2s_batches(mode='valid'))
+
+def bleu_report(args):
+    vocab = data_utils.get_vocab(vocab_file=args.vocab_file, min_freq=args.min_vocab_freq)
+    model = HanRnnSeq2Seq(args=args, vocab=vocab)
+    if args.train_from:
+        model.load_trained_model(args.train_from)
+    processor = data_utils.HanS2SProcessing(train_file=args.train_file, valid_file=args.valid_file, vocab=vocab,
+                                            batch_size=args.batch_size, model_type='recurrent')
+
+    model.get_bleu_score(processor.generate_s2s_batches(mode='valid'), num_batches=args.bleu_batches,
+                         n_processes=args.bleu_processes, model_path=args.train_from or None)
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--gpu', type=int, required=False, default=0)
@@ -39,10 +72,32 @@ if __name__ == '__main__':
     parser.add_argument('--decoder_dim', type=int, required=False, default=256)
     parser.add_argument('--num_encoder_layers', type=int, required=False, default=2)
     parser.add_argument('--num_decoder_layers', type=int, required=False, default=1)
-    parser.add_argument('--n_train_examples', type=int, required=False, default=158037)
-    parser.add_argument('--n_valid_examples', type=int, required=False, default=17561)
+    parser.add_argument('--n_train_examples', type=int, required=False, default=None, help='Default: line count of --train_file')
+    parser.add_argument('--n_valid_examples', type=int, required=False, default=None, help='Default: line count of --valid_file')
+    parser.add_argument('--quantize_report', action='store_true', help='Report int8/float16 quantization deltas for --train_from')
+    parser.add_argument('--quantize_mode', type=str, required=False, default='int8')
+    parser.add_argument('--softmax', type=str, required=False, default='full', help='Training loss: `full` or `sampled` softmax')
+    parser.add_argument('--num_sampled', type=int, required=False, default=20000, help='Negative classes per batch for sampled softmax')
+    parser.add_argument('--softmax_report', action='store_true', help='Compare full and sampled softmax throughput/perplexity')
+    parser.add_argument('--tie_embeddings', action='store_true', help='Share embedding and output projection matrices')
+    parser.add_argument('--grad_accum_steps', type=int, required=False, default=1, help='Batches of gradients accumulated per optimizer update')
+    parser.add_argument('--checkpoint_dir', type=str, required=False, default=None, help='Background checkpoint directory')
+    parser.add_argument('--checkpoint_every', type=int, required=False, default=0, help='Batches between mid-epoch checkpoints, 0 = epoch end only')
+    parser.add_argument('--keep_checkpoints', type=int, required=False, default=3, help='Most recent checkpoints kept besides the best')
+    parser.add_argument('--resume', action='store_true', help='Resume from the latest checkpoint, mid-epoch if needed')
+    parser.add_argument('--shuffle_buffer', type=int, required=False, default=None, help='Training lines shuffled together in memory, 0 = file order')
+    parser.add_argument('--bleu_report', action='store_true', help='Corpus BLEU and sentences/sec of HAN-RNN greedy decoding')
+    parser.add_argument('--bleu_batches', type=int, required=False, default=10, help='Validation batches decoded for --bleu_report')
+    parser.add_argument('--bleu_processes', type=int, required=False, default=0, help='CPU model replicas decoding in parallel, 0 = none')
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
-    train(args)
+    if args.quantize_report:
+        quantization_report(args)
+    elif args.bleu_report:
+        bleu_report(args)
+    elif args.softmax_report:
+        softmax_report(args)
+    else:
+        train(args)
@@ -9,11 +9,19 @@ from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_sc
 
 from layer_utils import *
 from process_utils import *
+from shortlist import split_output_layer, logits_over, compare_decoding
+from dataset_manifest import example_count
+from metrics import StreamingMetrics
+from checkpointing import (CheckpointManager, KerasWeightsExport, PeriodicCheckpoint, keras_snapshot, restore_keras, rng_state,
+                           set_rng_state)
 
 # Encoder and decoder layers
 class EncoderLayer(object):
-    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, dropout=0.1):
-        self.self_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
+    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, dropout=0.1, attention_mode=0, attention_chunk_size=None,
+                 attention_window=None, attention_n_global=1, attention_legacy_mask=True):
+        self.self_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout, mode=attention_mode,
+                                                 chunk_size=attention_chunk_size, window=attention_window,
+                                                 n_global=attention_n_global, legacy_mask=attention_legacy_mask)
         self.pos_ffn_layer = PositionwiseFeedForward(d_model, d_inner_hid, dropout=dropout)
 
     def __call__(self, enc_input, mask=None):
@@ -22,9 +30,13 @@ class EncoderLayer(object):
         return output, self_attn
 
 class DecoderLayer(object):
-    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, dropout=0.1):
-        self.self_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
-        self.enc_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
+    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, dropout=0.1, attention_mode=0, attention_chunk_size=None,
+                 attention_window=None, attention_n_global=1, attention_legacy_mask=True):
+        self.self_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout, mode=attention_mode,
+                                                 chunk_size=attention_chunk_size, window=attention_window,
+                                                 n_global=attention_n_global, causal=True, legacy_mask=attention_legacy_mask)
+        self.enc_att_layer = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout, mode=attention_mode,
+                                                chunk_size=attention_chunk_size, legacy_mask=attention_legacy_mask)
         self.pos_ffn_layer = PositionwiseFeedForward(d_model, d_inner_hid, dropout=dropout)
 
     def __call__(self, dec_input, enc_output, self_mask=None, enc_mask=None):
@@ -35,10 +47,13 @@ class DecoderLayer(object):
 
 # Encoder and decoder modules
 class Encoder(object):
-    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, layers=6, dropout=0.1, word_emb=None, pos_emb=None):
+    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, layers=6, dropout=0.1, word_emb=None, pos_emb=None,
+                 attention_mode=0, attention_chunk_size=None, attention_window=None, attention_n_global=1,
+                 attention_legacy_mask=True):
         self.emb_layer = word_emb
         self.pos_layer = pos_emb
-        self.layers = [EncoderLayer(d_model, d_inner_hid, n_head, d_k, d_v, dropout) for _ in range(layers)]
+        self.layers = [EncoderLayer(d_model, d_inner_hid, n_head, d_k, d_v, dropout, attention_mode, attention_chunk_size,
+                                    attention_window, attention_n_global, attention_legacy_mask) for _ in range(layers)]
 
     def __call__(self, src_seq, src_pos, return_att=False, active_layers=999):
         x = self.emb_layer(src_seq)
@@ -57,10 +72,13 @@ class Encoder(object):
         return (x, attns) if return_att else x
 
 class Decoder(object):
-    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, layers=6, dropout=0.1, word_emb=None, pos_emb=None):
+    def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, layers=6, dropout=0.1, word_emb=None, pos_emb=None,
+                 attention_mode=0, attention_chunk_size=None, attention_window=None, attention_n_global=1,
+                 attention_legacy_mask=True):
         self.emb_layer = word_emb
         self.pos_layer = pos_emb
-        self.layers = [DecoderLayer(d_model, d_inner_hid, n_head, d_k, d_v, dropout) for _ in range(layers)]
+        self.layers = [DecoderLayer(d_model, d_inner_hid, n_head, d_k, d_v, dropout, attention_mode, attention_chunk_size,
+                                    attention_window, attention_n_global, attention_legacy_mask) for _ in range(layers)]
 
     def __call__(self, tgt_seq, tgt_pos, src_seq, enc_output, return_att=False, active_layers=999):
         dec_emb = self.emb_layer(tgt_seq)
@@ -96,8 +114,9 @@ class Transformer(object):
         self.d_model = d_model
         self.decode_model = None
         self.model_name = args.model_name
-        self.n_train_examples = args.n_train_examples
-        self.n_valid_examples = args.n_valid_examples
+        # Counted once from the corpus manifests unless given
+        self.n_train_examples = example_count(args.train_file, args.n_train_examples)
+        self.n_valid_examples = example_count(args.valid_file, args.n_valid_examples)
         self.train_file = args.train_file
         self.valid_file = args.valid_file
         self.n_epochs = args.n_epochs
@@ -105,6 +124,28 @@ class Transformer(object):
         self.vocab = vocab
         self.inverse_vocab = {v: k for k, v in self.vocab.items()}
         self.i_tokens = list(self.vocab.keys())
+        self.softmax = getattr(args, 'softmax', 'full')
+        self.num_sampled = getattr(args, 'num_sampled', 20000)
+        # 0 = separate Q/K/V projections, 2 = fused QKV projection (see `MultiHeadAttention`)
+        self.attention_mode = getattr(args, 'attention_mode', 0)
+        # Query chunk size for memory-efficient attention over long inputs, None = unchunked
+        self.attention_chunk_size = getattr(args, 'attention_chunk_size', None)
+        # Sliding-window self-attention over W tokens each side (backward only in the decoder) plus global ones, None = full
+        self.attention_window = getattr(args, 'attention_window', None)
+        self.attention_n_global = getattr(args, 'attention_n_global', 1)
+        # Modes 0/1 mask padding with the wrong sign unless this is set, kept for existing checkpoints
+        self.attention_legacy_mask = not getattr(args, 'fix_attention_mask', False)
+        # Micro-batches whose gradients are summed into one update, effective batch = batch_size * grad_accum_steps
+        self.grad_accum_steps = getattr(args, 'grad_accum_steps', 1)
+        # Background checkpointing: directory (None = under the model dir), batches between snapshots (0 = per epoch only)
+        self.checkpoint_dir = getattr(args, 'checkpoint_dir', None)
+        self.checkpoint_every = getattr(args, 'checkpoint_every', 0)
+        self.keep_checkpoints = getattr(args, 'keep_checkpoints', 3)
+        self.resume = getattr(args, 'resume', False)
+        # Lines of training data shuffled together in memory (None = default buffer, 0 = file order)
+        self.shuffle_buffer = getattr(args, 'shuffle_buffer', None)
+        assert self.softmax in {'full', 'sampled'}, 'Softmax must be `full` or `sampled`!'
+        assert self.grad_accum_steps == 1 or self.softmax == 'full', 'Gradient accumulation needs the full softmax!'
 
         d_emb = d_model
 
@@ -122,13 +163,18 @@ class Transformer(object):
         #     i_word_emb = Dropout(0.2)(i_word_emb)
         
         self.encoder = Encoder(d_model=d_model, d_inner_hid=d_inner_hid, n_head=n_head, d_k=d_k,
-                               d_v=d_v, layers=layers, dropout=dropout, word_emb=i_word_emb, pos_emb=pos_emb)
+                               d_v=d_v, layers=layers, dropout=dropout, word_emb=i_word_emb, pos_emb=pos_emb,
+                               attention_mode=self.attention_mode, attention_chunk_size=self.attention_chunk_size,
+                               attention_window=self.attention_window, attention_n_global=self.attention_n_global,
+                               attention_legacy_mask=self.attention_legacy_mask)
         # self.word_encoder = Encoder(d_model, d_inner_hid, n_head, d_k, d_v, layers, dropout, \
         #                             word_emb=i_word_emb, pos_emb=pos_emb)
         # self.sent_encoder = Encoder(d_model, d_inner_hid, n_head, d_k, d_v, layers, dropout, \
         #                             word_emb=i_word_emb, pos_emb=pos_emb)
         self.decoder = Decoder(d_model, d_inner_hid, n_head, d_k, d_v, layers, dropout, \
-                               word_emb=o_word_emb, pos_emb=pos_emb)
+                               word_emb=o_word_emb, pos_emb=pos_emb, attention_mode=self.attention_mode,
+                               attention_chunk_size=self.attention_chunk_size, attention_window=self.attention_window,
+                               attention_n_global=self.attention_n_global, attention_legacy_mask=self.attention_legacy_mask)
         # self.target_layer = TimeDistributed(Dense(units=len(o_tokens), use_bias=False))
         self.target_layer = TimeDistributed(Dense(units=len(self.vocab), use_bias=True))
 
@@ -184,22 +230,108 @@ class Transformer(object):
         # self.prpl = Lambda(K.exp)(loss)
         self.prpl = Lambda(self.get_perplexity)([self.final_output, tgt_true])
         self.accu = Lambda(self.get_accu)([self.final_output, tgt_true])
+        self.dec_output, self.tgt_true = dec_output, tgt_true
 
-        self.model = Model([self.src_seq_input, self.tgt_seq_input], loss)
-        self.model.add_loss([loss])
+        # Full-softmax loss model, also used for validation when training with sampled softmax
+        self.eval_model = Model([self.src_seq_input, self.tgt_seq_input], loss)
+        self.eval_model.add_loss([loss])
         self.output_model = Model([self.src_seq_input, self.tgt_seq_input], self.final_output)
 
-        self.model.compile(optimizer, None)
-        self.model.metrics_names.append('prpl')
-        self.model.metrics_tensors.append(self.prpl)
-        self.model.metrics_names.append('accu')
-        self.model.metrics_tensors.append(self.accu)
+        self.eval_model.compile(optimizer, None)
+        self.eval_model.metrics_names.append('prpl')
+        self.eval_model.metrics_tensors.append(self.prpl)
+        self.eval_model.metrics_names.append('accu')
+        self.eval_model.metrics_tensors.append(self.accu)
+
+        if self.softmax == 'sampled':
+            # prpl/accu metrics would need the full logits every step, so they stay on `eval_model`
+            self.model = self._sampled_loss_model(optimizer)
+            print('Training with sampled softmax over {} classes...'.format(self.num_sampled))
+        elif self.grad_accum_steps > 1:
+            self.model = self._accumulated_loss_model(optimizer)
+            print('Accumulating gradients over {} batches of {}...'.format(self.grad_accum_steps, self.batch_size))
+        else:
+            self.model = self.eval_model
+
+    def _sampled_loss_model(self, optimizer):
+        """ Loss model sharing every layer with `eval_model`, with sampled softmax over the target layer """
+        dense = self.target_layer.layer
+        sampled_softmax = SampledSoftmax(num_sampled=self.num_sampled, num_classes=len(self.vocab), projection=dense.kernel,
+                                         bias=dense.bias, hidden_size=self.d_model)
+        loss = Lambda(lambda args: sampled_softmax.masked_loss(args[1], args[0]))([self.dec_output, self.tgt_true])
+
+        model = Model([self.src_seq_input, self.tgt_seq_input], loss)
+        model.add_loss([loss])
+        model.compile(optimizer, None)
+        return model
+
+    def _accumulated_loss_model(self, optimizer):
+        """ Loss model sharing every layer with `eval_model`, with the loss summed over target tokens
+        and gradients accumulated over `grad_accum_steps` batches before each update
+        """
+        loss_sum, n_tokens = Lambda(lambda args: list(token_sum_loss(args[1], args[0])))([self.final_output, self.tgt_true])
+
+        model = Model([self.src_seq_input, self.tgt_seq_input], loss_sum)
+        model.add_loss([loss_sum])
+        model.compile(GradientAccumulation(optimizer, self.grad_accum_steps, n_tokens=n_tokens), None)
+        model.metrics_names.append('token_loss')
+        model.metrics_tensors.append(loss_sum / K.maximum(n_tokens, 1.))
+        return model
 
     def load_model(self, model_weight_path:str):
         assert self.model is not None, "You must build the model architecture before loading in weights!"
         self.model.load_weights(model_weight_path)
         self.output_model = Model([self.src_seq_input, self.tgt_seq_input], self.final_output)
 
+    def _decode_model(self):
+        return self.output_model
+
+    def enable_shortlist(self, shortlist):
+        """ Score only `shortlist.candidates(source)` at every decode step instead of the
+        full vocabulary, see shortlist.py
+
+        Arguments:
+            shortlist {shortlist.Shortlist} -- Candidate lists built from training data
+        """
+        self.shortlist = shortlist
+        self.hidden_model, self.shortlist_projection = split_output_layer(self._decode_model(), len(self.vocab))
+
+    def disable_shortlist(self):
+        self.shortlist = None
+
+    def _restrict_vocab(self, src_seq):
+        if getattr(self, 'shortlist', None) is None:
+            return None
+        return self.shortlist_projection.restrict(self.shortlist.candidates(src_seq))
+
+    def _next_token(self, inputs:list, step:int, restricted=None):
+        """ Arg-max word ID at `step`, over the full vocabulary or the shortlist in `restricted` """
+        if restricted is None:
+            output = self._decode_model().predict_on_batch(inputs)
+            return int(np.argmax(output[0, step, :]))
+        hidden = self.hidden_model.predict_on_batch(inputs)[0, step]
+        return int(restricted[0][np.argmax(logits_over(hidden, restricted))])
+
+    def shortlist_report(self, sentences:list, shortlist, decode_fn=None):
+        """ Speed-up and agreement of shortlist decoding against the full softmax
+
+        Arguments:
+            sentences {list} -- Whitespace-tokenized input sentences
+            shortlist {shortlist.Shortlist} -- Candidate lists to evaluate
+        """
+        decode_fn = self.decode_sequence if decode_fn is None else decode_fn
+        self.enable_shortlist(shortlist)
+
+        def decode(use_shortlist):
+            def fn(sent):
+                self.shortlist = shortlist if use_shortlist else None
+                return decode_fn(sent.split())
+            return fn
+
+        report = compare_decoding(decode(False), decode(True), sentences)
+        self.shortlist = shortlist
+        return report
+
     def decode_sequence(self, input_seq:list, delimiter=''):
         stop_tok = self.vocab['</s>']
         len_limit = 100
@@ -208,6 +340,7 @@ class Transformer(object):
         input_seq.insert(0, '<s>')
         src_seq = np.asarray([self.vocab[w] if w in self.vocab.keys() else self.vocab['<UNK>'] for w in input_seq])
         src_seq = np.reshape(a=src_seq, newshape=(1, len(src_seq)))
+        restricted = self._restrict_vocab(src_seq)
 
         # Set up decoder input data
         decoded_tokens = []
@@ -217,8 +350,7 @@ class Transformer(object):
         # Loop through and generate decoder tokens
         print('Generating output...')
         for i in range(len_limit - 1):
-            output = self.output_model.predict_on_batch([src_seq, target_seq])
-            sampled_index = np.argmax(output[0, i, :])
+            sampled_index = self._next_token([src_seq, target_seq], i, restricted)
             if sampled_index == stop_tok:
                 break
             decoded_tokens.append(self.inverse_vocab[int(sampled_index)])
@@ -236,13 +368,34 @@ class Transformer(object):
 
         s2s_processor = data_utils.S2SProcessing(train_file=self.train_file, valid_file=self.valid_file, vocab=self.vocab,
                                                  batch_size=self.batch_size, encoder_max_len=300, decoder_max_len=100,
-                                                 shuffle_batch=True)
-
-        for e in range(self.n_epochs):
-            train_datagen = s2s_processor.generate_s2s_batches(mode='train')
+                                                 shuffle_batch=True, seed=7, shuffle_buffer=self.shuffle_buffer)
+
+        # `eval_model` holds every layer, `self.model` the optimizer that gets stepped
+        manager = CheckpointManager(self.checkpoint_dir or os.path.dirname(ckpt_filename), prefix=self.model_name,
+                                    keep_last=self.keep_checkpoints, keep_best=1)
+        snapshot = lambda: keras_snapshot(self.eval_model, optimizer=self.model.optimizer)
+        # `save_weights` files for `load_model`, filled from the same snapshots
+        export = KerasWeightsExport(self.model, snapshot_model=self.eval_model)
+        start_epoch, start_batch, data_state = 0, 0, None
+        if self.resume:
+            weights, state = manager.latest()
+            if weights is not None:
+                restore_keras(self.eval_model, weights, optimizer=self.model.optimizer, train_model=self.model)
+                set_rng_state(state['rng'])
+                start_epoch, start_batch, data_state = state['epoch'], state['batch'], state.get('data')
+                if data_state is None and start_batch > 0:
+                    data_state = s2s_processor.iterator_state('train', start_batch, epoch=start_epoch)
+                print('Resuming from epoch {}, batch {}...'.format(start_epoch + 1, start_batch))
+
+        for e in range(start_epoch, self.n_epochs):
+            epoch_state = {'epoch': e, 'rng': rng_state()}
+            train_datagen = s2s_processor.generate_s2s_batches(mode='train', state=data_state, epoch=e)
             valid_datagen = s2s_processor.generate_s2s_batches(mode='valid')
 
-            self.model.fit_generator(train_datagen, steps_per_epoch=n_train_iters)
+            ckpt = PeriodicCheckpoint(manager, snapshot, self.checkpoint_every, epoch_state, start_batch=start_batch,
+                                      data_state_fn=lambda n, e=e: s2s_processor.iterator_state('train', n, epoch=e))
+            self.model.fit_generator(train_datagen, steps_per_epoch=max(n_train_iters - start_batch, 1), callbacks=[ckpt])
+            start_batch, data_state = 0, None
             
             # Manually iterating over batches to train from generator
             # loss_tracker, ppl_tracker, acc_tracker = 0., 0., 0.
@@ -265,8 +418,11 @@ class Transformer(object):
             print('Accuracy:', valid_acc)
             print()
 
-            self.model.save_weights(filepath=ckpt_filename.format(e+1, valid_ppl))
+            # Resume snapshot and weights for `load_model`, both written in the background while the next epoch trains
+            manager.save(snapshot(), metric=valid_loss, state={'epoch': e + 1, 'batch': 0, 'rng': rng_state()},
+                         export=(ckpt_filename.format(e+1, valid_ppl), export))
 
+        manager.wait()
         return
 
     def validate(self, valid_datagen, n_valid_iters):
@@ -285,14 +441,38 @@ class Transformer(object):
         # valid_ppl /= n_iters
         # valid_acc /= n_iters
 
-        valid_loss, valid_ppl, valid_acc = self.model.evaluate_generator(generator=valid_datagen, steps=n_valid_iters)
+        # Token-level means over the whole validation set, not means of per-batch means
+        metrics = StreamingMetrics(pad_id=self.vocab['<PAD>'])
+        for _ in range(n_valid_iters):
+            x, _ = next(valid_datagen)
+            # Logits cover decoder positions 1: of the target input
+            metrics.update(self.output_model.predict_on_batch(x), x[1][:, 1:])
 
-        return valid_loss, valid_ppl, valid_acc
+        return metrics.loss, metrics.perplexity, metrics.accuracy
+
+    def softmax_report(self, train_datagen, valid_datagen, n_steps:int=100, n_valid_batches:int=20):
+        """ Throughput of full against sampled softmax training from the same initial weights,
+        and the full-softmax validation perplexity each reaches after `n_steps` updates
+
+        Arguments:
+            train_datagen {generator} -- Yields ([source, target], None) batches
+            valid_datagen {generator} -- Same, for validation
+        """
+        sampled_model = self.model if self.softmax == 'sampled' else self._sampled_loss_model('adam')
+        train_batches = [next(train_datagen) for _ in range(min(n_steps, 50))]
+        valid_batches = [next(valid_datagen) for _ in range(n_valid_batches)]
+        train_steps = {'full': lambda batch: self.eval_model.train_on_batch(batch[0], None),
+                       'sampled': lambda batch: sampled_model.train_on_batch(batch[0], None)}
+        # Targets are the decoder input shifted by one
+        return compare_softmax_training(self.output_model, train_steps, lambda batch: self.eval_model.test_on_batch(batch[0], None)[0],
+                                        train_batches, valid_batches, n_steps=n_steps,
+                                        count_tokens=lambda batch: int((batch[0][1][:, 1:] != 0).sum()))
 
 class TransformerClassifier(object):
     def __init__(self, args, len_limit, d_model=256, d_inner_hid=512, \
                  n_head=4, d_k=64, d_v=64, layers=2, dropout=0.1, \
-                 embedding_dropout=0.2):
+                 embedding_dropout=0.2, attention_mode=0, attention_chunk_size=None, attention_window=None,
+                 attention_n_global=1, attention_legacy_mask=True):
         self.batch_size = args.batch_size
         self.n_epochs = args.n_epochs
         self.vocab_size = args.vocab_size
@@ -319,7 +499,9 @@ class TransformerClassifier(object):
             i_word_emb = dropout_layer(i_word_emb)
 
         self.encoder = Encoder(d_model, d_inner_hid, n_head, d_k, d_v, layers, dropout, \
-                               word_emb=i_word_emb, pos_emb=pos_emb)
+                               word_emb=i_word_emb, pos_emb=pos_emb, attention_mode=attention_mode,
+                               attention_chunk_size=attention_chunk_size, attention_window=attention_window,
+                               attention_n_global=attention_n_global, attention_legacy_mask=attention_legacy_mask)
 
         self.out_layer = Dense(units=self.num_classes, activation=self.final_activation)
         self.build_graph()